@@ -151,11 +151,13 @@ class B2SharePublicationService(experiment.ExperimentModuleBase):
 
     # This override gets us experiments ready for publishing instead of the active ones
     def provide_experiments(self):
-        publication_requested_exps = experiment.ExperimentsApi(self._api_session).get_experiments_by_states(
-            publication_state=[experiment.PublicationState.PUBLICATION_REQUESTED, experiment.PublicationState.DRAFT_CREATION_REQUESTED, experiment.PublicationState.DRAFT_REMOVAL_REQUESTED]
+        publication_requested_exps = self.experiments_api.get_experiments_by_states(
+            publication_state=[experiment.PublicationState.PUBLICATION_REQUESTED, experiment.PublicationState.DRAFT_CREATION_REQUESTED, experiment.PublicationState.DRAFT_REMOVAL_REQUESTED],
+            publication_engine="b2share",
+            stream=True
             )
-        # Only these for b2share
-        return filter(lambda e: e.publication.engine == "b2share" and e.storage.archive, publication_requested_exps)
+        # Only archived ones
+        return filter(lambda e: e.storage.archive, publication_requested_exps)
         
     def step_experiment(self, exp_engine: experiment.ExperimentStorageEngine): 
 
@@ -1,7 +1,7 @@
 import pathlib
 import subprocess
 
-from common import LmodEnvProvider
+from common import LmodEnvProvider, run_cancellable
 
 class AreTomoResult:
     def __init__(self,
@@ -45,7 +45,7 @@ class AreTomo:
                f'-OutBin {self.binning} -TiltAxis {self.tilt_axis} -1 -VolZ {self.thickness} -OutImod 1 -TiltCor 1')
 
         if not ( skip_if_results_exist and out_mrc.exists() and out_mrc.stat().st_size > 0 ):
-            result = subprocess.run(com, shell=True, capture_output=True, text=True,
+            result = run_cancellable(com, shell=True, capture_output=True, text=True,
                                     env=self.exec_env)
 
             if result.returncode != 0:
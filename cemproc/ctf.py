@@ -2,7 +2,7 @@ import pathlib
 import shutil
 import subprocess
 
-from common import LmodEnvProvider
+from common import LmodEnvProvider, run_cancellable
 
 class CtfResult:
     def __init__(self, mrc_pw: pathlib.Path, result_txt_file: pathlib.Path):
@@ -106,7 +106,7 @@ class CtfFind5:
         out_info = mrc_pw.parent / f"{mrc_pw.stem}.txt"
         skip = ( skip_if_results_exist and out_info.exists() and out_info.stat().st_size > 0 and mrc_pw.exists() and mrc_pw.stat().st_size > 0 )
         if not skip:
-            result = subprocess.run(self.executable, shell=True, input=command_input, capture_output=True, text=True, env=self.exec_env)
+            result = run_cancellable(self.executable, shell=True, input=command_input, capture_output=True, text=True, env=self.exec_env)
             if result.returncode != 0:
                 raise RuntimeError(f"Failed ctffind {result.returncode} \n IN {command_input} \n ERR: {result.stderr} \n OUT: {result.stdout}")
 
@@ -2,7 +2,7 @@ import pathlib
 import subprocess
 import typing
 
-from common import LmodEnvProvider, IEnvironmentSetup
+from common import LmodEnvProvider, IEnvironmentSetup, run_cancellable
 
 
 class Imod:
@@ -13,7 +13,7 @@ class Imod:
     def newstack(self, frames: typing.List[pathlib.Path], out_file: pathlib.Path, mode=2):
         frame_paths = " ".join(map(str, frames))
         command = f"newstack -mode {mode} {frame_paths} {out_file}"
-        result = subprocess.run(command, capture_output=True, text=True, env=self.exec_env, shell=True)
+        result = run_cancellable(command, capture_output=True, text=True, env=self.exec_env, shell=True)
         if result.returncode != 0:
             raise RuntimeError(f"Newstack error {result.returncode} \n ERR: {result.stderr} \n OUT: {result.stdout}")
 
@@ -3,7 +3,7 @@ import pathlib
 import re
 import subprocess
 
-from common import LmodEnvProvider
+from common import LmodEnvProvider, run_cancellable
 
 class MotionCorr3:
     def __init__(self, out_dir: pathlib.Path, voltage, apix, pre_dose, frame_dose, gpus, lmod: LmodEnvProvider, use_gpus: int = 2, gain_file: pathlib.Path=None, executable: str ='MotionCor3'):
@@ -49,7 +49,7 @@ class MotionCorr3:
         if skip_if_results_exist and out_micrograph.exists():
             return out_micrograph, self.pre_dose
 
-        result = subprocess.run(command, capture_output=True, text=True,
+        result = run_cancellable(command, capture_output=True, text=True,
                                 env=self.exec_env, shell=True)
         if result.returncode != 0:
             raise RuntimeError(f"MotionCor3 failed: {result.stderr}")
@@ -23,18 +23,19 @@ class CemprocProcessingHandler(ExperimentModuleBase):
     EXEC_CACHE = {}
 
     def provide_experiments(self):
-        exps = ExperimentsApi(self._api_session).get_experiments_by_states(
+        exps = self.experiments_api.get_experiments_by_states(
             processing_state=[
                 ProcessingState.UNINITIALIZED,
                 ProcessingState.READY,
                 ProcessingState.RUNNING,
                 ProcessingState.STOP_REQUESTED,
-                ProcessingState.FINALIZING]
+                ProcessingState.FINALIZING],
+            processing_engine="cemproc",
+            processing_node=self.module_config.lims_config.node_name,
+            stream=True
         )
 
-        return filter(lambda e: e.processing.engine == "cemproc" and (
-                    not e.processing.node_name or e.processing.node_name == self.module_config.lims_config.node_name),
-                      exps)
+        return exps
 
     def step_experiment(self, exp_engine: ExperimentStorageEngine):
         # iconf = self.module_config.get("imod")
@@ -65,6 +66,8 @@ class CemprocProcessingHandler(ExperimentModuleBase):
 
         print("Processing cemproc! ")
         def rn(no_new_mics_expected=False):
+            # Processing state is visible in LIMS while the workflow runs
+            exp_engine.exp.exp_api.flush_patch()
             dw_result, errs = exp_engine.download_raw(w_dir)
             tomo_workflow.run_single(no_new_mics_expected)
             up_result, errs = exp_engine.upload_proc(w_dir)
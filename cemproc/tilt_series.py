@@ -3,13 +3,12 @@ import sys
 import typing
 from collections import defaultdict
 
-import numpy as np
-from sklearn.cluster import DBSCAN
-
 import common
 from cemproc.imod import Imod
 from cemproc.micrograph import Micrograph
 
+np = common.lazy_import("numpy")
+
 
 class TiltSeries:
     def __init__(self, series_id: int):
@@ -159,6 +158,7 @@ class StageSeriesClustering(IStageSeries):
 
     def find_tilt_series(self):
         self.dump_mics_csv(pathlib.Path("stage_dump.csv"))
+        from sklearn.cluster import DBSCAN
         shifts = np.array([m.metadata.image_shift for m in self.micrographs])
 
         db = DBSCAN(eps=self.image_shift_eps, min_samples=4, metric='euclidean').fit(
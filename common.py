@@ -1,16 +1,26 @@
+import contextlib
+import fnmatch
+import importlib
+import importlib.util
 import json
 import logging
 import math
+import os
 import re
 import shlex
+import signal
 import time
 import pathlib
 import threading
 import datetime
 import requests
+import requests.adapters
 import urllib.parse
 import subprocess
+import sys
 import types
+
+import metrics
 # Utility to convert file size to huma readable format
 # from https://stackoverflow.com/questions/1094841/get-human-readable-version-of-file-size
 def sizeof_fmt(num, suffix="B"):
@@ -87,6 +97,101 @@ def parse_timedelta(timedelta: str) -> datetime.timedelta:
 def euclidean_distance(p1, p2):
     return math.sqrt(sum((a - b) ** 2 for a, b in zip(p1, p2)))
 
+class OperationCancelled(Exception):
+    """ Raised when an operation stops because the module running it was cancelled """
+    pass
+
+_cancellation = threading.local()
+
+class LazyModule:
+    """ Stand-in for a heavy dependency (numpy, matplotlib...), imported on first attribute access.
+        Missing top level package is still reported right away. """
+    def __init__(self, name):
+        if importlib.util.find_spec(name.partition(".")[0]) is None:
+            raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+        self._lazy_name = name
+        self._lazy_module = None
+        self._lazy_lock = threading.Lock()
+
+    def _load(self):
+        if self._lazy_module is None:
+            with self._lazy_lock:
+                if self._lazy_module is None:
+                    self._lazy_module = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._lazy_name}'>"
+
+def lazy_import(name) -> types.ModuleType:
+    """ Already imported module, or a LazyModule importing it on first use """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+@contextlib.contextmanager
+def cancellation_scope(cancel_event: threading.Event):
+    """ Make cancel_event the cancellation token of everything running on this thread within the scope """
+    previous = getattr(_cancellation, "event", None)
+    _cancellation.event = cancel_event
+    try:
+        yield cancel_event
+    finally:
+        _cancellation.event = previous
+
+def current_cancel_event() -> threading.Event:
+    """ Cancellation token of the module step running on this thread, if any """
+    return getattr(_cancellation, "event", None)
+
+def run_cancellable(args, input=None, capture_output=False, check=False, timeout=None, cancel_event: threading.Event = None,
+                    terminate_timeout=10, poll_interval=0.5, **kwargs):
+    """ subprocess.run, but the process is terminated (killed after terminate_timeout) when cancel_event
+        (the current cancellation token by default) is set, raising OperationCancelled.
+        On POSIX the process gets its own session and the whole process group is signalled,
+        so that commands run by a shell (shell=True) or scripts stop as well. """
+    cancel_event = cancel_event or current_cancel_event()
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    group = sys.platform != "win32" and kwargs.setdefault("start_new_session", True)
+
+    def signal_process(proc, sig):
+        if not group:
+            return proc.kill() if sig == "kill" else proc.terminate()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL if sig == "kill" else signal.SIGTERM)
+        except ProcessLookupError:
+            pass # Whole group already exited
+
+    deadline = time.monotonic() + timeout if timeout else None
+    with subprocess.Popen(args, **kwargs) as proc:
+        while True:
+            try:
+                stdout, stderr = proc.communicate(input, timeout=poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                input = None # Already sent
+            if deadline and time.monotonic() > deadline:
+                signal_process(proc, "kill")
+                proc.communicate()
+                raise subprocess.TimeoutExpired(args, timeout)
+            if cancel_event is not None and cancel_event.is_set():
+                signal_process(proc, "terminate")
+                try:
+                    proc.communicate(timeout=terminate_timeout)
+                except subprocess.TimeoutExpired:
+                    signal_process(proc, "kill")
+                    proc.communicate()
+                raise OperationCancelled(f"Cancelled: {args}")
+
+    result = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+    if check:
+        result.check_returncode()
+    return result
+
 # This is supposted to be run on thread
 def action_thread(func, sleeptimesec, cancel_event: threading.Event, reraise_exception=False):
     while True:
@@ -103,7 +208,8 @@ def action_thread(func, sleeptimesec, cancel_event: threading.Event, reraise_exc
             if reraise_exception:
                 raise
 
-        time.sleep(sleeptimesec)
+        # Wakes up as soon as cancelled
+        cancel_event.wait(sleeptimesec)
 
 
 def path_universal_factory(path: str):
@@ -125,14 +231,14 @@ def path_universal_factory(path: str):
 
 def translate_path(path: pathlib.Path, mappings, replacing_stem=None):
     for src, dst in mappings:
-        if src in [path] + [p for p in path.parents]:
+        if src == path or src in path.parents:
             rel = path.relative_to(src)
             return dst / rel.parent / replacing_stem if replacing_stem else dst / rel
     
     return path.parent / replacing_stem if replacing_stem else path
 
 def try_translate_path(path: pathlib.Path, src: pathlib.Path, dst: pathlib.Path):
-    if src in [path] + [p for p in path.parents]:
+    if src == path or src in path.parents:
         rel = path.relative_to(src)
         return rel 
 
@@ -144,20 +250,71 @@ class DataWrapper:
 
 # Base url options is missing in requests library, thus this
 class BaseUrlSession(requests.Session):
-    def __init__(self, base_url, timeout=5, verify=True) -> None:
+    """ Session with base url, default and per-endpoint timeouts, safe to be shared by multiple threads.
+        requests.Session itself is not thread safe, so each thread dispatches through its own lightweight session,
+        all of them sharing headers/proxies/verify of this one and a single pooled adapter (urllib3 pools are thread safe). 
+        endpoint_timeouts maps fnmatch patterns of relative urls (e.g. "experiments/*/email") to timeouts. """
+    def __init__(self, base_url, timeout=5, verify=True, pool_maxsize=10, endpoint_timeouts: dict = None) -> None:
         super().__init__()
         self.base_url = base_url
         self.timeout = timeout
         self.verify = verify
-        self._request_lock = threading.Lock()
+        self.endpoint_timeouts = endpoint_timeouts or {}
+        self._adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.mount("https://", self._adapter)
+        self.mount("http://", self._adapter)
+        self._local = threading.local()
+
+    def timeout_for(self, url):
+        path = urllib.parse.urlsplit(url).path.lstrip("/")
+        for pattern, timeout in self.endpoint_timeouts.items():
+            if fnmatch.fnmatch(path, pattern):
+                return timeout
+        return self.timeout
+
+    def _thread_session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            self._local.session = session
+        # Share configuration of this session, it can be changed after creation
+        session.headers = self.headers
+        session.proxies = self.proxies
+        session.verify = self.verify
+        session.auth = self.auth
+        session.cert = self.cert
+        return session
 
     def request(self, method, url, *args, **kwargs):
         joined_url = urllib.parse.urljoin(self.base_url, url)
         if not "timeout" in kwargs:
-            kwargs["timeout"] = self.timeout
-        # Ensure requests made through this session are serialized across threads
-        with self._request_lock:
-            return super().request(method, joined_url, *args, **kwargs)
+            kwargs["timeout"] = self.timeout_for(url)
+        module = metrics.current_module()
+        start = time.monotonic()
+        try:
+            response = self._thread_session().request(method, joined_url, *args, **kwargs)
+        except Exception:
+            metrics.LIMS_REQUESTS.inc(1, module, method.upper(), "error")
+            raise
+        finally:
+            metrics.LIMS_REQUEST_SECONDS.inc(time.monotonic() - start, module)
+        metrics.LIMS_REQUESTS.inc(1, module, method.upper(), response.status_code)
+        self._count_bytes(response, module)
+        return response
+
+    @staticmethod
+    def _count_bytes(response, module):
+        body = response.request.body if response.request is not None else None
+        if body is not None and not hasattr(body, "read"):
+            metrics.LIMS_BYTES.inc(len(body), module, "sent")
+        # Streamed content is not read here, only announced length is counted
+        received = response.headers.get("Content-Length")
+        if received is None and response._content_consumed:
+            received = len(response.content or b"")
+        if received is not None:
+            metrics.LIMS_BYTES.inc(int(received), module, "received")
 
 
 class StateObj:
@@ -229,6 +386,15 @@ def dict_to_json_patch(input_dict, path=""):
 
     return operations
 
+def merge_dicts(target: dict, source: dict):
+    """ Recursively merge source dictionary into target (in place), values from source win """
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key, None), dict):
+            merge_dicts(target[key], value)
+        else:
+            target[key] = value
+    return target
+
 def search_for_key(data, key):
     """ Recursively search key in given data object, which can be dict, list, or object  """
     if isinstance(data, dict):
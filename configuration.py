@@ -1,11 +1,16 @@
 """Configuration and node/module management"""
 
+import collections
 import datetime
+import functools
+import hashlib
 import logging
 import pathlib, fnmatch
 import sys, typing
+import threading
 import time
 import yaml, json, requests
+import jsonpatch
 
 import common
 from data_tools import DataRulesWrapper
@@ -24,8 +29,14 @@ class JobConfigWrapper:
     def metadata(self):
         return self._data["Metadata"]
     
-    @property
+    @functools.cached_property
+    def fingerprint(self):
+        """ Hash of the experiment type configuration """
+        return config_hash(self._data)
+
+    @functools.cached_property
     def data_rules(self):
+        # Wrappers live as long as the configuration version (see ConfigIndex), so are the rules parsed from it
         return DataRulesWrapper(self._data["DataRules"] if "DataRules" in self._data else [])
 
     @property
@@ -40,7 +51,139 @@ class JobConfigWrapper:
         return self._data[item]
 
 
+# C implementation of the yaml parser, if libyaml is available
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Parsed configurations by sha256 of their content, parsed objects are shared and must not be modified
+_parsed_configs = collections.OrderedDict()
+_PARSED_CONFIGS_MAX = 8
+
+def parse_config(content: bytes, content_hash=None):
+    """ Parsed yaml content, content seen recently is not parsed again """
+    content_hash = content_hash or hashlib.sha256(content).hexdigest()
+    parsed = _parsed_configs.get(content_hash, None)
+    if parsed is None:
+        parsed = yaml.load(content, Loader=_YamlLoader) or {}
+        _parsed_configs[content_hash] = parsed
+        while len(_parsed_configs) > _PARSED_CONFIGS_MAX:
+            _parsed_configs.popitem(last=False)
+    else:
+        _parsed_configs.move_to_end(content_hash)
+    return parsed
+
+_MISSING = object()
+
+def config_hash(obj):
+    """ Stable hash of a configuration section, to tell whether settings derived from it are still current """
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+def config_diff(old, new, depth=2, prefix=""):
+    """ Set of paths of configuration sections that differ, down to depth levels (e.g. "LimsNodes/node_a") """
+    if old == new:
+        return set()
+    if depth == 0 or not isinstance(old, dict) or not isinstance(new, dict):
+        return {prefix}
+    changed = set()
+    for k in old.keys() | new.keys():
+        changed |= config_diff(old.get(k, _MISSING), new.get(k, _MISSING), depth - 1, f"{prefix}/{k}" if prefix else k)
+    return changed
+
+def affects_node(changed_sections, node_name):
+    """ Whether settings resolved for the node (its modules, node and global sections) may differ after the change """
+    return any(s == "LimsNodes" or s == f"LimsNodes/{node_name}" or not s.startswith("LimsNodes/") for s in changed_sections)
+
+
+def _path_key(path: pathlib.PurePath):
+    # Windows paths compare case insensitive and never equal to posix ones
+    if isinstance(path, pathlib.PureWindowsPath):
+        return (True,) + tuple(p.lower() for p in path.parts)
+    return (False,) + path.parts
+
+class PathMappingTrie:
+    """ PathMappings compiled into a prefix tree over path components, so that lookup is O(path depth).
+        As with the list, first mapping (in configured order) whose From contains the path wins. Results are memoized per path. """
+    RESULTS_MAX = 4096
+
+    def __init__(self, path_mappings: list):
+        self._root = {}
+        for order, mpp in enumerate(path_mappings):
+            fromp = common.path_universal_factory(mpp["From"])
+            to = common.path_universal_factory(mpp["To"])
+            proxy = common.path_universal_factory(mpp["Proxy"]) if "Proxy" in mpp and mpp["Proxy"] else None
+            node = self._root
+            for part in _path_key(fromp):
+                node = node.setdefault(part, {})
+            # None key holds mappings ending at this node
+            node.setdefault(None, []).append((order, len(fromp.parts), to, proxy))
+        self._results = {}
+
+    def translate(self, path: pathlib.Path, safe_stem: str, to_proxy=False) -> pathlib.Path:
+        key = (path, safe_stem, to_proxy)
+        if key not in self._results:
+            if len(self._results) >= self.RESULTS_MAX:
+                self._results.clear()
+            self._results[key] = self._translate(path, safe_stem, to_proxy)
+        return self._results[key]
+
+    def _translate(self, path: pathlib.Path, safe_stem: str, to_proxy):
+        best = None
+        node = self._root
+        path_key = _path_key(path)
+        for depth, part in enumerate(path_key):
+            node = node.get(part, None)
+            if node is None:
+                break
+            if depth == 0: # Just the flavour of the path
+                continue
+            for mapping in node.get(None, []):
+                if (not to_proxy or mapping[3]) and (best is None or mapping[0] < best[0]):
+                    best = mapping
+
+        if best is None:
+            return None
+        _, from_depth, to, proxy = best
+        if proxy:
+            return (proxy if to_proxy else to) / safe_stem
+        return to / type(path)(*path.parts[from_depth:])
+
+
+class ConfigIndex:
+    """ Lookup indexes of one configuration version, built once and replaced as a whole when configuration changes.
+        Parts of the previous index not touched by changed_sections (see config_diff) are carried over. """
+    def __init__(self, config: dict, previous: 'ConfigIndex' = None, changed_sections=None):
+        self.config = config
+        carry = previous is not None and changed_sections is not None
+        self.modules = {} # (node name, target) => module config
+        self.module_nodes = {} # target => names of nodes running it
+        for node_name, node in (config.get("LimsNodes", None) or {}).items():
+            for mod in node.get("Modules", None) or []:
+                if (node_name, mod["target"]) not in self.modules:
+                    self.modules[(node_name, mod["target"])] = mod
+                    self.module_nodes.setdefault(mod["target"], []).append(node_name)
+        self.experiments = {} # (instrument, technique) => JobConfigWrapper
+        if carry and not changed_sections & {"", "Experiments"}:
+            # Parsed data rules of experiment types are kept
+            self.experiments = previous.experiments
+        else:
+            for exp in config.get("Experiments", None) or []:
+                self.experiments.setdefault((exp["Instrument"], exp["Technique"]), JobConfigWrapper(exp))
+        self.resolved = {} # (module name, node name, key) => value resolved by LimsModuleConfigWrapper
+        self.fingerprints = {} # (module name, node name) => hash of the settings the module resolves
+        if carry:
+            self.resolved = {k: v for k, v in previous.resolved.items() if not affects_node(changed_sections, k[1])}
+            self.fingerprints = {k: v for k, v in previous.fingerprints.items() if not affects_node(changed_sections, k[1])}
+        self._path_mappings = {} # id of PathMappings list => (the list, PathMappingTrie)
+
+    def path_mapping_trie(self, path_mappings: list) -> PathMappingTrie:
+        compiled = self._path_mappings.get(id(path_mappings), None)
+        if compiled is None or compiled[0] is not path_mappings:
+            compiled = self._path_mappings[id(path_mappings)] = (path_mappings, PathMappingTrie(path_mappings))
+        return compiled[1]
+
+
 class LimsConfigWrapper():
+    URL_TIMEOUT = 30
+
     def __init__(self, organization, node_name, config=None):
         if config is None:
             config = {}
@@ -48,12 +191,48 @@ class LimsConfigWrapper():
         self._file_path = None
         self._organization = organization
         self.node_name = node_name
-        self._configstr_cached = yaml.dump(self._config)
+        self._content_hash = None
+        self._url_session = None
         self._last_update = datetime.datetime.fromtimestamp(0)
+        # Incremented on every change, changed_sections are paths of sections changed by the last one (see config_diff),
+        # change listeners (modules dropping what they built from previous settings) get them as well
+        self.version = 0
+        self.changed_sections = set()
+        self._change_listeners = []
+        self._index = None
 
-    
+    @property
+    def index(self) -> ConfigIndex:
+        """ Indexes of the current configuration, callers keep using one consistent version even if it changes meanwhile """
+        index = self._index
+        if index is None or index.config is not self._config:
+            index = self._index = ConfigIndex(self._config)
+        return index
+
+    def on_change(self, listener):
+        """ listener(changed_sections) is called whenever configuration changes, after the new one is in place """
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        if listener in self._change_listeners:
+            self._change_listeners.remove(listener)
+
+    def _set_config(self, config, content_hash=None):
+        changed = config_diff(self._config, config)
+        previous = self._index if self._index is not None and self._index.config is self._config else None
+        self._config = config
+        self._content_hash = content_hash
+        self._index = ConfigIndex(config, previous, changed)
+        if changed:
+            self.version += 1
+            self.changed_sections = changed
+            for listener in list(self._change_listeners):
+                try:
+                    listener(changed)
+                except Exception as e:
+                    logging.error("Configuration change listener failed", exc_info=e)
+        return changed
 
-    
     def from_file(self, path: str=None):
         if path is not None:
             self._file_path = path
@@ -67,35 +246,43 @@ class LimsConfigWrapper():
     def from_local_file(self, path: pathlib.Path):
         lastmodnew = datetime.datetime.utcfromtimestamp(path.stat().st_mtime)
         if lastmodnew > self._last_update or self._last_update == datetime.datetime.fromtimestamp(0):
-            self._last_update = datetime.datetime.utcnow()
-            self._configstr_cached = path.read_text()
-            self._config = yaml.full_load(self._configstr_cached)
-            # From now on, we will use json - yaml just for loading the file
-            # self._configstr_cached = json.dumps(self._config)
-            #  TODO not really necessary?
-            return True
+            return self._from_content(path.read_bytes())
 
         return False # No config refresh
 
     def from_url(self, url: str): 
-        result = requests.get(url)
-        if result.text != self._configstr_cached: 
-            self._configstr_cached = result.text
-            self._config = yaml.full_load(self._configstr_cached)
-            return True
-        
-        return False
+        if self._url_session is None:
+            self._url_session = requests.Session()
+        result = self._url_session.get(url, timeout=self.URL_TIMEOUT)
+        result.raise_for_status()
+        return self._from_content(result.content)
+
+    def _from_content(self, content: bytes):
+        """ Use yaml content as configuration, returns False if it is the same as the current one """
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash == self._content_hash:
+            return False
+
+        first_load = self._content_hash is None
+        changed = self._set_config(parse_config(content, content_hash), content_hash)
+        # Touched or reformatted without changing the configuration itself does not count as an update
+        if not changed and not first_load:
+            return False
+        self._last_update = datetime.datetime.utcnow()
+        return True
 
     def reset(self):
-        self._config = {}
-        self._configstr_cached = "{}"
+        self._set_config({})
         self._last_update = datetime.datetime.min
 
     def from_obj(self, obj, dt_config):
-        self._config = obj
-        self._configstr_cached = json.dumps(obj)
+        self._set_config(obj)
         self._last_update = dt_config
 
+    def apply_patch(self, json_patch: list, dt_config):
+        """ Apply json patch delta between the current and the dt_config version of configuration """
+        self.from_obj(jsonpatch.apply_patch(self._config, json_patch), dt_config)
+
     def __getitem__(self, item):
         return self._config[item]
 
@@ -118,11 +305,14 @@ class LimsConfigWrapper():
         return node
     
     def get_module_config(self, module_name, node_name=None):
-        return next(filter(lambda x: x["target"] == module_name, self.get_node_config(node_name)["Modules"]), None)
+        self.get_node_config(node_name)
+        return self.index.modules.get((node_name or self.node_name, module_name), None)
     
     def get_experiment_config(self, instrument, technique):
-        cf = next(filter(lambda e: (e["Instrument"] == instrument and e["Technique"] == technique), self._config["Experiments"]))
-        return JobConfigWrapper(cf)
+        cf = self.index.experiments.get((instrument, technique), None)
+        if cf is None:
+            raise KeyError(f"No configuration for experiment type {instrument}/{technique}")
+        return cf
 
     
     def find_module_config_any_node(self, module_name):
@@ -130,31 +320,14 @@ class LimsConfigWrapper():
         return next(nodes, (None, None))
 
     def find_module_config_nodes(self, module_name):
-        for k,v in self._config["LimsNodes"].items():
-            mod = next(filter(lambda x: x["target"] == module_name, v["Modules"]), None)
-            if mod:
-                yield LimsModuleConfigWrapper(module_name, k, self)
+        for k in self.index.module_nodes.get(module_name, []):
+            yield LimsModuleConfigWrapper(module_name, k, self)
 
     def translate_path(self, path: pathlib.Path, safe_stem: str, path_mappings=None, to_proxy=False) -> pathlib.Path:
         if not path_mappings:
             path_mappings = self.node["PathMappings"]
 
-        for mpp in path_mappings:
-            fromp = common.path_universal_factory(mpp["From"])
-            to = common.path_universal_factory(mpp["To"])
-            proxy = common.path_universal_factory(mpp["Proxy"]) if "Proxy" in mpp and mpp["Proxy"] else None
-
-            if to_proxy and not proxy:
-                continue
-            if to_proxy:
-                to = proxy
-
-            rel = common.try_translate_path(path, fromp, to)
-            if rel and proxy:
-                return to / safe_stem
-            elif rel:
-                return to / rel
-        return None
+        return self.index.path_mapping_trie(path_mappings).translate(path, safe_stem, to_proxy)
 
 
 
@@ -171,6 +344,37 @@ class LimsModuleConfigWrapper():
             return default
         
     def __getitem__(self, item):
+        # Resolution is done once per configuration version
+        resolved = self.lims_config.index.resolved
+        key = (self.module_name, self.node_name, item)
+        val = resolved.get(key, _MISSING)
+        if val is _MISSING:
+            val = resolved[key] = self._resolve(item)
+        if val is _MISSING:
+            raise KeyError(f"Key {item} not found in the configuration")
+        return val
+
+    def affected_by(self, changed_sections):
+        """ Whether a configuration change (LimsConfigWrapper.on_change) may change settings of this module """
+        return affects_node(changed_sections, self.node_name)
+
+    @property
+    def fingerprint(self):
+        """ Hash of the settings this module resolves - its own config, its node (without other modules) and global sections
+            except experiment types. Stays the same when only other modules, nodes or experiment types change. """
+        index = self.lims_config.index
+        key = (self.module_name, self.node_name)
+        fingerprint = index.fingerprints.get(key, None)
+        if fingerprint is None:
+            node = (index.config.get("LimsNodes", None) or {}).get(self.node_name, None) or {}
+            fingerprint = index.fingerprints[key] = config_hash([
+                index.modules.get((self.node_name, self.module_name), None) if self.module_name else None,
+                {k: v for k, v in node.items() if k != "Modules"},
+                {k: v for k, v in index.config.items() if k not in ("LimsNodes", "Experiments")},
+            ])
+        return fingerprint
+
+    def _resolve(self, item):
         if self.module_name:
             module_config = self.lims_config.get_module_config(self.module_name, self.node_name)
             val = common.get_dict_val_by_path(module_config, item)
@@ -188,7 +392,7 @@ class LimsModuleConfigWrapper():
         if global_c is not None:
             return global_c
         
-        raise KeyError(f"Key {item} not found in the configuration")
+        return _MISSING
         
     
 
@@ -199,10 +403,21 @@ class LimsNodeModule:
         self._lims_logger: logging.Logger = lims_logger
         self._api_session: requests.Session = api_session
         self.module_config: LimsModuleConfigWrapper = module_config
+        # Set when the module gets disabled or removed, long running work should check it (see common.cancellation_scope)
+        self.cancel_event = threading.Event()
 
     def step(self):
         pass
 
+    def close(self):
+        """ Release resources of the module once it is removed or disabled and its last step finished """
+        pass
+
+    def drain(self, timeout):
+        """ Wait up to timeout seconds for work the cancelled module runs outside of its steps (e.g. runner workers),
+            True when none is left """
+        return True
+
     
 def _ping_helper(session: requests.Session, node_name):
     """ Ping sip server and extract last config update datetime from the response """
@@ -234,6 +449,11 @@ class ConfigToDbSyncer(LimsNodeModule):
 
 
 class ConfigFromDbSyncer(LimsNodeModule):
+    """ Pulls configuration from LIMS when ping reports a newer one.
+        With long_poll_wait set, step then waits up to long_poll_wait seconds for a change notification
+        (centers/changes/{node}?since=...&wait=... => {"DtConfig": ..., "Patch": json patch or null}), ping is just a heartbeat.
+        LIMS without the endpoint (404) turns long polling off, other failures of the wait only end the step. """
+    long_poll_wait = None
 
     def step(self):
         config = self.module_config.lims_config
@@ -248,11 +468,50 @@ class ConfigFromDbSyncer(LimsNodeModule):
             config_fetched = self._api_session.get("centers").json()
             config.from_obj(config_fetched, last_config_update)
             self.logger.info(f"Fetched configuration from LIMS.")
+        elif self.long_poll_wait: # Current configuration is up to date - wait for a change
+            try:
+                self._wait_for_change(config)
+            except Exception as e:
+                # Ping keeps the configuration up to date meanwhile
+                self.logger.warning(f"Waiting for configuration change failed: {e}")
+
+    def _wait_for_change(self, config: LimsConfigWrapper):
+        res = self._api_session.get(f"centers/changes/{config.node_name}",
+                                    params={"since": config._last_update.isoformat(), "wait": self.long_poll_wait},
+                                    timeout=self.long_poll_wait + 10)
+        if res.status_code == 404:
+            self.logger.info("LIMS does not notify about configuration changes, using ping only.")
+            self.long_poll_wait = None
+            return
+        res.raise_for_status()
+        if res.status_code == 204: # No change while waiting
+            return
+
+        change = res.json()
+        dt_config = datetime.datetime.fromisoformat(change["DtConfig"])
+        if change.get("Patch", None) is not None:
+            try:
+                config.apply_patch(change["Patch"], dt_config)
+                self.logger.info(f"Applied configuration change from LIMS.")
+                return
+            except jsonpatch.JsonPatchException as e:
+                self.logger.warning(f"Configuration change does not apply, fetching whole configuration: {e}")
+
+        config.from_obj(self._api_session.get("centers").json(), dt_config)
+        self.logger.info(f"Fetched configuration from LIMS.")
 
 
    
-def create_lims_session(base_url, api_key, https_proxy=None, verify=True):
-    session = common.BaseUrlSession(base_url, verify=verify)
+# Slow LIMS endpoints, everything else uses the session default timeout
+LIMS_ENDPOINT_TIMEOUTS = {
+    "experiments/*/email": 130,
+    "documents/*/files": 60,
+    "experiments/logs": 20,
+}
+
+def create_lims_session(base_url, api_key, https_proxy=None, verify=True, pool_maxsize=10, endpoint_timeouts=None):
+    session = common.BaseUrlSession(base_url, verify=verify, pool_maxsize=pool_maxsize,
+                                    endpoint_timeouts={**LIMS_ENDPOINT_TIMEOUTS, **(endpoint_timeouts or {})})
     session.headers.update({"lims-organization": api_key})
 
     if https_proxy:
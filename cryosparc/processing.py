@@ -4,15 +4,15 @@ import logging
 import os, sys, re, json, pathlib
 from io import TextIOWrapper
 import subprocess
-from common import StateObj, exec_state
-import numpy as np
+from common import StateObj, exec_state, lazy_import
 import processing_tools
 import data_tools
 import fs_storage_engine
 import common
-from cryosparc.reporting import CryosparcReport
 from experiment import ExperimentModuleBase, ExperimentStorageEngine, ExperimentsApi, JobState, ProcessingState
 
+np = lazy_import("numpy")
+
 class ProjectInfo:
     def __init__(self, project_id: str, session_id: str, dirname: str):
         self.project_id = project_id
@@ -82,7 +82,7 @@ class CryosparcWrapper(StateObj):
             
         self.exp_engine.logger.info(f"Invoking cryosparc engine: {' '.join(args)}")
         try:
-            pc = subprocess.run(args, text=True, input=stdin, capture_output=True, check=True, env=env)
+            pc = common.run_cancellable(args, text=True, input=stdin, capture_output=True, check=True, env=env)
         except subprocess.CalledProcessError as e:
             print("ERRR")
             print(e.stdout, e.stderr)
@@ -180,6 +180,8 @@ class CryosparcWrapper(StateObj):
         pp = self.project_path
         if not pp:
             raise ValueError("No project path specified")
+        # Reporting pulls in matplotlib and reportlab, only needed here
+        from cryosparc.reporting import CryosparcReport
         report = CryosparcReport(pp)
         try:
             report_path = report.create_report()
@@ -197,16 +199,19 @@ class CryosparcWrapper(StateObj):
 class CryosparcProcessingHandler(ExperimentModuleBase): 
 
     def provide_experiments(self):
-        exps = ExperimentsApi(self._api_session).get_experiments_by_states(
+        exps = self.experiments_api.get_experiments_by_states(
             processing_state=[
                 ProcessingState.UNINITIALIZED, 
                        ProcessingState.READY, 
                        ProcessingState.RUNNING,
                        ProcessingState.STOP_REQUESTED,  
-                       ProcessingState.FINALIZING]
+                       ProcessingState.FINALIZING],
+            processing_engine="cryosparc",
+            processing_node=self.module_config.lims_config.node_name,
+            stream=True
             )
-        
-        return filter(lambda e: e.processing.engine == "cryosparc" and (not e.processing.node_name or e.processing.node_name == self.module_config.lims_config.node_name), exps)
+
+        return exps
 
     def step_experiment(self, exp_engine: ExperimentStorageEngine):
         cconf = self.module_config["cryosparc_config"]
@@ -230,6 +235,8 @@ class CryosparcProcessingHandler(ExperimentModuleBase):
                 cw.create_and_submit_report()
 
         def running():
+            # Running state and pid are visible in LIMS during the transfers
+            exp_engine.exp.exp_api.flush_patch()
             # Fetch new data from storage -> processing project
             dw_result, errs = exp_engine.download_raw(cw.raw_data_dir, timeout=60*5) # Download for 5 minutes (chunk), so we can improve liveness
             _check_and_gen_report_helper()
@@ -252,6 +259,7 @@ class CryosparcProcessingHandler(ExperimentModuleBase):
 
         def _uploading(on_finish):
             """ Should return processed data to storage """
+            exp_engine.exp.exp_api.flush_patch()
             up_result, errs = exp_engine.upload_processed(cw.project_path, cw.project_path.name)
             up_result = _filter_relevant_upload_results(up_result)
             print("FIn UP", up_result)
@@ -5,7 +5,7 @@ from data_tools import TransferAction
 
 class DataArchivationService(experiment.ExperimentModuleBase):
     def provide_experiments(self):
-        return experiment.ExperimentsApi(self._api_session).get_experiments_by_states(storage_state=[experiment.StorageState.ARCHIVATION_REQUESTED, experiment.StorageState.ARCHIVING])
+        return self.experiments_api.get_experiments_by_states(storage_state=[experiment.StorageState.ARCHIVATION_REQUESTED, experiment.StorageState.ARCHIVING])
     
     def step_experiment(self, exp_engine: experiment.ExperimentStorageEngine):
         # We have experiment current storage engine
@@ -32,6 +32,7 @@ class DataArchivationService(experiment.ExperimentModuleBase):
         
         # Set state that we are archiving this experiment 
         exp_engine.exp.storage.state = experiment.StorageState.ARCHIVING
+        exp_engine.exp.exp_api.flush_patch()
 
         # Archive (=move) data
         try:
@@ -1,4 +1,5 @@
 """ Periodically schedulabe service to clean up source datafolder picked for experiments"""
+import functools
 import experiment
 from experiment import ExperimentStorageEngine, ExperimentWrapper
 import shutil, common, datetime
@@ -6,8 +7,12 @@ import configuration
 from proxy_transferer import find_proxy_destination_directory_helper
 import sys
 class DataCleanService(configuration.LimsNodeModule):
+    @functools.cached_property
+    def experiments_api(self):
+        return experiment.ExperimentsApi(self._api_session)
+
     def provide_experiments(self):
-        return experiment.ExperimentsApi(self._api_session).get_experiments(subpath="source_cleanable")
+        return self.experiments_api.get_experiments(subpath="source_cleanable")
     
     def step(self):
         exps_to_clean = self.provide_experiments()
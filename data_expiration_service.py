@@ -5,7 +5,7 @@ from experiment import ExperimentStorageEngine, OperationState, Operations
 
 class DataExpirationService(experiment.ExperimentModuleBase):
     def provide_experiments(self):
-        return (experiment.ExperimentsApi(self._api_session)
+        return (self.experiments_api
                 .get_experiments_by_operation_states([(Operations.EXPIRATION, OperationState.REQUESTED)]))
     
     def step_experiment(self, exp_engine: ExperimentStorageEngine):
@@ -17,6 +17,7 @@ import typing
 import traceback
 import yaml
 import common
+import metrics
 from common import as_list
 import functools
 from fnmatch import fnmatch
@@ -226,6 +227,8 @@ class DataRule:
         return f"DataRule({self.patterns}, {self.tags}, {self.target}, {self.keep_tree}, {self.subfiles}, {self.action}, {self.condition})"
 
 class DataRulesWrapper:
+    """ Rule set, rules are not modified once wrapped - derived rule sets (with_tags, get_target_for, ...)
+        are built once and shared by everyone using the same wrapper """
     def __init__(self, data_rules: typing.Union[list, DataRule, dict]) -> None:
         # Data_rules arg is a list that can contain both dicts or DataRule objects
         # Create self.data_rules where all items are DataRule objects
@@ -235,18 +238,32 @@ class DataRulesWrapper:
         for dr in data_rules: 
             self.data_rules.append(dr if isinstance(dr, DataRule) else DataRule(**dr))
 
+        self._tag_index = {} # tag => indexes of rules having it
+        for i, dr in enumerate(self.data_rules):
+            for tag in dr.tags:
+                self._tag_index.setdefault(tag, set()).add(i)
+        self._derived = {} # key => derived rule set or rule
+
+    def derive(self, key, factory):
+        """ Rule set (or rule) derived from this one, factory is called once per key """
+        derived = self._derived.get(key, None)
+        if derived is None:
+            derived = self._derived[key] = factory()
+        return derived
+
     def with_tags(self, *tags) -> 'DataRulesWrapper':
         # Filter current data rules by tag and return new dataruleswrapper object
         # Make each given "tag" to be a set
-        tag_sets = [item if isinstance(item, set) else {item} for item in tags]
-        out_rules = []
-        for dr in self.data_rules:
-            # Any of tag_sets is subset of dr.tags?
-            dr_ready = any(tg.issubset(dr.tags) for tg in tag_sets)
-            if dr_ready:
-                out_rules.append(dr)
-
-        return DataRulesWrapper(out_rules)
+        tag_sets = tuple(frozenset(item) if isinstance(item, (set, frozenset)) else frozenset({item}) for item in tags)
+        return self.derive(("with_tags", tag_sets), lambda: DataRulesWrapper([self.data_rules[i] for i in sorted(self._matching_rules(tag_sets))]))
+
+    def _matching_rules(self, tag_sets):
+        # Rules having all tags of any of tag_sets
+        all_rules = set(range(len(self.data_rules)))
+        matching = set()
+        for tg in tag_sets:
+            matching |= all_rules.intersection(*[self._tag_index.get(t, set()) for t in tg])
+        return matching
     
     def match_files(self, files: typing.Iterable[pathlib.Path]):
         files = set(files)
@@ -258,10 +275,14 @@ class DataRulesWrapper:
             files = files.difference(matched)
 
     def get_target_for(self, *tags, **rule_args) -> DataRule:
-        patts_result = []
-        for rule in self.with_tags(*tags):
-            patts_result = patts_result + rule.get_target_patterns()
-        return DataRule(patts_result, tags, **rule_args)
+        def target_rule():
+            patts_result = []
+            for rule in self.with_tags(*tags):
+                patts_result = patts_result + rule.get_target_patterns()
+            return DataRule(patts_result, tags, **rule_args)
+
+        key = ("target_for", tuple(frozenset(t) if isinstance(t, (set, frozenset)) else t for t in tags), tuple(sorted(rule_args.items())))
+        return self.derive(key, target_rule)
 
     def get_tags_patterns(self):
         for rule in self.data_rules:
@@ -458,7 +479,8 @@ class DataAsyncTransferer:
                  on_start = None,
                  on_finish = None,
                  on_file_done = None,
-                 app_data_dir = None):
+                 app_data_dir = None,
+                 cancel_event: threading.Event = None):
         self.source = source
         self.target = target
         self.data_rules = data_rules
@@ -472,6 +494,8 @@ class DataAsyncTransferer:
         self.on_finish = on_finish or (lambda: None)
         self.on_file_done = on_file_done or (lambda: None)
         self.max_consecutive_errors = 10
+        # Cancellation token of the module step creating the transferer, unless given
+        self.cancel_event = cancel_event or common.current_cancel_event()
 
         self.executor = None
         self.ev_loop = None
@@ -640,21 +664,32 @@ class DataAsyncTransferer:
         # Now, wait for the transfer tasks and react to their result
         transfer_start = time.time()
         consecutive_errors = 0
+        if self.cancel_event is not None:
+            self.ev_loop.create_task(self._cancel_when_requested(tasks))
         for tsk in asyncio.as_completed(tasks):
             try:
                 result = await tsk
 
                 _mark_as_done_helper(result.file, result.modif)
+                module = metrics.current_module()
+                metrics.STORAGE_TRANSFER_FILES.inc(1, module)
+                metrics.STORAGE_TRANSFER_BYTES.inc(result.size, module)
+                metrics.STORAGE_TRANSFER_SECONDS.inc(result.transfer_time, module)
 
                 message = f"TRANSFER [{', '.join(result.dr.tags)}]; {common.sizeof_fmt(result.size)}, {result.transfer_time:.3f} sec, \n {result.file.name}"
                 if result.checksum:
                     message += f", checksum validated"
-                self.logger.info(message)
+                # Per file messages are summarized before they get to LIMS
+                self.logger.info(message, extra={"coalesce": f"TRANSFER [{', '.join(result.dr.tags)}]; {{count}} files, {{size}} in last {{window}} s",
+                                                 "coalesce_size": result.size})
                 consecutive_errors = 0
                 if timeout and (time.time() - transfer_start) > timeout:
                     self.logger.info("Timeout hit, transfer remaining in next round")
                     break
                 
+            except asyncio.CancelledError:
+                self.logger.info("Transfer cancelled, remaining files are left for later")
+                break
             except Exception as e:
                 self.logger.error("File transfer failed: " + str(e))
                 traceback.print_exc()
@@ -669,6 +704,12 @@ class DataAsyncTransferer:
 
         return successes, errors
 
+    async def _cancel_when_requested(self, tasks, poll_interval=0.5):
+        while not self.cancel_event.is_set():
+            await asyncio.sleep(poll_interval)
+        for tsk in tasks:
+            tsk.cancel()
+
     def stop(self):
         tsks = asyncio.all_tasks(self.ev_loop)
         for tsk in tsks:
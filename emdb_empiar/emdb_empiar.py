@@ -175,10 +175,8 @@ class EmdbEmpiarPublicationService(experiment.ExperimentModuleBase):
             (Operations.PUBLICATION, experiment.OperationState.RUNNING)
         ]
 
-        exps = (experiment.ExperimentsApi(self._api_session)
-                .get_experiments_by_operation_states(valid_states))
-
-        return filter(lambda e: e.publications.publication("empiar-emdb"), exps)
+        return (self.experiments_api
+                .get_experiments_by_operation_states(valid_states, publication_engine="empiar-emdb", stream=True))
 
     def _state_file(self) -> pathlib.Path:
         return pathlib.Path(self.module_config.get("state_file", STATE_FILE_DEFAULT))
@@ -1,8 +1,15 @@
+import collections
 import concurrent
+import contextlib
+import copy
 import fnmatch
+import importlib
 import logging
+import multiprocessing
 import pathlib
 import re
+import signal
+import sys
 import weakref
 
 import yaml
@@ -12,16 +19,20 @@ import datetime
 import requests
 
 import data_tools
+import leases
 import logger_db_api
+import metrics
 import datetime
 import enum
 import uuid
 import threading
+import time
 import inspect, tempfile
 from typing import List, Union, Tuple
 from data_tools import DataRulesSniffer, DataRulesWrapper, DataRule, MetadataModel, TransferAction, TransferCondition, \
     list_directory, DataAsyncTransferer, FnMatchPattern
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
 
 class JobState(enum.Enum):
     IDLE = "Idle"
@@ -72,10 +83,200 @@ class Operations(enum.Enum):
     PUBLICATION = "PublicationOperation"
 
 
+class ExperimentQueryCache:
+    """ Node wide cache of experiment list queries, shared by all modules.
+        Identical queries running at the same time are sent only once (single flight), results are reused for ttl seconds.
+        Any change of an experiment made by this node invalidates the cache, as the experiment may have moved between queries. """
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {} # key => (monotonic time, data)
+        self._in_flight = {} # key => Future of data
+        self._generation = 0
+        self._invalidation_listeners = []
+        # Last response of each query with its validators, kept beyond ttl for conditional requests
+        self._validated = {} # key => (etag, last modified, data)
+
+    def get(self, key, fetch):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+
+            future = self._in_flight.get(key, None)
+            is_owner = future is None
+            if is_owner:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                generation = self._generation
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            data = fetch()
+        except BaseException as e:
+            with self._lock:
+                if self._in_flight.get(key, None) is future:
+                    del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._in_flight.get(key, None) is future:
+                del self._in_flight[key]
+            # Do not store results fetched before an invalidation
+            if self.ttl > 0 and generation == self._generation:
+                self._entries[key] = (time.monotonic(), data)
+        future.set_result(data)
+        return data
+
+    def get_validated(self, key):
+        with self._lock:
+            return self._validated.get(key, None)
+
+    def set_validated(self, key, etag, last_modified, data):
+        with self._lock:
+            if etag or last_modified:
+                self._validated[key] = (etag, last_modified, data)
+            else:
+                self._validated.pop(key, None)
+
+    def on_invalidate(self, listener):
+        self._invalidation_listeners.append(listener)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._in_flight.clear()
+            self._generation += 1
+        for listener in self._invalidation_listeners:
+            listener()
+
+experiment_query_cache = ExperimentQueryCache()
+
+
+def _value_in(path):
+    return lambda exp, values: common.get_dict_val_by_path(exp, path) in values
+
+def _unassigned_or_node_in(exp, values):
+    node = common.get_dict_val_by_path(exp, "Processing/Node")
+    return not node or node in values
+
+def _publication_engine_in(exp, values):
+    return any(p.get("PublicationEngine", None) in values for p in exp.get("Publications", None) or [])
+
+def _exp_type_in(exp, values):
+    return f"{exp.get('InstrumentName', None)}/{exp.get('Technique', None)}" in values
+
+# Experiment list query parameters that can be evaluated locally => predicate(experiment data, requested values)
+EXPERIMENT_QUERY_FILTERS = {
+    "expState": _value_in("State"),
+    "storageState": _value_in("Storage/State"),
+    "processingState": _value_in("Processing/State"),
+    "processingEngine": _value_in("Processing/ProcessingEngine"),
+    "processingNode": _unassigned_or_node_in,
+    "publicationEngine": _publication_engine_in,
+    "expType": _exp_type_in,
+}
+
+def _join_values(values: Union[str, List[str]]):
+    return values if isinstance(values, str) else ",".join(values)
+
+def filter_experiments(queryData, expData: list):
+    """ Apply the locally evaluable part of an experiment list query (dict or list of pairs) to experiment data """
+    pairs = queryData.items() if isinstance(queryData, dict) else queryData
+    filters = [(EXPERIMENT_QUERY_FILTERS[k], v.split(",")) for k, v in pairs if k in EXPERIMENT_QUERY_FILTERS]
+    if not filters:
+        return expData
+    return [e for e in expData if all(predicate(e, values) for predicate, values in filters)]
+
+class ExperimentMirror:
+    """ Local in-memory mirror of experiments, kept in sync through "changed since cursor" queries to the LIMS
+        (experiments/changes?since=cursor => {"Cursor": ..., "Experiments": [changed...], "Removed": [ids...]}).
+        State queries are then answered from memory, so LIMS traffic scales with the rate of changes, not with the number of experiments.
+        Sync happens on query, at most once per sync_interval, or sooner when this node changed an experiment. """
+    def __init__(self, http_session: requests.Session, sync_interval=2.0):
+        self._http_session = http_session
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._experiments = {} # id => data
+        self._cursor = None
+        self._last_sync = None
+        self._results = {} # query key => list of experiment data, valid until next change
+
+    def mark_stale(self):
+        self._last_sync = None
+
+    def can_query(self, queryData):
+        return isinstance(queryData, dict) and all(k in EXPERIMENT_QUERY_FILTERS for k in queryData)
+
+    def sync(self):
+        params = {"since": self._cursor} if self._cursor is not None else {}
+        changes = self._http_session.get("experiments/changes", params=params).json()
+        changed, removed = changes.get("Experiments", []), changes.get("Removed", [])
+        for exp in changed:
+            self._experiments[exp["Id"]] = exp
+        for exp_id in removed:
+            self._experiments.pop(exp_id, None)
+        if changed or removed:
+            self._results.clear()
+        self._cursor = changes["Cursor"]
+        self._last_sync = time.monotonic()
+
+    def query(self, queryData: dict):
+        # Under the lock, concurrent queries wait for one sync instead of each doing their own
+        with self._lock:
+            if self._last_sync is None or time.monotonic() - self._last_sync >= self.sync_interval:
+                self.sync()
+
+            query_key = tuple(sorted(queryData.items()))
+            result = self._results.get(query_key, None)
+            if result is None:
+                result = filter_experiments(queryData, list(self._experiments.values()))
+                self._results[query_key] = result
+            return result
+
+experiment_mirror: ExperimentMirror = None
+
+def enable_experiment_mirror(http_session: requests.Session, sync_interval=2.0):
+    """ Make state queries of all modules on this node go through a local experiment mirror """
+    global experiment_mirror
+    experiment_mirror = ExperimentMirror(http_session, sync_interval)
+    experiment_query_cache.on_invalidate(experiment_mirror.mark_stale)
+    return experiment_mirror
+
+
+def conditional_get(http_session: requests.Session, path, validated=None, **kwargs):
+    """ GET with If-None-Match/If-Modified-Since from previous (etag, last_modified, data) response.
+        Returns (data, etag, last_modified), data is the previous data object itself when server responds 304 Not Modified """
+    headers = {}
+    if validated:
+        etag, last_modified, _ = validated
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    result = http_session.get(path, headers=headers, **kwargs)
+    if result.status_code == 304 and validated:
+        return validated[2], validated[0], validated[1]
+
+    return result.json(), result.headers.get("ETag", None), result.headers.get("Last-Modified", None)
+
+
 class ExperimentApi:
-    def __init__(self, exp_id, http_session: requests.Session):
+    def __init__(self, exp_id, http_session: requests.Session, query_cache: ExperimentQueryCache = None, on_patch_failed=None):
         self.exp_id = exp_id
         self._http_session = http_session
+        self._query_cache = query_cache or experiment_query_cache
+        # Called when LIMS does not accept a patch, so that wrappers with its optimistic changes are not reused
+        self._on_patch_failed = on_patch_failed
+        # Experiment data that patches are optimistically applied to, set by ExperimentWrapper
+        self.local_data = None
+        self._detail_validators = (None, None)
+        # Changes collected by patch_context, None when not inside one
+        self._pending_patch = None
 
     @property
     def session(self):
@@ -85,14 +286,72 @@ class ExperimentApi:
         return f"experiments/{self.exp_id}"
         
     def get_experiment(self):
-        result = self._http_session.get(f"experiments/{self.exp_id}")
-        return result.json()
+        validated = (*self._detail_validators, self.local_data) if self.local_data is not None else None
+        data, *self._detail_validators = conditional_get(self._http_session, f"experiments/{self.exp_id}", validated)
+        if self._pending_patch:
+            # Not yet flushed changes are still valid for the caller
+            common.merge_dicts(data, copy.deepcopy(self._pending_patch))
+        return data
     
     def patch_experiment(self, data):
         """ Data is just a dictionary with properties to be replaced to new values, possibly nested,
-            convert it to a new data structure in format of "json patch" standard, which will be sent to the server"""
+            convert it to a new data structure in format of "json patch" standard, which will be sent to the server.
+            Inside patch_context, the change is only collected and sent together with others when the context exits."""
+        if self.local_data is not None:
+            common.merge_dicts(self.local_data, copy.deepcopy(data))
+
+        if self._pending_patch is not None:
+            common.merge_dicts(self._pending_patch, copy.deepcopy(data))
+            return
+
+        self._send_patch(data)
+
+    def _send_patch(self, data):
         json_patch = common.dict_to_json_patch(data)
-        result = self._http_session.patch(f"experiments/{self.exp_id}", json=json_patch, headers={"Content-Type": "application/json-patch+json"})
+        try:
+            result = self._http_session.patch(f"experiments/{self.exp_id}", json=json_patch, headers={"Content-Type": "application/json-patch+json"})
+            result.raise_for_status()
+        except Exception:
+            # Local data hold changes LIMS does not have, next reads must get the experiment from LIMS again
+            self._detail_validators = (None, None)
+            if self._on_patch_failed is not None:
+                self._on_patch_failed()
+            raise
+        finally:
+            self._query_cache.invalidate()
+
+    @contextlib.contextmanager
+    def patch_context(self):
+        """ Unit of work - all patch_experiment calls inside are merged into one minimal json patch (each property replaced once),
+            sent when the outermost context exits, also on exception, so no change is lost. """
+        if self._pending_patch is not None:
+            # Nested, outer context flushes
+            yield self
+            return
+
+        self._pending_patch = {}
+        try:
+            yield self
+        except BaseException:
+            # Failing flush must not replace the exception of the step
+            try:
+                self.flush_patch(close=True)
+            except Exception as e:
+                logging.error(f"Could not send changes of experiment {self.exp_id}: {e}")
+            raise
+        self.flush_patch(close=True)
+
+    def flush_patch(self, close=False):
+        """ Send changes collected so far, for places where the LIMS must see them before the step ends,
+            e.g. processing state and pid before hours of work """
+        pending = self._pending_patch
+        self._pending_patch = None if close or pending is None else {}
+        if pending:
+            self._send_patch(pending)
+
+    def invalidate_queries(self):
+        """ Experiment was changed by other means than patch, cached experiment queries are no longer valid """
+        self._query_cache.invalidate()
 
     def change_state(self, state):
         state_map = {
@@ -113,7 +372,9 @@ class ExperimentApi:
         self._http_session.post(f"documents/{document_id}/files", files=files_for_request, params={"append": append})
 
     def send_email(self, email):
-        result = self._http_session.post(f"experiments/{self.exp_id}/email", json=email, timeout=130)
+        # The email must not announce changes the LIMS does not have yet
+        self.flush_patch()
+        result = self._http_session.post(f"experiments/{self.exp_id}/email", json=email)
 
 
 
@@ -127,17 +388,19 @@ class OperationWrapper:
         return self.data["$type"] == state.value
 
     def run_operation(self, node_name: str):
-        result = self.api.session.post(f"{self.api.exp_url_base()}/operations/{self.name}/run", params={"node": node_name})
-        result.raise_for_status()
-        self.data = result.json()
+        self._post_operation("run", params={"node": node_name})
 
     def finish_operation(self, node_name: str, data=None):
-        result = self.api.session.post(f"{self.api.exp_url_base()}/operations/{self.name}/finish", params={"node": node_name}, json=data)
-        result.raise_for_status()
-        self.data = result.json()
+        self._post_operation("finish", params={"node": node_name}, json=data)
 
     def fail_operation(self, node_name: str, request_again: bool = True):
-        result = self.api.session.post(f"{self.api.exp_url_base()}/operations/{self.name}/fail", params={"node": node_name, "request_again": request_again})
+        self._post_operation("fail", params={"node": node_name, "request_again": request_again})
+
+    def _post_operation(self, action: str, **kwargs):
+        # The operation sees changes made so far in the step
+        self.api.flush_patch()
+        result = self.api.session.post(f"{self.api.exp_url_base()}/operations/{self.name}/{action}", **kwargs)
+        self.api.invalidate_queries()
         result.raise_for_status()
         self.data = result.json()
 
@@ -263,15 +526,20 @@ class ExperimentDataSourceWrapper:
         
         self._data["DtCleaned"] = now
     
-    def get_combined_raw_datarules(self, raw_rules, keep_source_files=False):
+    def get_combined_raw_datarules(self, raw_rules: DataRulesWrapper, keep_source_files=False):
+        key = ("combined_raw", tuple(self._data["SourcePatterns"]), bool(keep_source_files), bool(self.keep_source_files))
+        return raw_rules.derive(key, lambda: self._combine_raw_datarules(raw_rules, keep_source_files))
+
+    def _combine_raw_datarules(self, raw_rules: DataRulesWrapper, keep_source_files):
         trans_action = TransferAction.MOVE if not keep_source_files else TransferAction.COPY
-        raw_rules = DataRulesWrapper(raw_rules.data_rules + [DataRule(p, ["raw"], ".", True, subfiles=False, action=trans_action, condition=TransferCondition.IF_MISSING) for p in self.source_patterns])
+        rules = raw_rules.data_rules + [DataRule(p, ["raw"], ".", True, subfiles=False, action=trans_action, condition=TransferCondition.IF_MISSING) for p in self.source_patterns]
         # If keeping files on the instrument is requested, use copy action on all, otherwise leave default configured values
         if self.keep_source_files:
-            for r in raw_rules:
+            rules = [copy.copy(r) for r in rules]
+            for r in rules:
                 r.action = TransferAction.COPY
 
-        return raw_rules
+        return DataRulesWrapper(rules)
 
 class ExperimentStorageWrapper:
     def __init__(self, exp_data: dict, exp_api: ExperimentApi) -> None:
@@ -374,6 +642,7 @@ class ExperimentWrapper:
     def __init__(self, experiment_api: ExperimentApi, data=None):
         self._data = data
         self.exp_api = experiment_api
+        self.exp_api.local_data = data
 
         self._lastexpfetch = None
         self._laststatusfetch = None
@@ -382,8 +651,16 @@ class ExperimentWrapper:
             self._lastexpfetch = datetime.datetime.utcnow()
             self._laststatusfetch = datetime.datetime.utcnow()
 
+    def update_data(self, data):
+        """ Take newer data of the experiment in place, e.g. from a later query """
+        self._data = data
+        self.exp_api.local_data = data
+        self._lastexpfetch = datetime.datetime.utcnow()
+        self._laststatusfetch = datetime.datetime.utcnow()
+
     def reload(self):
         self._data = self.exp_api.get_experiment()
+        self.exp_api.local_data = self._data
         self._lastexpfetch = datetime.datetime.utcnow()
         self._laststatusfetch = datetime.datetime.utcnow()
 
@@ -468,29 +745,125 @@ class ExperimentWrapper:
                 return True
         return False
 
+# Experiments requested per page of list queries, None requests whole lists at once
+EXPERIMENTS_PAGE_SIZE = 200
+
 class ExperimentsApi:
-    def __init__(self, http_session: requests.Session) -> None:
+    def __init__(self, http_session: requests.Session, query_cache: ExperimentQueryCache = None, page_size=EXPERIMENTS_PAGE_SIZE) -> None:
         self._http_session = http_session
+        self._query_cache = query_cache or experiment_query_cache
+        self.page_size = page_size
+        self._wrapped = {} # query key => (data the wrappers were created from, wrappers)
+        self._paged = {} # query key => (data of the pages, joined data)
 
     def get_active_experiments(self):
         return self.get_experiments_by_states(exp_state=JobState.ACTIVE)
         
-    def get_experiments(self, queryData=None, subpath=None):
-        queryData = queryData or {}
+    @staticmethod
+    def _query_key(queryData, subpath):
         path = "experiments" if subpath is None else f"experiments/{subpath}"
-        result = self._http_session.get(path, params=queryData)
-        expData = result.json()
-        return [ExperimentWrapper(self.for_experiment(x["Id"]), x) for x in expData]
+        return path, (path, tuple(sorted(queryData.items())) if isinstance(queryData, dict) else tuple(queryData))
+
+    def get_experiments(self, queryData=None, subpath=None, stream=False):
+        """ List of experiments of the query, shared by modules of the node through the query cache.
+            stream=True returns iter_experiments instead. """
+        if stream:
+            return self.iter_experiments(queryData, subpath)
+        queryData = queryData or {}
+        path, query_key = self._query_key(queryData, subpath)
 
-    def get_experiments_by_operation_states(self, operations: List[Tuple[Operations, OperationState]]):
+        if subpath is None and experiment_mirror is not None and experiment_mirror.can_query(queryData):
+            expData = experiment_mirror.query(queryData)
+        else:
+            expData = self._query_cache.get(query_key, lambda: self._fetch_experiments(query_key, path, queryData))
+        return self._wrap_experiments(query_key, expData)
+
+    def iter_experiments(self, queryData=None, subpath=None):
+        """ Experiments of the query yielded page by page, a page is requested only when the previous one is consumed.
+            Not shared through the query cache (it keeps whole lists), pages are still conditionally requested.
+            Experiments changed while iterating may move between pages, they are seen by the next query then. """
+        queryData = queryData or {}
+        path, query_key = self._query_key(queryData, subpath)
+
+        if subpath is None and experiment_mirror is not None and experiment_mirror.can_query(queryData):
+            pages = [experiment_mirror.query(queryData)]
+        elif not self.page_size:
+            pages = [self._fetch_page(query_key, path, queryData)[0]]
+        else:
+            pages = self._iter_pages(query_key, path, queryData)
+        for page in pages:
+            # Page data are kept for conditional requests, wrappers get their own copy
+            for x in copy.deepcopy(page):
+                yield ExperimentWrapper(self.for_experiment(x["Id"]), x)
+
+    def _wrap_experiments(self, query_key, expData):
+        # Unchanged data (cached, mirrored or not modified on the server) - reuse wrappers created last time
+        wrapped_data, wrappers = self._wrapped.get(query_key, (None, None))
+        if wrapped_data is expData:
+            return list(wrappers)
+
+        # Cached data are shared, wrappers get their own copy as they modify it
+        wrappers = [ExperimentWrapper(self.for_experiment(x["Id"]), x) for x in copy.deepcopy(expData)]
+        self._wrapped[query_key] = (expData, wrappers)
+        return list(wrappers)
+
+    def _fetch_experiments(self, query_key, path, queryData):
+        """ Whole list of the query, as the query cache shares complete results only """
+        if not self.page_size:
+            return self._fetch_page(query_key, path, queryData)[0]
+
+        pages = list(self._iter_pages(query_key, path, queryData))
+        paged_data, data = self._paged.get(query_key, (None, None))
+        # Every page not modified - keep the joined data as well
+        if paged_data is None or len(paged_data) != len(pages) or any(a is not b for a, b in zip(paged_data, pages)):
+            data = [e for page in pages for e in page]
+            self._paged[query_key] = (pages, data)
+        return data
+
+    def _iter_pages(self, query_key, path, queryData):
+        """ Request pages of the query one after another, so that only one page is decoded at a time """
+        pairs = list(queryData.items()) if isinstance(queryData, dict) else list(queryData)
+        page = None
+        while True:
+            params = pairs + [("pageSize", self.page_size)] + ([("page", page)] if page is not None else [])
+            data, page = self._fetch_page((query_key, page), path, params)
+            yield data
+            if page is None:
+                return
+
+    def _fetch_page(self, page_key, path, params):
+        """ Returns (experiment data, next page), LIMS not paging the query responds with the list itself """
+        validated = self._query_cache.get_validated(page_key)
+        response, etag, last_modified = conditional_get(self._http_session, path, validated, params=params)
+        if validated is not None and response is validated[2]:
+            return response
+
+        if isinstance(response, dict):
+            result = (filter_experiments(params, response.get("Items", [])), response.get("NextPage", None))
+        else:
+            result = (filter_experiments(params, response), None)
+        self._query_cache.set_validated(page_key, etag, last_modified, result)
+        return result
+
+    def get_experiments_by_operation_states(self, operations: List[Tuple[Operations, OperationState]], publication_engine: Union[str, List[str], None]=None,
+                                            stream=False):
         qrData = [(x.value, y.value) for x, y in operations]
-        exps = self.get_experiments(queryData=qrData, subpath="by_operation")
+        if publication_engine:
+            qrData.append(("publicationEngine", _join_values(publication_engine)))
+        exps = self.get_experiments(queryData=qrData, subpath="by_operation", stream=stream)
         return exps
 
     def get_experiments_by_states(self, exp_state: Union[JobState, List[JobState], None]=None,
                                         storage_state: Union[StorageState, List[StorageState], None]=None,
                                         processing_state: Union[ProcessingState, List[ProcessingState], None]=None,
-                                        publication_state: Union[PublicationState, List[PublicationState], None]=None):
+                                        publication_state: Union[PublicationState, List[PublicationState], None]=None,
+                                        processing_engine: Union[str, List[str], None]=None,
+                                        processing_node: Union[str, None]=None,
+                                        publication_engine: Union[str, List[str], None]=None,
+                                        exp_type: Union[str, List[str], None]=None,
+                                        stream=False):
+        """ Filters are evaluated by the LIMS; processing_node selects experiments assigned to the node or to no node,
+            exp_type is "<instrument>/<technique>", stream=True yields experiments page by page (iter_experiments) """
         queryData = {}
         if exp_state:
             queryData["expState"] = exp_state.value if isinstance(exp_state, JobState) else ",".join([s.value for s in exp_state])
@@ -500,11 +873,23 @@ class ExperimentsApi:
             queryData["processingState"] = processing_state.value if isinstance(processing_state, ProcessingState) else ",".join([s.value for s in processing_state])
         if publication_state:
             queryData["publicationState"] = publication_state.value if isinstance(publication_state, PublicationState) else ",".join([s.value for s in publication_state])
+        if processing_engine:
+            queryData["processingEngine"] = _join_values(processing_engine)
+        if processing_node:
+            queryData["processingNode"] = processing_node
+        if publication_engine:
+            queryData["publicationEngine"] = _join_values(publication_engine)
+        if exp_type:
+            queryData["expType"] = _join_values(exp_type)
         
-        return self.get_experiments(queryData)
+        return self.get_experiments(queryData, stream=stream)
 
     def for_experiment(self, id):
-        return ExperimentApi(id, self._http_session)
+        return ExperimentApi(id, self._http_session, self._query_cache, self._forget_wrapped)
+
+    def _forget_wrapped(self):
+        """ Experiment patch failed - wrappers are rebuilt from LIMS data, not reused with the rejected changes """
+        self._wrapped = {}
 
 class ExperimentDocumentWrapper:
     def __init__(self, doc_data, exp_api: ExperimentApi):
@@ -558,6 +943,10 @@ class ExperimentStorageEngine(data_tools.DataTransferSource):
     def is_accessible(self):
         """ Check if the storage is accessible from current node with current configuration """
         raise NotImplementedError()
+
+    def close(self):
+        """ Release connections of the engine, called when it is evicted from StorageEngineCache """
+        pass
     
     def prepare(self):
         """ Prepare the storage for the experiment """
@@ -727,13 +1116,107 @@ class ExperimentStorageEngine(data_tools.DataTransferSource):
         return metad
 
     
+class StorageEngineCache:
+    """ Storage engines of a module kept between steps, by (experiment id, engine name, hashes of the settings they were created with).
+        Least recently used engines beyond max_size and engines unused for ttl seconds are evicted and closed,
+        engines in use are never evicted. """
+    def __init__(self, max_size=256, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key => [engine, monotonic time of last use, number of users]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @contextlib.contextmanager
+    def use(self, key, create):
+        """ Cached engine of key, or a new one from create() (None is not cached), kept from eviction within the block """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                entry[2] += 1
+                self._entries.move_to_end(key)
+
+        if entry is None:
+            engine = create()
+            if engine is None:
+                yield None
+                return
+            with self._lock:
+                # Engines of other settings or engine names of the experiment are replaced
+                stale = [k for k, e in self._entries.items() if k[0] == key[0] and k != key and not e[2]]
+                evicted = [self._entries.pop(k)[0] for k in stale]
+                entry = self._entries.setdefault(key, [engine, time.monotonic(), 0])
+                entry[2] += 1
+            if entry[0] is not engine:
+                evicted.append(engine)
+            self._close(evicted)
+
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] = time.monotonic()
+                entry[2] -= 1
+                evicted = self._evict()
+                # Cleared while in use
+                if not entry[2] and self._entries.get(key, None) is not entry:
+                    evicted.append(entry[0])
+            self._close(evicted)
+
+    def _evict(self):
+        evicted = []
+        now = time.monotonic()
+        excess = len(self._entries) - self.max_size
+        for key, entry in list(self._entries.items()):
+            if entry[2]:
+                continue
+            if excess > 0 or now - entry[1] > self.ttl:
+                evicted.append(self._entries.pop(key)[0])
+                excess -= 1
+        return evicted
+
+    def clear(self):
+        """ Evict and close all engines, those in use are closed when released """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        self._close([e[0] for e in entries if not e[2]])
+
+    @staticmethod
+    def _close(engines):
+        for engine in engines:
+            try:
+                engine.close()
+            except Exception as exc:
+                logging.warning(f"Could not close storage engine of experiment {engine.exp.id}: {exc}")
+
 
 class ExperimentModuleBase(configuration.LimsNodeModule):
     def __init__(self, name, logger, lims_logger, config: configuration.LimsModuleConfigWrapper, api_session, exp_storage_engine_factory):
         super().__init__(name, logger, lims_logger, config, api_session)
         self.exp_storage_engine_factory = exp_storage_engine_factory
-        # create runner according to parallel configuration
-        self.runner = ParallelRunner(self.parallel, name, self.logger) if self.is_parallel else SequentialRunner(self.logger)
+        self.experiments_api = ExperimentsApi(api_session)
+        self.leases = leases.ModuleLeases(name, config, api_session, self.logger)
+        self.engine_cache = StorageEngineCache(self.engine_cache_size, self.engine_cache_ttl)
+        # create runner according to runner and parallel configuration
+        if self.runner_kind == "process":
+            self.runner = ProcessRunner(max(self.parallel, 1), name, self.logger, ProcessWorkerSetup(self), config,
+                                        self.cancel_event, self.experiment_weight, self.experiment_deadline)
+        elif self.is_parallel:
+            self.runner = ParallelRunner(self.parallel, name, self.logger, self.experiment_weight, self.experiment_deadline)
+        else:
+            self.runner = SequentialRunner(self.logger)
+        config.lims_config.on_change(self._config_changed)
+
+    def _config_changed(self, changed_sections):
+        """ Engines and process workers built from previous settings are released right away, not once they expire """
+        if not self.module_config.affected_by(changed_sections):
+            return
+        self.engine_cache.clear()
+        if isinstance(self.runner, ProcessRunner):
+            self.runner.release_stale_pool()
 
     def _safe_get_experiment_storage_engine(self, e: ExperimentWrapper):
         exp_logger = logger_db_api.experiment_logger_adapter(self._lims_logger, e.id)
@@ -745,9 +1228,17 @@ class ExperimentModuleBase(configuration.LimsNodeModule):
             self.logger.error("Could not create storage engine for experiment, skipping")
             self.logger.exception(exc)
 
-    def _experiments_to_their_engines(self, experiments: List[ExperimentWrapper]):
-        return filter(None, [self._safe_get_experiment_storage_engine(e) for e in experiments])
-        
+    @contextlib.contextmanager
+    def _cached_experiment_storage_engine(self, e: ExperimentWrapper):
+        """ Storage engine of the experiment kept from previous steps, created if not cached, with data of e swapped in.
+            Engines are replaced once settings of the module or of the experiment type change. """
+        exp_config = self.module_config.lims_config.get_experiment_config(e.instrument, e.technique)
+        key = (e.id, e.storage.engine, self.module_config.fingerprint, exp_config.fingerprint)
+        with self.engine_cache.use(key, lambda: self._safe_get_experiment_storage_engine(e)) as exp_engine:
+            if exp_engine is not None and exp_engine.exp is not e:
+                exp_engine.exp.update_data(e._data)
+            yield exp_engine
+
     @property
     def parallel(self):
         str_val = self.module_config.get("parallel", 0)
@@ -756,17 +1247,88 @@ class ExperimentModuleBase(configuration.LimsNodeModule):
     @property
     def is_parallel(self):
         return self.parallel > 0
+
+    @property
+    def runner_kind(self):
+        """ "thread" (default) runs experiment steps in this process, "process" in worker processes (CPU heavy modules) """
+        return self.module_config.get("runner", "thread")
     
+    @property
+    def experiment_deadline(self):
+        """ Soft deadline of one experiment step in seconds, runs past it are logged """
+        deadline = self.module_config.get("experiment_deadline", None)
+        return common.parse_timedelta(deadline).total_seconds() if deadline else None
+
+    def experiment_weight(self, exp: 'ExperimentWrapper'):
+        """ Share of free workers the experiment gets, by experiment state, e.g. {"Active": 4, "Finished": 1} """
+        weights = self.module_config.get("experiment_weights", None)
+        if not weights:
+            return 1
+        return weights.get(exp.state.value, 1)
+
+    @property
+    def engine_cache_size(self):
+        """ How many storage engines of experiments are kept between steps """
+        return int(self.module_config.get("engine_cache_size", 256))
+
+    @property
+    def engine_cache_ttl(self):
+        """ Seconds after which unused storage engines are dropped """
+        return common.parse_timedelta(self.module_config.get("engine_cache_ttl", "00:10:00")).total_seconds()
+
+    @property
+    def coalesce_patches(self):
+        return bool(self.module_config.get("coalesce_patches", True))
+
+    def close(self):
+        """ Close cached storage engines and stop the runner workers """
+        self.module_config.lims_config.remove_change_listener(self._config_changed)
+        self.runner.shutdown()
+        self.engine_cache.clear()
+
+    def drain(self, timeout):
+        return self.runner.drain(timeout)
+
     def step(self):
         experiments = self.provide_experiments()
+        self.engine_cache.max_size, self.engine_cache.ttl = self.engine_cache_size, self.engine_cache_ttl
+        # Runners get experiments only, engines are created once a worker is free (by worker processes for ProcessRunner)
+        # Leases of experiments no longer provided are released once the runner went through all of them
+        exp_refs = (ExperimentRef(e) for e in self.leases.track(experiments))
+        if isinstance(self.runner, ProcessRunner):
+            return self.runner.step(exp_refs, name=self.name)
         # delegate execution to selected runner
-        self.runner.step(self._experiments_to_their_engines(experiments), self.step_experiment, self.name)
-                
+        self.runner.step(exp_refs, self._step_experiment_ref, self.name)
+
+    def _step_experiment_ref(self, exp_ref: 'ExperimentRef'):
+        # Cancelled module does not start on further experiments
+        if self.cancel_event.is_set():
+            return
+        # The experiment is claimed before its engine gets created
+        with self.leases.hold(exp_ref.exp.id) as claimed:
+            if not claimed:
+                self.logger.debug(f"Experiment {exp_ref.exp.id} is leased by another node, skipping")
+                return
+            with self._cached_experiment_storage_engine(exp_ref.exp) as exp_engine:
+                if exp_engine is not None:
+                    self._step_experiment_scoped(exp_engine)
+
+    def _step_experiment_scoped(self, exp_engine: 'ExperimentStorageEngine'):
+        # Transfers and external tools of the step stop when the module gets cancelled, also on runner threads
+        metrics.EXPERIMENT_STEPS.inc(1, self.name)
+        with common.cancellation_scope(self.cancel_event), metrics.module_scope(self.name), \
+                metrics.EXPERIMENT_STEP_SECONDS.time(self.name):
+            if not self.coalesce_patches:
+                return self.step_experiment(exp_engine)
+            # All experiment changes done during the step are sent to LIMS as one patch
+            with exp_engine.exp.exp_api.patch_context():
+                self.step_experiment(exp_engine)
+
     def step_experiment(self, exp_engine: ExperimentStorageEngine):
         pass
 
     def provide_experiments(self):
-        return ExperimentsApi(self._api_session).get_active_experiments()
+        return self.experiments_api.get_active_experiments()
     
     def get_experiment_config(self, exp: ExperimentWrapper):
         return self.module_config.lims_config.get_experiment_config(exp.instrument, exp.technique)
@@ -811,8 +1373,15 @@ class ExpFileBrowser(configuration.LimsNodeModule):
         return drives
 
 class ExperimentRunnerBase:
-    def step(self, experiments, step_experiment, name):
+    def step(self, experiments, step_experiment, name=None):
         raise NotImplementedError()
+
+    def shutdown(self):
+        pass
+
+    def drain(self, timeout):
+        """ Wait up to timeout seconds for steps running on runner workers, True when none is left """
+        return True
     
     def _experiment_engine_iterator(self, experiments, create_engine):
         for e in experiments:
@@ -828,45 +1397,308 @@ class SequentialRunner(ExperimentRunnerBase):
     def __init__(self, logger):
         self.logger = logger
 
-    def step(self, experiments, step_experiment, name):
+    def step(self, experiments, step_experiment, name=None):
         for exp_engine in experiments:
             try:
                 step_experiment(exp_engine)
             except Exception as exc:
                 self.logger.exception(exc)
 
+_parallel_runners = weakref.WeakSet()
+
+def _runner_saturation():
+    busy = {}
+    for runner in list(_parallel_runners):
+        busy[(runner.name, "busy")] = len(runner.exec_state)
+        busy[(runner.name, "max")] = runner.max_workers
+    return busy
+
+metrics.registry.gauge("lims_node_runner_workers", "Busy and maximum experiment workers of parallel module runners",
+                       ("module", "kind"), function=_runner_saturation)
+
 class ParallelRunner(ExperimentRunnerBase):
     """ Runs experiments up to given max amount of experiments in parallel
-        In one step call, all experiments not having free worker are skipped and waiting for next step call
-
-        Possible fix: Execution is not distributed evenly to experiments, so inappropriate usage may lead to starvation of some experiments
+        In one step call, free workers are given to experiments that waited longest since they were last served,
+        waiting time is multiplied by weight(exp) (1 by default), never served experiments go first.
+        Experiments not getting a free worker wait for next step call.
+        Runs taking longer than deadline seconds are logged, once while running and once when they finish.
     """
-    def __init__(self, max_workers, name, logger):
+    def __init__(self, max_workers, name, logger, weight=None, deadline=None):
         self.logger = logger
+        self.name = name
         self.exec_state = {}
         self.state_lock = threading.Lock()
         self.max_workers = max_workers
+        self.weight = weight
+        self.deadline = deadline
+        self.last_served = {} # exp id => monotonic time of last submission
+        self._started = {} # exp id => monotonic start time of running step
+        self._overrun = set() # exp ids of running steps already logged as overrun
         self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
         self._finalizer = weakref.finalize(self, self.executor.shutdown, wait=False)
+        _parallel_runners.add(self)
+
+    def shutdown(self):
+        """ No new steps, running ones finish in the background """
+        self.executor.shutdown(wait=False)
+
+    def drain(self, timeout):
+        with self.state_lock:
+            running = list(self.exec_state.values())
+        _, not_done = wait_futures(running, timeout)
+        return not not_done
+
+    def _weight(self, exp):
+        if self.weight is None:
+            return 1.0
+        try:
+            return max(float(self.weight(exp)), 0.0)
+        except Exception as exc:
+            self.logger.warning(f"Could not weight experiment {exp.id}: {exc}")
+            return 1.0
+
+    def _order(self, exp_engines, now):
+        """ Never served first (heavier first), then by weighted time since last served """
+        def priority(item):
+            idx, exp_engine = item
+            weight = self._weight(exp_engine.exp)
+            last = self.last_served.get(exp_engine.exp.id)
+            if last is None:
+                return (0, -weight, idx)
+            return (1, -(now - last) * weight, idx)
+        return [e for _, e in sorted(enumerate(exp_engines), key=priority)]
+
+    def _check_deadlines(self, now):
+        with self.state_lock:
+            overdue = [(exp_id, now - start) for exp_id, start in self._started.items()
+                       if now - start > self.deadline and exp_id not in self._overrun]
+            self._overrun.update(exp_id for exp_id, _ in overdue)
+        for exp_id, running in overdue:
+            metrics.EXPERIMENT_DEADLINE_OVERRUNS.inc(1, self.name)
+            self.logger.warning(f"Experiment {exp_id} step still running after {running:.0f} s, deadline is {self.deadline:.0f} s")
+
+    def step(self, experiments, step_experiment, name=None):
+        name = name or self.name
 
-    def step(self, experiments, step_experiment, name):
         def step_exp_helper(e_engine):
-            self.logger.info(f"{e_engine.exp.secondary_id} / {name} parallel exp step")
+            exp_id = e_engine.exp.id
+            start = time.monotonic()
             try:
                 step_experiment(e_engine)
             except Exception as exc:
                 self.logger.exception(exc)
             finally:
+                duration = time.monotonic() - start
                 with self.state_lock:
-                    self.exec_state.pop(e_engine.exp.id, None)
-
-        for exp_engine in experiments:
-            if len(self.exec_state) >= self.max_workers:
-                # No free workers, skip
-                continue
-
-            with self.state_lock:
+                    self.exec_state.pop(exp_id, None)
+                    self._started.pop(exp_id, None)
+                    self._overrun.discard(exp_id)
+                if self.deadline and duration > self.deadline:
+                    self.logger.warning(f"Experiment {exp_id} step took {duration:.0f} s, deadline is {self.deadline:.0f} s")
+
+        now = time.monotonic()
+        if self.deadline:
+            self._check_deadlines(now)
+        if len(self.exec_state) >= self.max_workers:
+            # No free workers, skip
+            return
+
+        exp_engines = list(experiments)
+        submitted = []
+        with self.state_lock:
+            # Forget experiments no longer provided to the runner
+            present = {e.exp.id for e in exp_engines}
+            for exp_id in [i for i in self.last_served if i not in present and i not in self.exec_state]:
+                del self.last_served[exp_id]
+
+            for exp_engine in self._order(exp_engines, now):
+                if len(self.exec_state) >= self.max_workers:
+                    break
                 if exp_engine.exp.id not in self.exec_state:
-                    # submit and track
+                    # submit and track, serving order and deadlines count from submission, as free workers start right away
+                    self.last_served[exp_engine.exp.id] = self._started[exp_engine.exp.id] = now
                     self.exec_state[exp_engine.exp.id] = self.executor.submit(step_exp_helper, exp_engine)
-
+                    submitted.append(exp_engine)
+
+        for exp_engine in submitted:
+            self.logger.info(f"{exp_engine.exp.secondary_id} / {name} parallel exp step")
+
+
+
+class ExperimentRef:
+    """ Experiment given to a runner without its storage engine, the engine is created once the experiment gets a worker """
+    def __init__(self, exp: ExperimentWrapper):
+        self.exp = exp
+
+
+class ProcessWorkerSetup:
+    """ Picklable description of an experiment module, from which worker processes rebuild it.
+        Live sessions and engines are not sent, only what is needed to create new ones. """
+    def __init__(self, module: 'ExperimentModuleBase'):
+        session = module._api_session
+        self.module_name = module.name
+        self.module_class = (type(module).__module__, type(module).__qualname__)
+        self.node_name = module.module_config.node_name
+        self.engine_factory = module.exp_storage_engine_factory
+        self.base_url = session.base_url
+        self.headers = dict(session.headers)
+        self.proxies = dict(session.proxies)
+        self.verify = session.verify
+        self.timeout = getattr(session, "timeout", 5)
+        self.endpoint_timeouts = dict(getattr(session, "endpoint_timeouts", {}))
+        self.log_level = logging.getLogger().level
+
+    def create_session(self):
+        session = common.BaseUrlSession(self.base_url, self.timeout, self.verify, pool_maxsize=2, endpoint_timeouts=self.endpoint_timeouts)
+        session.headers.update(self.headers)
+        session.proxies = self.proxies
+        return session
+
+
+class _ProcessWorker:
+    """ Module rebuilt in a worker process with the configuration the pool was created with,
+        the runner creates a new pool for a newer configuration """
+    current: '_ProcessWorker' = None
+
+    def __init__(self, setup: ProcessWorkerSetup, settings_hash, config):
+        logging.basicConfig(level=setup.log_level)
+        self.session = setup.create_session()
+        self.log_handler = logger_db_api.LimsApiLoggerHandler(setup.create_session(), logging.INFO)
+        self.config = configuration.LimsConfigWrapper(None, setup.node_name)
+        self.config.from_obj(config, datetime.datetime.utcnow())
+        self.settings_hash = settings_hash
+
+        module_path, class_name = setup.module_class
+        cls = getattr(importlib.import_module(module_path), class_name)
+        lims_logger = logger_db_api.prepare_lims_api_logger("lims/" + setup.module_name, setup.node_name, self.log_handler)
+        module_config = configuration.LimsModuleConfigWrapper(setup.module_name, setup.node_name, self.config)
+        self.module: ExperimentModuleBase = cls(setup.module_name, logging.getLogger(setup.module_name), lims_logger,
+                                                module_config, self.session, setup.engine_factory)
+        if sys.platform != "win32":
+            # Runner drain terminates workers, the running step is cancelled as it would be in the node
+            signal.signal(signal.SIGTERM, lambda sig, frame: self.module.cancel_event.set())
+
+    def step(self, settings_hash, exp_data):
+        if settings_hash != self.settings_hash:
+            self.module.logger.warning(f"Experiment {exp_data['Id']} stepped with settings {self.settings_hash[:8]} instead of {settings_hash[:8]}")
+        try:
+            exp = ExperimentWrapper(self.module.experiments_api.for_experiment(exp_data["Id"]), exp_data)
+            self.module._step_experiment_ref(ExperimentRef(exp))
+        finally:
+            self.log_handler.flush()
+
+
+def _process_worker_init(setup: ProcessWorkerSetup, settings_hash, config):
+    _ProcessWorker.current = _ProcessWorker(setup, settings_hash, config)
+
+def _process_worker_step(settings_hash, exp_data):
+    _ProcessWorker.current.step(settings_hash, exp_data)
+
+
+class ProcessRunner(ParallelRunner):
+    """ ParallelRunner running experiment steps in up to max_workers worker processes, for CPU heavy modules
+        whose work would otherwise hold the GIL and stall I/O threads of the node.
+        Runner threads only wait for the workers. Workers are spawned fresh (no fork of the threaded node),
+        rebuild the module from ProcessWorkerSetup and create engines from experiment data themselves.
+        Configuration is sent to the workers once, when the pool is created, steps send only experiment data.
+        Changed settings of the module or of experiment types get a new pool, steps already running finish in the old one.
+        A crashed worker fails only the experiment steps it was running, the pool is recreated for the next ones.
+        Draining asks workers to cancel their steps by SIGTERM and kills those not finished in time. """
+    def __init__(self, max_workers, name, logger, setup: ProcessWorkerSetup, module_config: configuration.LimsModuleConfigWrapper,
+                 cancel_event: threading.Event = None, weight=None, deadline=None):
+        super().__init__(max_workers, name, logger, weight, deadline)
+        self.setup = setup
+        self.module_config = module_config
+        self.cancel_event = cancel_event or threading.Event()
+        self._pool = None
+        self._pool_settings = None
+        self._pool_finalizer = None
+        self._pool_workers = [] # pid => process of every pool whose workers may still run, including replaced pools
+        self._pool_lock = threading.Lock()
+
+    def _worker_settings(self):
+        """ (hash of what the workers use - settings of the module and configurations of experiment types, configuration) """
+        index = self.module_config.lims_config.index
+        return configuration.config_hash([self.module_config.fingerprint] + [e.fingerprint for e in index.experiments.values()]), index.config
+
+    def _take_pool(self):
+        """ Current pool, the runner no longer uses it, called with _pool_lock held """
+        pool, self._pool = self._pool, None
+        if self._pool_finalizer is not None:
+            self._pool_finalizer.detach()
+            self._pool_finalizer = None
+        return pool
+
+    def _process_pool(self):
+        """ (pool, settings hash of its workers) """
+        with self._pool_lock:
+            settings, config = self._worker_settings()
+            if self._pool is not None and self._pool_settings != settings:
+                self._take_pool().shutdown(wait=False)
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_process_worker_init, initargs=(self.setup, settings, config))
+                self._pool_settings = settings
+                # Kept apart, the pool drops its process dict on shutdown, workers keep running until their steps finish
+                self._pool_workers = [self._pool._processes] + [workers for workers in self._pool_workers
+                                                                if any(w.is_alive() for w in dict(workers).values())]
+                self._pool_finalizer = weakref.finalize(self, self._pool.shutdown, wait=False, cancel_futures=True)
+            return self._pool, self._pool_settings
+
+    def release_stale_pool(self):
+        """ Shut the pool down if its workers were created with other settings, the next step creates a new one """
+        with self._pool_lock:
+            if self._pool is None or self._pool_settings == self._worker_settings()[0]:
+                return
+            pool = self._take_pool()
+        pool.shutdown(wait=False)
+
+    def _discard_pool(self, pool):
+        with self._pool_lock:
+            if self._pool is pool:
+                self._take_pool()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def step(self, experiments, step_experiment=None, name=None):
+        """ experiments are ExperimentRefs (or engines), step_experiment is run by the workers, not here """
+        super().step(experiments, self._step_in_process, name)
+
+    def _step_in_process(self, exp_ref: ExperimentRef):
+        pool, settings = self._process_pool()
+        future = pool.submit(_process_worker_step, settings, exp_ref.exp._data)
+        try:
+            while not future.done():
+                if self.cancel_event.wait(0.5) and not future.done():
+                    if not future.cancel():
+                        self.logger.info(f"Experiment {exp_ref.exp.id} step left to finish in worker process")
+                    return
+            future.result()
+        except BrokenProcessPool:
+            self.logger.error(f"Worker process crashed while stepping experiment {exp_ref.exp.id}, restarting workers")
+            self._discard_pool(pool)
+        finally:
+            # The worker changed the experiment through its own session
+            experiment_query_cache.invalidate()
+
+    def shutdown(self):
+        super().shutdown()
+        with self._pool_lock:
+            pool = self._take_pool()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        # Runner threads return once the module is cancelled, leaving steps to the workers
+        self.shutdown()
+        threads_done = super().drain(timeout)
+        with self._pool_lock:
+            workers = [w for pool_workers in self._pool_workers for w in dict(pool_workers).values() if w.is_alive()]
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        stuck = [w for w in workers if w.is_alive()]
+        for worker in stuck:
+            worker.kill()
+        return threads_done and not stuck
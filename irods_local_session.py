@@ -0,0 +1,355 @@
+""" Local, in-process stand-in for the part of iRODSSession used by irods_storage_engine.
+    Logical iRODS paths are mapped onto a local directory, AVUs and tickets are kept in sidecar files.
+    Every catalog call can be slowed down by configurable latency, so engine code paths (glob, put, checksum, metadata)
+    can be measured and tuned locally without a live zone. """
+import base64
+import datetime
+import hashlib
+import json
+import pathlib
+import shutil
+import threading
+import time
+
+from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.meta import iRODSMeta, AVUOperation
+
+_AVU_DIR = ".irods_avu"
+_TICKETS_FILE = ".irods_tickets.json"
+
+
+class LocalIrodsSession:
+    def __init__(self, root, latency=0.0, bandwidth=None, host="localhost", zone="tempZone", user="rods", **connection):
+        """ root - local directory backing the zone
+            latency - seconds added to each catalog round trip
+            bandwidth - bytes per second for data transfers (put/get/open), None for unlimited """
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.host = host
+        self.zone = zone
+        self.username = user
+        self.pam_pw_negotiated = ["local"]
+
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+        self.collections = LocalCollectionManager(self)
+        self.data_objects = LocalDataObjectManager(self)
+        self.pool = LocalConnectionPool(self)
+
+    # Session API parity - the stand-in keeps no connections
+    def cleanup(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def round_trip(self):
+        """ Simulate one request to the catalog """
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer_delay(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def local_path(self, logical_path) -> pathlib.Path:
+        return self.root / str(logical_path).lstrip("/")
+
+    def logical_path(self, local_path: pathlib.Path) -> str:
+        return "/" + local_path.relative_to(self.root).as_posix()
+
+    def _avu_file(self, logical_path) -> pathlib.Path:
+        key = hashlib.sha1(str(logical_path).encode()).hexdigest()
+        return self.root / _AVU_DIR / f"{key}.json"
+
+    def load_avus(self, logical_path):
+        avu_file = self._avu_file(logical_path)
+        if not avu_file.exists():
+            return []
+        return [iRODSMeta(*avu) for avu in json.loads(avu_file.read_text())]
+
+    def save_avus(self, logical_path, avus):
+        avu_file = self._avu_file(logical_path)
+        avu_file.parent.mkdir(parents=True, exist_ok=True)
+        avu_file.write_text(json.dumps([(m.name, m.value, m.units) for m in avus]))
+
+    def store_ticket(self, ticket_string, permission, target):
+        tickets_file = self.root / _TICKETS_FILE
+        with self._lock:
+            tickets = json.loads(tickets_file.read_text()) if tickets_file.exists() else {}
+            tickets[ticket_string] = {"permission": permission, "target": str(target)}
+            tickets_file.write_text(json.dumps(tickets))
+
+    def tickets(self):
+        tickets_file = self.root / _TICKETS_FILE
+        return json.loads(tickets_file.read_text()) if tickets_file.exists() else {}
+
+
+class LocalConnectionPool:
+    """ Just enough of the connection pool so irods.ticket.Ticket can issue tickets against the stand-in """
+    def __init__(self, session: LocalIrodsSession):
+        self.session = session
+
+    def get_connection(self):
+        return LocalConnection(self.session)
+
+
+class LocalConnection:
+    def __init__(self, session: LocalIrodsSession):
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, message):
+        self.session.round_trip()
+        request = message.msg
+        if request.arg1 == "create":
+            self.session.store_ticket(request.arg2, request.arg3, request.arg4)
+
+    def recv(self):
+        return None
+
+
+class LocalMetadata:
+    def __init__(self, session: LocalIrodsSession, path: str):
+        self._session = session
+        self._path = path
+
+    def items(self):
+        self._session.round_trip()
+        return self._session.load_avus(self._path)
+
+    def keys(self):
+        return [m.name for m in self.items()]
+
+    def get_all(self, key):
+        return [m for m in self.items() if m.name == key]
+
+    def __getitem__(self, key):
+        values = self.get_all(key)
+        if not values:
+            raise KeyError(key)
+        return values[0]
+
+    def __contains__(self, key):
+        return bool(self.get_all(key))
+
+    def __len__(self):
+        return len(self.items())
+
+    def add(self, meta: iRODSMeta):
+        self.apply_atomic_operations(AVUOperation(operation="add", avu=meta))
+
+    def remove(self, meta: iRODSMeta):
+        self.apply_atomic_operations(AVUOperation(operation="remove", avu=meta))
+
+    def __setitem__(self, key, meta: iRODSMeta):
+        # Same as the real client: one request per removed value, then one for the add
+        for m in self.get_all(key):
+            self.remove(m)
+        self.add(meta)
+
+    def __delitem__(self, key):
+        for m in self.get_all(key):
+            self.remove(m)
+
+    def apply_atomic_operations(self, *avu_ops):
+        self._session.round_trip()
+        avus = self._session.load_avus(self._path)
+        for op in avu_ops:
+            triple = (op.avu.name, op.avu.value, op.avu.units or "")
+            if op.operation == "add":
+                if triple not in [(m.name, m.value, m.units or "") for m in avus]:
+                    avus.append(iRODSMeta(*triple))
+            elif op.operation == "remove":
+                avus = [m for m in avus if (m.name, m.value, m.units or "") != triple]
+            else:
+                raise ValueError(f"Unsupported AVU operation: {op.operation}")
+        self._session.save_avus(self._path, avus)
+
+
+class LocalCollection:
+    def __init__(self, session: LocalIrodsSession, path: str):
+        self._session = session
+        self.path = str(path)
+        self.name = pathlib.PurePosixPath(self.path).name
+        self.metadata = LocalMetadata(session, self.path)
+
+    @property
+    def _local(self):
+        return self._session.local_path(self.path)
+
+    @property
+    def subcollections(self):
+        self._session.round_trip()
+        return [LocalCollection(self._session, self._session.logical_path(p))
+                for p in sorted(self._local.iterdir()) if p.is_dir() and not p.name.startswith(".irods")]
+
+    @property
+    def data_objects(self):
+        self._session.round_trip()
+        return [LocalDataObject(self._session, self._session.logical_path(p))
+                for p in sorted(self._local.iterdir()) if p.is_file() and not p.name.startswith(".irods")]
+
+    def remove(self, recurse=True, force=False, **options):
+        self._session.collections.remove(self.path, recurse=recurse, force=force, **options)
+
+
+class LocalCollectionManager:
+    def __init__(self, session: LocalIrodsSession):
+        self.sess = session
+
+    def get(self, path):
+        self.sess.round_trip()
+        if not self.sess.local_path(path).is_dir():
+            raise CollectionDoesNotExist(path)
+        return LocalCollection(self.sess, path)
+
+    def exists(self, path):
+        self.sess.round_trip()
+        return self.sess.local_path(path).is_dir()
+
+    def create(self, path, recurse=True, **options):
+        self.sess.round_trip()
+        self.sess.local_path(path).mkdir(parents=recurse, exist_ok=True)
+        return LocalCollection(self.sess, path)
+
+    def remove(self, path, recurse=True, force=False, **options):
+        self.sess.round_trip()
+        local = self.sess.local_path(path)
+        if not local.is_dir():
+            raise CollectionDoesNotExist(path)
+        shutil.rmtree(local) if recurse else local.rmdir()
+
+
+class LocalDataObject:
+    def __init__(self, session: LocalIrodsSession, path: str):
+        self._session = session
+        self.path = str(path)
+        self.name = pathlib.PurePosixPath(self.path).name
+        self.metadata = LocalMetadata(session, self.path)
+        stat = self._local.stat()
+        self.size = stat.st_size
+        self.modify_time = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)
+
+    @property
+    def _local(self):
+        return self._session.local_path(self.path)
+
+    def open(self, mode="r", **options):
+        self._session.round_trip()
+        # iRODS data objects are always binary
+        mode = {"r": "rb", "w": "wb", "a": "ab", "r+": "r+b"}.get(mode, mode)
+        self._session.transfer_delay(self.size)
+        return self._local.open(mode)
+
+    def chksum(self, **options):
+        """ Same format as iRODS sha256 checksum: 'sha2:' + base64 digest """
+        self._session.round_trip()
+        hash_func = hashlib.sha256()
+        with self._local.open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hash_func.update(chunk)
+        return "sha2:" + base64.b64encode(hash_func.digest()).decode()
+
+    def unlink(self, force=False, **options):
+        self._session.data_objects.unlink(self.path, force=force, **options)
+
+
+class LocalDataObjectManager:
+    def __init__(self, session: LocalIrodsSession):
+        self.sess = session
+
+    def exists(self, path):
+        self.sess.round_trip()
+        return self.sess.local_path(path).is_file()
+
+    def get(self, path, local_path=None, **options):
+        self.sess.round_trip()
+        local = self.sess.local_path(path)
+        if not local.is_file():
+            raise DataObjectDoesNotExist(path)
+        if local_path is not None:
+            self.sess.transfer_delay(local.stat().st_size)
+            shutil.copyfile(local, local_path)
+        return LocalDataObject(self.sess, path)
+
+    def put(self, local_path, irods_path, **options):
+        self.sess.round_trip()
+        target = self.sess.local_path(irods_path)
+        if not target.parent.is_dir():
+            raise CollectionDoesNotExist(str(pathlib.PurePosixPath(irods_path).parent))
+        self.sess.transfer_delay(pathlib.Path(local_path).stat().st_size)
+        shutil.copyfile(local_path, target)
+
+    def create(self, path, **options):
+        self.sess.round_trip()
+        target = self.sess.local_path(path)
+        if not target.parent.is_dir():
+            raise CollectionDoesNotExist(str(pathlib.PurePosixPath(path).parent))
+        target.touch()
+        return LocalDataObject(self.sess, path)
+
+    def unlink(self, path, force=False, **options):
+        self.sess.round_trip()
+        local = self.sess.local_path(path)
+        if not local.is_file():
+            raise DataObjectDoesNotExist(path)
+        local.unlink()
+
+
+# Quick local benchmark of the iRODS engine code paths against the stand-in
+if __name__ == "__main__":
+    import argparse
+    import functools
+    import logging
+    import tempfile
+    from unittest.mock import Mock
+
+    import irods_storage_engine
+    from data_tools import DataRule, DataRulesWrapper
+    from experiment import ExperimentWrapper
+
+    aparser = argparse.ArgumentParser(description="Benchmark iRODS storage engine against local stand-in")
+    aparser.add_argument("--files", type=int, default=200)
+    aparser.add_argument("--size", type=int, default=64 * 1024, help="File size in bytes")
+    aparser.add_argument("--latency", type=float, default=0.002, help="Seconds per catalog round trip")
+    args = aparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        src = tmp / "src"
+        src.mkdir()
+        for i in range(args.files):
+            (src / f"movie_{i:05d}.tif").write_bytes(bytes(args.size))
+
+        exp = ExperimentWrapper(Mock(), {"Storage": {"SubPath": "bench_exp"}})
+        rules = DataRulesWrapper([DataRule("**/*.tif", ["raw"])])
+        engine = irods_storage_engine.IrodsExperimentStorageEngine(
+            exp, logging.getLogger("bench"), rules, {}, connection={}, collection_base="/tempZone/home/rods",
+            session_factory=functools.partial(LocalIrodsSession, tmp / "zone", latency=args.latency))
+        engine.prepare()
+        session = engine.irods_collection.irods_session
+
+        def measure(name, fn):
+            trips_start, t_start = session.round_trips, time.time()
+            result = fn()
+            print(f"{name: <10} {time.time() - t_start:8.3f} s  {session.round_trips - trips_start: >6} round trips")
+            return result
+
+        measure("put", lambda: [engine.put_file(pathlib.Path(f.name), f) for f in sorted(src.iterdir())])
+        globbed = measure("glob", lambda: list(engine.glob(rules)))
+        measure("checksum", lambda: [engine.checksum(f, "sha256") for f, _, _, _ in globbed])
+        measure("metadata", lambda: engine.irods_collection.store_irods_metadata({f"key_{i}": i for i in range(1, 64)}))
@@ -1,4 +1,5 @@
 import base64
+import functools
 import pathlib, yaml, datetime, logging
 
 from irods.keywords import FORCE_CHKSUM_KW
@@ -11,12 +12,13 @@ import logger_db_api
 import experiment
 import configuration
 from irods.session import iRODSSession
-from irods.meta import iRODSMeta
+from irods.meta import iRODSMeta, AVUOperation
 from irods.ticket import Ticket
 from irods.collection import iRODSCollection
 import irods.message
 import fnmatch
 import fs_storage_engine
+import irods_local_session
 
 # Filter out aggressive debug logs from irods that spit out tons of binary data
 logging.getLogger("irods.connection").setLevel(logging.INFO)
@@ -132,12 +134,36 @@ class IrodsCollectionWrapper:
                 f.write(str.encode(yamlstr))
                 self.logger.info(f"Experiment data model saved to the collection {str(self.collection_path)}")
 
+        avu_ops = self._metadata_diff_operations(col.metadata.items(), metadata)
+        if not avu_ops:
+            return
+
+        # Single round trip, applied by the catalog atomically (all or nothing)
+        col.metadata.apply_atomic_operations(*avu_ops)
+        self.logger.info(f"Attached metadata to collection: {str(self.collection_path)}, {len(avu_ops)} AVU operations")
+
+    @staticmethod
+    def _metadata_diff_operations(existing_avus, metadata: dict):
+        """ Compute AVU operations that bring collection metadata to the given values. 
+            Keys that already hold exactly the desired value are left untouched, keys not present in metadata are kept. """
+        existing = {}
+        for avu in existing_avus:
+            existing.setdefault(avu.name, []).append(avu)
+
+        avu_ops = []
         for met_name, met_value in metadata.items():
-            if met_value:
-                imeta = iRODSMeta(met_name, str(met_value), '')
-                col.metadata[imeta.name] = imeta
-                
-        self.logger.info(f"Attached metadata to collection: {str(self.collection_path)}")         
+            if not met_value:
+                continue
+
+            imeta = iRODSMeta(met_name, str(met_value), '')
+            current = existing.get(met_name, [])
+            if len(current) == 1 and current[0].value == imeta.value and not current[0].units:
+                continue
+
+            avu_ops.extend(AVUOperation(operation='remove', avu=avu) for avu in current)
+            avu_ops.append(AVUOperation(operation='add', avu=imeta))
+
+        return avu_ops
 
     def drop_collection(self):
         self.collection.remove(recurse=True)
@@ -153,14 +179,15 @@ class IrodsExperimentStorageEngine(experiment.ExperimentStorageEngine):
                  collection_base,
                  
                  mount_point=None,
-                 metadata_target="experiment.yml") -> None:
+                 metadata_target="experiment.yml",
+                 session_factory=iRODSSession) -> None:
         super().__init__(experiment, logger, data_rules, metadata_model, metadata_target)
         self.connection_config = connection
         self.collection_base = pathlib.Path(collection_base)
         self.mount_point = pathlib.Path(mount_point) if mount_point else None
 
         self.irods_collection = IrodsCollectionWrapper(
-            irods_session=iRODSSession(**self.connection_config), 
+            irods_session=session_factory(**self.connection_config), 
             collection_path=self.collection_base / self.exp.storage.subpath,
             logger=self.logger)
         
@@ -194,7 +221,10 @@ class IrodsExperimentStorageEngine(experiment.ExperimentStorageEngine):
             return True
         except Exception:
             return False
-    
+
+    def close(self):
+        self.irods_collection.irods_session.cleanup()
+
     def get_access_info(self):
         return {
             "Target": self.irods_collection.irods_session.host, 
@@ -282,6 +312,11 @@ def irods_storage_engine_factory(exp, e_config: configuration.JobConfigWrapper,
     conf: dict = module_config.get(engine or exp.storage.engine)
     if not conf:
         return None
+
+    # Optional local stand-in of the zone, for testing and benchmarking without live iRODS
+    session_factory = iRODSSession
+    if conf.get("local_root"):
+        session_factory = functools.partial(irods_local_session.LocalIrodsSession, conf["local_root"], latency=conf.get("local_latency", 0.0))
     
     return IrodsExperimentStorageEngine(
         exp, logger, e_config.data_rules, e_config.metadata["model"],
@@ -289,7 +324,8 @@ def irods_storage_engine_factory(exp, e_config: configuration.JobConfigWrapper,
         collection_base=conf["base_path"], 
         metadata_target=e_config.metadata["target"],
         connection=conf["connection"],
-        mount_point=conf.get("mount_point", None) 
+        mount_point=conf.get("mount_point", None),
+        session_factory=session_factory
     )
 
 
@@ -6,7 +6,7 @@ from experiment import ExperimentStorageEngine, OperationState
 class JobLifecycleService(experiment.ExperimentModuleBase):
 
     def provide_experiments(self):
-        exps = experiment.ExperimentsApi(self._api_session).get_experiments_by_states(
+        exps = self.experiments_api.get_experiments_by_states(
             exp_state=[experiment.JobState.START_REQUESTED, 
                        experiment.JobState.ACTIVE, 
                        experiment.JobState.STOP_REQUESTED]
@@ -55,6 +55,8 @@ class JobLifecycleService(experiment.ExperimentModuleBase):
                 exp_engine.exp.exp_api.send_email(email_conf)
 
             exp_engine.exp.exp_api.patch_experiment(patch)
+            # Start must be visible in LIMS before the first, possibly long, upload
+            exp_engine.exp.exp_api.flush_patch()
             exp_running()
 
         def _handle_auto_stop():
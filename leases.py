@@ -0,0 +1,255 @@
+""" Leases of experiments for modules, so that several nodes can share the work of one module.
+    A node claims an experiment for a module with a TTL before stepping it and renews the lease while the step runs.
+    The lease is kept, not renewed, for the TTL after the step, so the same node keeps serving the experiment.
+    It is released once the experiment is no longer provided to the module, and picked up by another node
+    once it expires (e.g. the node went down).
+    Leases are kept by LIMS (LimsLeaseStore), or as files in a directory shared by the nodes (FsLeaseStore). """
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import uuid
+
+import requests
+
+import common
+
+
+class LimsLeaseStore:
+    """ Leases kept by LIMS, PUT experiments/{id}/leases/{module} grants or renews (409 if held by another owner) """
+    def __init__(self, http_session: requests.Session):
+        self._http_session = http_session
+
+    @staticmethod
+    def _url(key):
+        module, exp_id = key.split("/", 1)
+        return f"experiments/{exp_id}/leases/{module}"
+
+    def acquire(self, key, owner, ttl):
+        result = self._http_session.put(self._url(key), json={"Owner": owner, "Ttl": ttl})
+        if result.status_code == 409:
+            return False
+        result.raise_for_status()
+        return True
+
+    def renew(self, key, owner, ttl):
+        return self.acquire(key, owner, ttl)
+
+    def release(self, key, owner):
+        self._http_session.delete(self._url(key), params={"owner": owner}).raise_for_status()
+
+
+class FsLeaseStore:
+    """ Leases as files in a directory shared by the nodes (e.g. NFS), a stand-in where LIMS does not keep leases.
+        Lease files are never written in place: new ones are hard linked (fails if one exists), renewed ones replaced.
+        Expiry uses wall clock time of the nodes, TTL must be well above their clock skew. """
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key) -> pathlib.Path:
+        return self.directory / (key.replace("/", "__") + ".lease")
+
+    @staticmethod
+    def _read(path: pathlib.Path):
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            return None
+
+    def _write_temp(self, path: pathlib.Path, lease):
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        tmp.write_text(json.dumps(lease))
+        return tmp
+
+    def _create(self, path, lease):
+        tmp = self._write_temp(path, lease)
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            tmp.unlink()
+
+    def _replace(self, path, lease):
+        os.replace(self._write_temp(path, lease), path)
+        return True
+
+    def _take_over(self, path, expired, lease):
+        # Only one of the nodes moving the expired lease away gets it
+        tomb = path.with_name(f".{path.name}.{uuid.uuid4().hex}.expired")
+        try:
+            os.rename(path, tomb)
+        except FileNotFoundError:
+            return self._create(path, lease)
+        if self._read(tomb) != expired:
+            # Another node took the lease over meanwhile, put its lease back
+            try:
+                os.link(tomb, path)
+            except FileExistsError:
+                pass
+            tomb.unlink()
+            return False
+        tomb.unlink()
+        return self._create(path, lease)
+
+    def acquire(self, key, owner, ttl):
+        path = self._path(key)
+        lease = {"Owner": owner, "Expires": time.time() + ttl}
+        if self._create(path, lease):
+            return True
+        current = self._read(path)
+        if current is None:
+            return self._create(path, lease)
+        if current["Owner"] == owner:
+            return self._replace(path, lease)
+        if current["Expires"] > time.time():
+            return False
+        return self._take_over(path, current, lease)
+
+    def renew(self, key, owner, ttl):
+        path = self._path(key)
+        current = self._read(path)
+        if current is None or current["Owner"] != owner:
+            return False
+        return self._replace(path, {"Owner": owner, "Expires": time.time() + ttl})
+
+    def release(self, key, owner):
+        path = self._path(key)
+        current = self._read(path)
+        if current is not None and current["Owner"] == owner:
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+
+
+class LeaseKeeper:
+    """ Leases of one module of this node, renewed every ttl/3 while held """
+    def __init__(self, store, owner, ttl, logger: logging.Logger = None):
+        self.store = store
+        self.owner = owner
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger("leases")
+        self._held = {} # key => number of holders
+        self._release_pending = set() # keys released while held, released once the last holder finishes
+        self._lock = threading.Lock()
+        # Taken around each renewal and release, so that a lease is never renewed after it was released
+        self._store_lock = threading.Lock()
+        self._renewer = None
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        """ Claim the lease and keep it renewed within the block, yields whether it was claimed """
+        try:
+            claimed = self.store.acquire(key, self.owner, self.ttl)
+        except Exception as e:
+            self.logger.warning(f"Could not claim lease {key}: {e}")
+            claimed = False
+        if not claimed:
+            yield False
+            return
+
+        with self._lock:
+            self._held[key] = self._held.get(key, 0) + 1
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew_held, name="lease_renewer", daemon=True)
+                self._renewer.start()
+        try:
+            yield True
+        finally:
+            release = False
+            with self._lock:
+                self._held[key] -= 1
+                if not self._held[key]:
+                    del self._held[key]
+                    release = key in self._release_pending
+                    self._release_pending.discard(key)
+            if release:
+                self._release(key)
+
+    def release(self, key):
+        """ Release the lease now, or once the step holding it finishes """
+        with self._lock:
+            if key in self._held:
+                self._release_pending.add(key)
+                return
+        self._release(key)
+
+    def _release(self, key):
+        with self._store_lock:
+            try:
+                self.store.release(key, self.owner)
+            except Exception as e:
+                self.logger.warning(f"Could not release lease {key}: {e}")
+
+    def _renew_held(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            with self._lock:
+                keys = list(self._held)
+                if not keys:
+                    self._renewer = None
+                    return
+            for key in keys:
+                with self._store_lock:
+                    with self._lock:
+                        # The step finished meanwhile, the lease is just kept until it expires
+                        if key not in self._held:
+                            continue
+                    try:
+                        renewed = self.store.renew(key, self.owner, self.ttl)
+                    except Exception as e:
+                        self.logger.warning(f"Could not renew lease {key}: {e}")
+                        continue
+                if not renewed:
+                    self.logger.warning(f"Lease {key} was lost, another node may work on it too")
+
+
+class ModuleLeases:
+    """ Experiment leases of one module, shared with other nodes running it when module config lease_store is set
+        ("lims", or a directory shared by the nodes), held for lease_ttl (5 minutes by default) """
+    def __init__(self, name, module_config, http_session: requests.Session, logger: logging.Logger):
+        self.name = name
+        self.module_config = module_config
+        self._http_session = http_session
+        self.logger = logger
+        self._keeper = None
+        self._keeper_config = None
+        self._lock = threading.Lock()
+        self._provided = set() # ids of experiments provided to the last step that went through all of them
+
+    @property
+    def keeper(self) -> LeaseKeeper:
+        """ Keeper of the configured store, None when leases are not used """
+        store = self.module_config.get("lease_store", None)
+        if not store:
+            return None
+        ttl = common.parse_timedelta(self.module_config.get("lease_ttl", "00:05:00")).total_seconds()
+        with self._lock:
+            if self._keeper_config != (store, ttl):
+                lease_store = LimsLeaseStore(self._http_session) if store == "lims" else FsLeaseStore(store)
+                self._keeper = LeaseKeeper(lease_store, self.module_config.node_name, ttl, self.logger)
+                self._keeper_config = (store, ttl)
+            return self._keeper
+
+    def hold(self, exp_id):
+        """ Context claiming the experiment for the step, yields whether it was claimed (always without lease_store) """
+        keeper = self.keeper
+        return keeper.hold(f"{self.name}/{exp_id}") if keeper else contextlib.nullcontext(True)
+
+    def track(self, experiments):
+        """ Experiments of a step passed through, once all of them went through,
+            leases of experiments provided to the previous step but not to this one are released """
+        provided = set()
+        for exp in experiments:
+            provided.add(exp.id)
+            yield exp
+        previous, self._provided = self._provided, provided
+        keeper = self.keeper
+        if keeper is None:
+            return
+        for exp_id in previous - provided:
+            keeper.release(f"{self.name}/{exp_id}")
@@ -0,0 +1,239 @@
+""" Local stand-in of the LIMS HTTP API for tests and benchmarks.
+    Serves experiments kept in memory, with the same query parameters as the LIMS, paging (pageSize, page),
+    json patches, change feed (experiments/changes?since=cursor)
+    and conditional requests (ETag/If-None-Match, Last-Modified/If-Modified-Since).
+    Center configuration is served with ping and long polled change notifications (centers/changes/{node}).
+    Experiment leases of modules are granted by PUT and released by DELETE of experiments/{id}/leases/{module}. """
+import copy
+import datetime
+import email.utils
+import hashlib
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import jsonpatch
+
+from experiment import filter_experiments
+
+
+class LocalLimsServer:
+    def __init__(self, experiments=None, config=None, host="127.0.0.1", port=0):
+        self._lock = threading.Lock()
+        self._config_changed = threading.Condition(self._lock)
+        self.config_versions = [] # (datetime, config)
+        if config is not None:
+            self.set_config(config)
+        self.experiments = {}
+        self.modified = {} # id => modification timestamp
+        self.change_seq = {} # id => sequence number of the last change, used as change feed cursor
+        self._seq = 0
+        self.leases = {} # (experiment id, module) => (owner, expiry timestamp)
+        for exp in experiments or []:
+            self.put_experiment(exp)
+
+        # (method, path, status) of each handled request
+        self.requests = []
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _LimsRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.lims = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def put_experiment(self, exp: dict):
+        """ Create or replace experiment, as if changed by someone else """
+        with self._lock:
+            self.experiments[exp["Id"]] = copy.deepcopy(exp)
+            self._mark_changed(exp["Id"])
+
+    def patch_experiment(self, exp_id, json_patch: list):
+        with self._lock:
+            self.experiments[exp_id] = jsonpatch.apply_patch(self.experiments[exp_id], json_patch)
+            self._mark_changed(exp_id)
+
+    def _mark_changed(self, exp_id):
+        self._seq += 1
+        self.change_seq[exp_id] = self._seq
+        self.modified[exp_id] = time.time()
+
+    def changes_since(self, cursor: int):
+        with self._lock:
+            changed = [copy.deepcopy(self.experiments[i]) for i, seq in self.change_seq.items() if seq > cursor]
+            return {"Cursor": self._seq, "Experiments": changed, "Removed": []}
+
+    def set_config(self, config: dict):
+        """ New version of center configuration, notifies long polling nodes """
+        with self._config_changed:
+            dt = datetime.datetime.utcnow()
+            if self.config_versions and dt <= self.config_versions[-1][0]:
+                dt = self.config_versions[-1][0] + datetime.timedelta(microseconds=1)
+            self.config_versions.append((dt, copy.deepcopy(config)))
+            self._config_changed.notify_all()
+
+    def config_change_since(self, since: datetime.datetime, wait: float):
+        """ Wait for configuration newer than since, returns None if there is none within wait seconds """
+        with self._config_changed:
+            is_newer = lambda: self.config_versions and self.config_versions[-1][0] > since
+            if not self._config_changed.wait_for(is_newer, timeout=wait):
+                return None
+            dt, config = self.config_versions[-1]
+            previous = next((c for d, c in self.config_versions if d == since), None)
+            patch = jsonpatch.make_patch(previous, config).patch if previous is not None else None
+            return {"DtConfig": dt.isoformat(), "Patch": patch}
+
+    def acquire_lease(self, exp_id, module, owner, ttl):
+        """ Grant or renew the lease, False if held by another owner and not expired """
+        with self._lock:
+            current = self.leases.get((exp_id, module), None)
+            if current is not None and current[0] != owner and current[1] > time.time():
+                return False
+            self.leases[(exp_id, module)] = (owner, time.time() + ttl)
+            return True
+
+    def release_lease(self, exp_id, module, owner):
+        with self._lock:
+            current = self.leases.get((exp_id, module), None)
+            if current is not None and current[0] == owner:
+                del self.leases[(exp_id, module)]
+
+    def count_requests(self, method=None, status=None):
+        return len([r for r in self.requests if (method is None or r[0] == method) and (status is None or r[2] == status)])
+
+    def query_experiments(self, query: dict):
+        with self._lock:
+            exps = list(self.experiments.values())
+        return filter_experiments({k: v[0] for k, v in query.items()}, exps)
+
+
+class _LimsRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def lims(self) -> LocalLimsServer:
+        return self.server.lims
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=None, headers=None):
+        self.lims.requests.append((self.command, self.path, status))
+        # Strings are sent as plain text (ping)
+        payload = body.encode() if isinstance(body, str) else json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "text/plain" if isinstance(body, str) else "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _respond_conditional(self, body, last_modified: float):
+        etag = '"' + hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest() + '"'
+        last_modified_str = email.utils.formatdate(last_modified, usegmt=True)
+        headers = {"ETag": etag, "Last-Modified": last_modified_str}
+
+        if_none_match = self.headers.get("If-None-Match", None)
+        if_modified_since = self.headers.get("If-Modified-Since", None)
+        if if_none_match is not None:
+            not_modified = if_none_match == etag
+        elif if_modified_since is not None:
+            not_modified = int(last_modified) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        else:
+            not_modified = False
+
+        if not_modified:
+            return self._respond(304, headers=headers)
+        return self._respond(200, body, headers)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        query = urllib.parse.parse_qs(url.query)
+
+        if len(parts) == 3 and parts[:2] == ["centers", "ping"]:
+            versions = self.lims.config_versions
+            return self._respond(200, (versions[-1][0] if versions else datetime.datetime.min).isoformat())
+
+        if parts == ["centers"]:
+            return self._respond(200, self.lims.config_versions[-1][1] if self.lims.config_versions else None)
+
+        if len(parts) == 3 and parts[:2] == ["centers", "changes"]:
+            since = datetime.datetime.fromisoformat(query["since"][0])
+            change = self.lims.config_change_since(since, float(query.get("wait", ["0"])[0]))
+            return self._respond(200, change) if change is not None else self._respond(204)
+
+        if parts == ["experiments"]:
+            exps = self.lims.query_experiments(query)
+            last_modified = max([self.lims.modified[e["Id"]] for e in exps], default=0)
+            if "pageSize" not in query:
+                return self._respond_conditional(exps, last_modified)
+
+            page_size, page = int(query["pageSize"][0]), int(query.get("page", ["0"])[0])
+            items = exps[page * page_size:(page + 1) * page_size]
+            next_page = page + 1 if len(exps) > (page + 1) * page_size else None
+            return self._respond_conditional({"Items": items, "NextPage": next_page}, last_modified)
+
+        if parts == ["experiments", "changes"]:
+            return self._respond(200, self.lims.changes_since(int(query.get("since", ["0"])[0])))
+
+        if len(parts) == 2 and parts[0] == "experiments":
+            exp = self.lims.experiments.get(parts[1], None)
+            if exp is None:
+                return self._respond(404)
+            return self._respond_conditional(exp, self.lims.modified[parts[1]])
+
+        self._respond(404)
+
+    def do_PATCH(self):
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "experiments" and parts[1] in self.lims.experiments:
+            self.lims.patch_experiment(parts[1], self._read_json())
+            return self._respond(200)
+
+        self._respond(404)
+
+    def do_PUT(self):
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        if len(parts) == 4 and parts[0] == "experiments" and parts[2] == "leases" and parts[1] in self.lims.experiments:
+            lease = self._read_json()
+            if not self.lims.acquire_lease(parts[1], parts[3], lease["Owner"], float(lease["Ttl"])):
+                return self._respond(409)
+            return self._respond(200)
+
+        self._respond(404)
+
+    def do_DELETE(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) == 4 and parts[0] == "experiments" and parts[2] == "leases":
+            owner = urllib.parse.parse_qs(url.query).get("owner", [None])[0]
+            self.lims.release_lease(parts[1], parts[3], owner)
+            return self._respond(204)
+
+        self._respond(404)
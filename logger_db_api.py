@@ -1,11 +1,18 @@
 import datetime
+import gzip
+import json
 import logging
+import pathlib
 import queue
+import re
+import threading
 import time
 import uuid
 
 import requests
 
+import common
+
 DOTNET_LOGMAP = {
     logging.getLevelName(logging.DEBUG): "Debug",
     logging.getLevelName(logging.INFO): "Information",
@@ -14,62 +21,223 @@ DOTNET_LOGMAP = {
     logging.getLevelName(logging.WARNING): "Warning",
 }
 
+# Numbers (counts, sizes, times, ids) masked to group otherwise identical messages
+_NUMBERS_RE = re.compile(r"\d+(?:[.,:]\d+)*")
+
+class LogCoalescer:
+    """ Aggregates repeated log messages of one origin and experiment into periodic summaries.
+        Messages logged with extra={"coalesce": template, "coalesce_size": bytes} are only counted and summarized
+        by the template, e.g. "TRANSFER [raw]; {count} files, {size} in last {window} s".
+        Other messages are grouped by their text with numbers masked - first of a group in a window passes,
+        the rest is summarized when the window ends. Every origin passes at most rate_limit messages per window,
+        warnings and errors always pass. Raw logs can be kept in a local detail file. """
+    def __init__(self, window=60.0, rate_limit=120, detail_path=None, detail_max_bytes=50 * 1024 * 1024):
+        self.window = window
+        self.rate_limit = rate_limit
+        self.detail_path = pathlib.Path(detail_path) if detail_path else None
+        self.detail_max_bytes = detail_max_bytes
+        self._groups = {} # (origin, exp id, group key) => {"start", "count", "size", "last", "template"}
+        self._passed = {} # origin => (window start, number of passed logs)
+        # process and summaries are called by the flushing thread, close and callers flushing on their own
+        self._lock = threading.RLock()
+
+    def process(self, logs_data: list, now=None):
+        """ Returns logs to submit - passed ones and summaries of groups whose window ended """
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            self._write_detail(logs_data)
+
+            result = []
+            for log in logs_data:
+                template, size = log.pop("_coalesce", None) or (None, None)
+                if template is None and log["Level"] not in ("Debug", "Information"):
+                    result.append(log)
+                    continue
+
+                group_key = (log["Origin"], log["ExperimentId"], template or _NUMBERS_RE.sub("#", log["Message"]))
+                group = self._groups.get(group_key, None)
+                if group is None and template is None and self._pass(log["Origin"], now):
+                    # First of its kind passes as it is, repetitions get summarized
+                    self._groups[group_key] = {"start": now, "count": 0, "size": 0, "last": None, "template": None}
+                    result.append(log)
+                    continue
+                if group is None:
+                    group = self._groups[group_key] = {"start": now, "count": 0, "size": 0, "last": None, "template": template}
+                group["count"] += 1
+                group["size"] += size or 0
+                group["last"] = log
+
+            return result + self.summaries(now)
+
+    def summaries(self, now=None, force=False):
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            result = []
+            for group_key, group in list(self._groups.items()):
+                if not force and now - group["start"] < self.window:
+                    continue
+                del self._groups[group_key]
+                if not group["count"]:
+                    continue
+                result.append(self._summary(group, now))
+            return result
+
+    def _summary(self, group, now):
+        window = f"{min(now - group['start'], self.window):.0f}"
+        if group["template"]:
+            message = group["template"].format(count=group["count"], size=common.sizeof_fmt(group["size"]), window=window)
+        else:
+            message = f"{group['last']['Message']} ({group['count']} similar messages in last {window} s)"
+        return {**group["last"], "Id": str(uuid.uuid4()), "Message": message}
+
+    def _pass(self, origin, now):
+        start, passed = self._passed.get(origin, (now, 0))
+        if now - start >= self.window:
+            start, passed = now, 0
+        if passed >= self.rate_limit:
+            return False
+        self._passed[origin] = (start, passed + 1)
+        return True
+
+    def _write_detail(self, logs_data):
+        if self.detail_path is None or not logs_data:
+            return
+        # Keep the last detail_max_bytes, in current and one rotated file
+        if self.detail_path.exists() and self.detail_path.stat().st_size > self.detail_max_bytes:
+            self.detail_path.replace(self.detail_path.with_name(self.detail_path.name + ".1"))
+        with open(self.detail_path, "a") as f:
+            f.write("".join(json.dumps({k: v for k, v in l.items() if k != "_coalesce"}) + "\n" for l in logs_data))
+
+
 class LimsApiLoggerHandler(logging.Handler):
+    """ Submits logs to LIMS in batches from a flushing thread (keep_flushing), gzip compressed if compress is set
+        (LIMS must accept Content-Encoding: gzip requests).
+        emit never blocks - when the queue is full, logs spill to an append-only journal file (if journal_path is set),
+        otherwise they are dropped and counted. Batches that fail to submit go to the journal as well
+        and the journal is replayed once LIMS accepts logs again. Optional coalescer aggregates repeated logs before submission. """
     def __init__(self,
                  http_session: requests.Session,
                  level=logging.INFO,
                  queue_max=6400,
-                 max_logs_per_request=64):
+                 max_logs_per_request=64,
+                 journal_path=None,
+                 compress=False,
+                 max_retry_delay=60,
+                 coalescer: LogCoalescer = None):
         super().__init__(level)
         self._session = http_session
         self._buffer = queue.Queue(queue_max)
         self._max_logs_per_request = max_logs_per_request
+        self.journal_path = pathlib.Path(journal_path) if journal_path else None
+        self._journal_lock = threading.Lock()
+        self.compress = compress
+        self.max_retry_delay = max_retry_delay
+        self._retry_delay = 0
+        self._retry_at = 0.0
+        self.dropped = 0
+        self.coalescer = coalescer
 
     def emit(self, record: logging.LogRecord):
-        self.format(record)
-        if not hasattr(record, "log_id"):
-            record.log_id = str(uuid.uuid4())
-        if not hasattr(record, "exp_id"):
-            record.exp_id = None
-        if not hasattr(record, "origin"):
-            record.origin = "-"
-        self._buffer.put(record)
+        try:
+            log_data = {
+                "Id": str(getattr(record, "log_id", None) or uuid.uuid4()),
+                "ExperimentId": getattr(record, "exp_id", None),
+                "Dt": datetime.datetime.utcfromtimestamp(record.created).isoformat(),
+                "Origin": getattr(record, "origin", "-"),
+                "Level": DOTNET_LOGMAP.get(record.levelname, "Information"),
+                "Message": record.getMessage()
+            }
+            if hasattr(record, "coalesce"):
+                log_data["_coalesce"] = (record.coalesce, getattr(record, "coalesce_size", 0))
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self._buffer.put_nowait(log_data)
+        except queue.Full:
+            self._spill([log_data])
+
+    def _spill(self, logs_data):
+        if self.journal_path is None:
+            self.dropped += len(logs_data)
+            return
+        lines = "".join(json.dumps(l) + "\n" for l in logs_data)
+        with self._journal_lock:
+            with open(self.journal_path, "a") as f:
+                f.write(lines)
+
+    def _take_batch(self):
+        logs_data = []
+        while len(logs_data) < self._max_logs_per_request:
+            try:
+                logs_data.append(self._buffer.get_nowait())
+            except queue.Empty:
+                break
+        return logs_data
 
     def flush(self):
-        # Take items from queue into list, maximum max_logs_per_request, do that until queue is exhausted
-        while not self._buffer.empty():
-            logs_data = []
-            while not self._buffer.empty() and len(logs_data) < self._max_logs_per_request:
-                record = self._buffer.get()
-                logs_data.append({
-                    "Id": record.log_id,
-                    "ExperimentId": record.exp_id,
-                    "Dt": datetime.datetime.utcfromtimestamp(record.created).isoformat(),
-                    "Origin": record.origin,
-                    "Level": DOTNET_LOGMAP[record.levelname],
-                    "Message": record.getMessage()
-                })
+        # LIMS failed recently - wait for the backoff, queue overflow goes to the journal meanwhile
+        if time.monotonic() < self._retry_at:
+            return
+        if not self._replay_journal():
+            return
 
+        # Take items from queue in batches of maximum max_logs_per_request, until queue is exhausted
+        while True:
+            logs_data = self._take_batch()
+            if self.coalescer is not None:
+                logs_data = self.coalescer.process(logs_data)
             if not logs_data:
-                continue
+                return
+            if not self._submit_logs(logs_data):
+                self._spill(logs_data)
+                return
 
-            self._submit_logs(logs_data)
+    def _replay_journal(self):
+        """ Submit logs from the journal, returns False when LIMS still does not accept them """
+        if self.journal_path is None:
+            return True
+        replay_path = self.journal_path.with_name(self.journal_path.name + ".replay")
+        # Replayed part is moved aside, so that emit can keep spilling into a new journal
+        with self._journal_lock:
+            if not replay_path.exists():
+                if not self.journal_path.exists():
+                    return True
+                self.journal_path.rename(replay_path)
 
-    def _submit_logs(self, logs_data, max_retries=5, delay=1):
-        for attempt in range(max_retries):
+        logs_data = []
+        for line in replay_path.read_text().splitlines():
             try:
-                res = self._session.post("experiments/logs", json=logs_data, stream=False)
-                res.raise_for_status()
-                return  # if successful, exit the function
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    print(f"Retrying after error: {e}. Attempt {attempt + 1}/{max_retries}")
-                    time.sleep(delay)
-                    delay *= 2  # exponential backoff
-                else:
-                    print(f"Logger handler error after {max_retries} attempts: {e}, dropping {len(logs_data)} logs")
-                    break
+                logs_data.append(json.loads(line))
+            except ValueError:
+                pass # Incomplete line written before crash
 
+        for i in range(0, len(logs_data), self._max_logs_per_request):
+            if not self._submit_logs(logs_data[i:i + self._max_logs_per_request]):
+                # Keep the rest for next replay
+                replay_path.write_text("".join(json.dumps(l) + "\n" for l in logs_data[i:]))
+                return False
+        replay_path.unlink()
+        return True
+
+    def _submit_logs(self, logs_data):
+        """ Single attempt without waiting, failure schedules next attempt with exponential backoff """
+        body = json.dumps([{k: v for k, v in l.items() if k != "_coalesce"} for l in logs_data]).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        try:
+            res = self._session.post("experiments/logs", data=body, headers=headers, stream=False)
+            res.raise_for_status()
+        except Exception as e:
+            self._retry_delay = min(max(self._retry_delay * 2, 1), self.max_retry_delay)
+            self._retry_at = time.monotonic() + self._retry_delay
+            print(f"Logger handler error: {e}, retrying {len(logs_data)} logs after {self._retry_delay}s")
+            return False
+        self._retry_delay = 0
+        return True
 
     def keep_flushing(self, interval=0.7):
         while True:
@@ -78,6 +246,11 @@ class LimsApiLoggerHandler(logging.Handler):
 
     def close(self):
         self.flush()
+        # Logs not submitted are kept for the next run
+        while not self._buffer.empty():
+            self._spill(self._take_batch())
+        if self.coalescer is not None:
+            self._spill(self.coalescer.summaries(force=True))
         super().close()
         self._session.close()
 
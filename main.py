@@ -3,22 +3,21 @@ import datetime
 import importlib
 import logging
 import os
+import signal
 import sys
+import tempfile
 import time
 import configuration
 import logger_db_api
+import metrics
+import profiling
+import scheduler
+import supervisor
 import socket
 import common
 import threading
 import experiment
 
-# Trigger a stack trace when SIGUSR1 is received
-# For debugging stuck threads
-if sys.platform != "win32":
-    import faulthandler
-    import signal
-    signal.signal(signal.SIGUSR1, lambda sig, frame: faulthandler.dump_traceback())
-
 aparser = argparse.ArgumentParser(
     prog = 'lims-node',
     description = 'LIMS processing/controlling node',
@@ -32,48 +31,27 @@ aparser.add_argument("--sip-api-url", "-u", dest="sip_api_url", default=os.geten
 aparser.add_argument("--sip-api-key", "-s", dest="sip_api_key", default=os.getenv("SIP_API_KEY"), help="A key that is used to authorize organization in the LIMS API/")
 aparser.add_argument("--sip-api-https-proxy", "-p", dest="sip_api_https_proxy", help="A proxy server to be used to communicatet with LIMS API")
 aparser.add_argument("--refresh-interval", "-r", dest="refresh_interval", default=6.0, type=float, help="How often to ping LIMS database, fetch/submit configuration and adjust executed modules accordingly. Default 15sec.")
+aparser.add_argument("--config-long-poll", dest="config_long_poll", default=0.0, type=float, help="How many seconds to wait for configuration change notification from LIMS (must support centers/changes), ping is then sent once per wait, but not more often than every refresh interval. Default 0, pings every refresh interval.")
+aparser.add_argument("--module-workers", dest="module_workers", default=16, type=int, help="Maximum number of module steps running at the same time. Default 16.")
+aparser.add_argument("--drain-timeout", dest="drain_timeout", default=30.0, type=float, help="How many seconds running module steps get to finish when the node stops. Default 30sec.")
+aparser.add_argument("--lims-pool-size", dest="lims_pool_size", default=10, type=int, help="Maximum number of pooled HTTP connections per LIMS API session. Default 10.")
+aparser.add_argument("--experiment-cache-ttl", dest="experiment_cache_ttl", default=2.0, type=float, help="For how many seconds are experiment queries shared between modules of this node, 0 disables caching. Default 2sec.")
+aparser.add_argument("--experiment-mirror", dest="experiment_mirror", action='store_true', help="Keep a local mirror of experiments synced by LIMS change feed and answer state queries of modules from it.")
+aparser.add_argument("--log-journal", dest="log_journal", help="File where logs are kept while LIMS does not accept them, replayed later. Default is lims-node-<node name>-logs.jsonl in the temp directory.")
+aparser.add_argument("--log-coalesce-window", dest="log_coalesce_window", default=60.0, type=float, help="Repeated logs are summarized for LIMS over this many seconds, 0 disables coalescing. Default 60sec.")
+aparser.add_argument("--log-rate-limit", dest="log_rate_limit", default=120, type=int, help="Maximum number of logs per origin and coalescing window submitted to LIMS, the rest is summarized. Default 120.")
+aparser.add_argument("--log-compress", dest="log_compress", action='store_true', help="Send logs to LIMS gzip compressed, LIMS must accept gzip encoded requests.")
+aparser.add_argument("--log-detail-file", dest="log_detail_file", help="File keeping all logs before coalescing. Default is lims-node-<node name>-detail.jsonl in the temp directory.")
+aparser.add_argument("--metrics-port", dest="metrics_port", default=0, type=int, help="Serve metrics in Prometheus text format on http://127.0.0.1:<port>/metrics, 0 disables the endpoint. Default 0.")
+aparser.add_argument("--metrics-file", dest="metrics_file", help="File where metrics snapshots are appended as json lines, rolled over at 10 MiB. Default is lims-node-<node name>-metrics.jsonl in the temp directory.")
+aparser.add_argument("--metrics-file-interval", dest="metrics_file_interval", default=60.0, type=float, help="How often are metrics written to the metrics file, 0 disables the file. Default 60sec.")
+aparser.add_argument("--profile-dir", dest="profile_dir", help="Directory where profiles and allocation diffs requested by SIGUSR2 or control socket are written. Default is the temp directory.")
+aparser.add_argument("--profile-seconds", dest="profile_seconds", default=30.0, type=float, help="How long SIGUSR2 samples stacks of all threads. Default 30sec.")
+aparser.add_argument("--control-socket", dest="control_socket", help="Unix socket accepting diagnostic commands: profile [seconds], stop, malloc, malloc-stop. Disabled by default.")
+aparser.add_argument("--supervise", dest="supervise", action='store_true', help="Run module groups (module config \"group\", default \"main\") in separate child processes restarted on crash, this process only syncs configuration and submits logs.")
 aparser.add_argument("-d --debug", dest="debug_mode", action='store_true')
-arguments = aparser.parse_args()
-
-# Configure root logger
-loglvl = logging.DEBUG if arguments.debug_mode else logging.INFO
-logging.basicConfig(level=loglvl)
-
-
-# Handle obtaining configuration and connecting to LIMS
-is_config_master = False
-node_name = arguments.node_name if arguments.node_name else socket.gethostname()
-debug_mode = bool(arguments.debug_mode)
-config = configuration.LimsConfigWrapper(arguments.organization_name, node_name)
-
-# Disable ssl verify warnings
-if debug_mode:
-    import urllib3
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-if arguments.config_file:
-    config.from_file(arguments.config_file)
-    is_config_master = True
-    # API arguments should be present in the file - load them
-    api_config = config["SipApi"]
-    arguments.organization_name = arguments.organization_name or api_config["Organization"]
-    arguments.sip_api_url = arguments.sip_api_url or api_config["BaseUrl"]
-    arguments.sip_api_key = arguments.sip_api_key or api_config["SecretKey"]
-
-if not arguments.organization_name:
-    aparser.error("Organization name must be provided either by command line argument (-o, --organization-name) or through config file (SipApi.Organization)")
-
-if not arguments.sip_api_key:
-    aparser.error("SIP API key must be provided either by command line argument (--sip-api-key) or through config file (SipApi.SecretKey)")
-
-if not arguments.sip_api_url:
-    aparser.error("SIP API URL must be provided either by command line argument (--sip-api-url) or through config file (SipApi.BaseUrl)")
-
-
-# ========= Factories, edit them to provide required dependencies ===========
-def lims_api_session_provider():
-        return configuration.create_lims_session(arguments.sip_api_url, arguments.sip_api_key, arguments.sip_api_https_proxy, verify=not arguments.debug_mode)
-
+# Storage engine factory, edit it to provide required engines
+# It is module level, so that process runners can send it to their worker processes
 def exp_storage_engine_factory(exp: experiment.ExperimentWrapper, e_config: configuration.JobConfigWrapper, logger: logging.Logger, module_config: configuration.LimsModuleConfigWrapper, engine: str=None):
     engine = engine or exp.storage.engine
     if (engine.startswith("fs")):
@@ -83,91 +61,164 @@ def exp_storage_engine_factory(exp: experiment.ExperimentWrapper, e_config: conf
         import irods_storage_engine
         return irods_storage_engine.irods_storage_engine_factory(exp, e_config, logger, module_config, engine)
 
-# Prepare logger handler for saving logs to SIP server and make it run on separate thread
-sip_logger_handler = logger_db_api.LimsApiLoggerHandler(lims_api_session_provider(), logging.INFO)
-threading.Thread(target=sip_logger_handler.keep_flushing, daemon=True).start()
-
-def make_module(cls, conf):
-    name = conf["target"]
-    logger = logging.getLogger(conf["target"])
-    lims_logger = logger_db_api.prepare_lims_api_logger("lims/" + conf["target"], node_name, sip_logger_handler)
-    module_config = configuration.LimsModuleConfigWrapper(name, node_name, config)
-    if issubclass(cls, experiment.ExperimentModuleBase):
-        return cls(name, logger, lims_logger, module_config, lims_api_session_provider(), exp_storage_engine_factory)
-    if issubclass(cls, configuration.LimsNodeModule):
-        return cls(name, logger, lims_logger, module_config, lims_api_session_provider())
-
-def make_config_syncer(config_syncer_class):
-    conf_syncer = config_syncer_class(
-    config_syncer_class.__module__ + "." + config_syncer_class.__name__, 
-    logging.getLogger("config_syncer"), 
-    logger_db_api.prepare_lims_api_logger("lims_config_syncer", node_name, sip_logger_handler),
-    configuration.LimsModuleConfigWrapper(None, node_name, config), lims_api_session_provider()
-    ) 
-    return conf_syncer
-# ==============================================================
-
-# Keep configuration up to date, and ping
-conf_syncer = make_config_syncer(configuration.ConfigToDbSyncer if is_config_master else configuration.ConfigFromDbSyncer)
-
-modules_dict = {}
-action_targets = {} # module.method => (task, config)
-
-while True:
-    # Ping lims and fetch/submit configuration
-    try:
-        conf_syncer.step()
-        logging.debug(f"{datetime.datetime.now()} Configuration synced.")
-    except Exception as e:
-        logging.exception(e)
-        time.sleep(arguments.refresh_interval)
-        continue
-    
-    mods = []
-    if not config.is_empty:
-        mods = config.node["Modules"]
-
-    # Kill modules that are not present any longer
-    for active_mod_name in list(action_targets):
-        mod_config = next(filter(lambda x: x["target"] == active_mod_name, mods), None)
-        if mod_config is None or ("enabled" in mod_config and not mod_config["enabled"]):
-            action_targets[active_mod_name][0].set() # Set thread cancel event
-            del action_targets[active_mod_name] # Remove thread from current threads
-        
-    for conf in mods:
-        # Is this action enabled? If not, skip it.
-        if "enabled" in conf and not conf["enabled"]:
-            continue
-
-        # Is this action already running?
-        if conf["target"] in action_targets:
-            continue
-
-        # This action is not running - start it
-        target_spl = conf["target"].split(".")
-        module_name, class_name = ".".join(target_spl[:-1]), target_spl[-1]
-        # Import and configure the module, if not yet done
-        if module_name not in modules_dict:
-            module = importlib.import_module(module_name)
-            modules_dict[module_name] = module
-        else:
-            module = modules_dict[module_name]
-
-        interval = common.parse_timedelta(conf["interval"])
-        seconds = interval.total_seconds()
-        
-        try:
-            task_instance = make_module(getattr(module, class_name), conf)
-        except Exception as e:
-            logging.error("Failed to initialize module action", exc_info=e)
-            continue
-        
-        cancel_event = threading.Event()
-        thrd = threading.Thread(target=common.action_thread, daemon=True, args=(task_instance.step, seconds, cancel_event, False))
-        thrd.start()
-        action_targets[conf["target"]] = (cancel_event, conf)
+
+def main():
+    # Trigger a stack trace when SIGUSR1 is received
+    # For debugging stuck threads
+    if sys.platform != "win32":
+        import faulthandler
+        signal.signal(signal.SIGUSR1, lambda sig, frame: faulthandler.dump_traceback())
+
+    arguments = aparser.parse_args()
+
+    # Configure root logger
+    loglvl = logging.DEBUG if arguments.debug_mode else logging.INFO
+    logging.basicConfig(level=loglvl)
+
+
+    # SIGUSR2 samples stacks of all threads for profile seconds, control socket also takes allocation snapshots
+    diagnostics = profiling.Diagnostics(arguments.profile_dir or tempfile.gettempdir(), arguments.profile_seconds)
+    if sys.platform != "win32":
+        diagnostics.listen_signal(signal.SIGUSR2)
+        if arguments.control_socket:
+            profiling.ControlSocket(arguments.control_socket, diagnostics).start()
+
+    # Handle obtaining configuration and connecting to LIMS
+    is_config_master = False
+    node_name = arguments.node_name if arguments.node_name else socket.gethostname()
+    debug_mode = bool(arguments.debug_mode)
+    config = configuration.LimsConfigWrapper(arguments.organization_name, node_name)
+
+    # Disable ssl verify warnings
+    if debug_mode:
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    if arguments.config_file:
+        config.from_file(arguments.config_file)
+        is_config_master = True
+        # API arguments should be present in the file - load them
+        api_config = config["SipApi"]
+        arguments.organization_name = arguments.organization_name or api_config["Organization"]
+        arguments.sip_api_url = arguments.sip_api_url or api_config["BaseUrl"]
+        arguments.sip_api_key = arguments.sip_api_key or api_config["SecretKey"]
+
+    if not arguments.organization_name:
+        aparser.error("Organization name must be provided either by command line argument (-o, --organization-name) or through config file (SipApi.Organization)")
+
+    if not arguments.sip_api_key:
+        aparser.error("SIP API key must be provided either by command line argument (--sip-api-key) or through config file (SipApi.SecretKey)")
+
+    if not arguments.sip_api_url:
+        aparser.error("SIP API URL must be provided either by command line argument (--sip-api-url) or through config file (SipApi.BaseUrl)")
+
+
+    experiment.experiment_query_cache.ttl = arguments.experiment_cache_ttl
+
+    # ========= Factories, edit them to provide required dependencies ===========
+    def lims_api_session_provider():
+            return configuration.create_lims_session(arguments.sip_api_url, arguments.sip_api_key, arguments.sip_api_https_proxy, verify=not arguments.debug_mode, pool_maxsize=arguments.lims_pool_size)
+
+    # Supervised module groups keep their own mirror
+    if arguments.experiment_mirror and not arguments.supervise:
+        experiment.enable_experiment_mirror(lims_api_session_provider(), sync_interval=arguments.experiment_cache_ttl)
+
+    # Prepare logger handler for saving logs to SIP server and make it run on separate thread
+    log_journal = arguments.log_journal or os.path.join(tempfile.gettempdir(), f"lims-node-{node_name}-logs.jsonl")
+    log_coalescer = None
+    if arguments.log_coalesce_window > 0:
+        log_detail_file = arguments.log_detail_file or os.path.join(tempfile.gettempdir(), f"lims-node-{node_name}-detail.jsonl")
+        log_coalescer = logger_db_api.LogCoalescer(arguments.log_coalesce_window, arguments.log_rate_limit, log_detail_file)
+    sip_logger_handler = logger_db_api.LimsApiLoggerHandler(lims_api_session_provider(), logging.INFO, journal_path=log_journal,
+                                                            compress=arguments.log_compress, coalescer=log_coalescer)
+    threading.Thread(target=sip_logger_handler.keep_flushing, daemon=True).start()
+
+    make_module = supervisor.module_factory(node_name, config, sip_logger_handler, lims_api_session_provider, exp_storage_engine_factory)
+
+    def make_config_syncer(config_syncer_class):
+        conf_syncer = config_syncer_class(
+        config_syncer_class.__module__ + "." + config_syncer_class.__name__, 
+        logging.getLogger("config_syncer"), 
+        logger_db_api.prepare_lims_api_logger("lims_config_syncer", node_name, sip_logger_handler),
+        configuration.LimsModuleConfigWrapper(None, node_name, config), lims_api_session_provider()
+        ) 
+        return conf_syncer
+    # ==============================================================
+
+    # Keep configuration up to date, and ping
+    conf_syncer = make_config_syncer(configuration.ConfigToDbSyncer if is_config_master else configuration.ConfigFromDbSyncer)
+    if not is_config_master and arguments.config_long_poll > 0:
+        conf_syncer.long_poll_wait = arguments.config_long_poll
+
+    # Steps of all modules are run by one scheduler, module config "schedule" selects fixed_delay (default) or fixed_rate
+    module_scheduler = scheduler.ModuleScheduler(arguments.module_workers)
+    module_scheduler.export_metrics()
+
+    if arguments.metrics_port:
+        metrics.MetricsServer(arguments.metrics_port).start()
+    if arguments.metrics_file_interval > 0:
+        metrics_file = arguments.metrics_file or os.path.join(tempfile.gettempdir(), f"lims-node-{node_name}-metrics.jsonl")
+        module_scheduler.schedule("metrics_file", metrics.MetricsFileWriter(metrics_file).write, arguments.metrics_file_interval, jitter=0)
+
+    module_host = supervisor.ModuleHost(make_module, module_scheduler)
+    group_supervisor = None
+    if arguments.supervise:
+        # Module groups run in child processes, this one keeps syncing configuration and submitting logs
+        group_setup = supervisor.GroupSetup(arguments.organization_name, node_name, arguments.sip_api_url, arguments.sip_api_key,
+                                            arguments.sip_api_https_proxy, not arguments.debug_mode, arguments.lims_pool_size,
+                                            arguments.module_workers, arguments.drain_timeout, arguments.experiment_cache_ttl,
+                                            exp_storage_engine_factory, arguments.experiment_mirror)
+        group_supervisor = supervisor.GroupSupervisor(group_setup, sip_logger_handler)
+
+    if sys.platform != "win32":
+        signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
 
     try:
-        time.sleep(arguments.refresh_interval)
-    except KeyboardInterrupt:
-        break
+        while True:
+            step_start = time.monotonic()
+            # Ping lims and fetch/submit configuration
+            try:
+                conf_syncer.step()
+                logging.debug(f"{datetime.datetime.now()} Configuration synced.")
+            except Exception as e:
+                logging.exception(e)
+                time.sleep(arguments.refresh_interval)
+                continue
+        
+            mods = []
+            if not config.is_empty:
+                mods = config.node["Modules"]
+
+            if group_supervisor is not None:
+                group_supervisor.sync(config.version, config.config, mods)
+            else:
+                module_host.sync(mods)
+
+            # Long polling syncer waits for a change by itself, requests are still at least refresh interval apart
+            # (the wait returns early on a change or when it fails)
+            sleep = arguments.refresh_interval
+            if getattr(conf_syncer, "long_poll_wait", None) and not config.is_empty:
+                sleep -= time.monotonic() - step_start
+
+            try:
+                time.sleep(max(sleep, 0))
+            except KeyboardInterrupt:
+                break
+    finally:
+        # On exit (including SIGTERM), running steps are cancelled and get drain timeout to finish
+        stop_node(module_host, group_supervisor, arguments.drain_timeout)
+
+
+def stop_node(module_host: supervisor.ModuleHost, group_supervisor: supervisor.GroupSupervisor, drain_timeout):
+    """ Drain modules before the interpreter exits - executors join their worker threads before atexit handlers run,
+        so draining in atexit would never cancel running steps. Steps not finished within the timeout
+        would keep the process alive, it exits right away instead. """
+    if group_supervisor is not None:
+        group_supervisor.stop(drain_timeout + 5)
+    if module_host.drain(drain_timeout):
+        logging.shutdown()
+        os._exit(1)
+
+
+if __name__ == "__main__":
+    main()
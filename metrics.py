@@ -0,0 +1,272 @@
+""" Process-wide metrics of the node: step timings, LIMS and storage counters, worker pool saturation.
+    Exposed in Prometheus text format by MetricsServer and periodically snapshotted to a rolling file by MetricsFileWriter. """
+import bisect
+import contextlib
+import http.server
+import json
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+_scope = threading.local()
+
+
+@contextlib.contextmanager
+def module_scope(module_name):
+    """ Attribute metrics recorded by this thread (e.g. LIMS calls) to the module """
+    previous = getattr(_scope, "module", None)
+    _scope.module = module_name
+    try:
+        yield
+    finally:
+        _scope.module = previous
+
+
+def current_module():
+    return getattr(_scope, "module", None) or ""
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {} # label values => value
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}")
+        return tuple(str(l) for l in labels)
+
+    def samples(self):
+        """ (suffix, label names, label values, value) """
+        with self._lock:
+            return [("", self.label_names, key, value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        return {",".join(key): value for _, _, key, value in self.samples()}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """ Gauge either set explicitly, or computed at collection by function returning {label values tuple: value} """
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, *labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        return [("", self.label_names, tuple(str(l) for l in key), value) for key, value in self.function().items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Bucket counts, then sum and count
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                counts[idx] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *labels)
+
+    def samples(self):
+        result = []
+        le_names = self.label_names + ("le",)
+        with self._lock:
+            for key, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    result.append(("_bucket", le_names, key + (_format_value(bound),), cumulative))
+                result.append(("_bucket", le_names, key + ("+Inf",), counts[-1]))
+                result.append(("_sum", self.label_names, key, counts[-2]))
+                result.append(("_count", self.label_names, key, counts[-1]))
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            return {",".join(key): {"count": counts[-1], "sum": counts[-2]} for key, counts in self._values.items()}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError(f"Metric {metric.name} already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None) -> Gauge:
+        gauge = self._register(Gauge(name, help, labels))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """ All metrics in Prometheus text exposition format """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, names, values, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+
+registry = MetricsRegistry()
+
+MODULE_STEP_SECONDS = registry.histogram("lims_node_module_step_seconds", "Duration of module steps", ("module",))
+EXPERIMENT_STEP_SECONDS = registry.histogram("lims_node_experiment_step_seconds", "Duration of step_experiment calls", ("module",))
+EXPERIMENT_STEPS = registry.counter("lims_node_experiment_steps_total", "Experiments stepped by modules", ("module",))
+EXPERIMENT_DEADLINE_OVERRUNS = registry.counter("lims_node_experiment_deadline_overruns_total", "Experiment steps running past their soft deadline", ("module",))
+LIMS_REQUESTS = registry.counter("lims_node_lims_requests_total", "Requests sent to LIMS API", ("module", "method", "status"))
+LIMS_REQUEST_SECONDS = registry.counter("lims_node_lims_request_seconds_total", "Time spent waiting for LIMS API", ("module",))
+LIMS_BYTES = registry.counter("lims_node_lims_bytes_total", "Bytes exchanged with LIMS API", ("module", "direction"))
+STORAGE_TRANSFER_SECONDS = registry.counter("lims_node_storage_transfer_seconds_total", "Time spent transferring files", ("module",))
+STORAGE_TRANSFER_BYTES = registry.counter("lims_node_storage_transfer_bytes_total", "Bytes of transferred files", ("module",))
+STORAGE_TRANSFER_FILES = registry.counter("lims_node_storage_transfer_files_total", "Transferred files", ("module",))
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    registry: MetricsRegistry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """ Serves registry on http://host:port/metrics, local only by default """
+    def __init__(self, port, host="127.0.0.1", registry: MetricsRegistry = registry):
+        handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": registry})
+        self._server = http.server.ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics_server", daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MetricsFileWriter:
+    """ Appends registry snapshots as json lines to path, rolling it over to path.1 ... path.<backups> at max_bytes """
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3, registry: MetricsRegistry = registry):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.registry = registry
+
+    def write(self):
+        line = json.dumps({"time": time.time(), "metrics": self.registry.snapshot()}) + "\n"
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+            self._roll()
+        with open(self.path, "a") as f:
+            f.write(line)
+
+    def _roll(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
@@ -7,10 +7,14 @@ import io
 from enum import Enum, IntEnum
 
 from cemproc.micrograph import MicrographScanner
-from common import lmod_getenv
+from common import lmod_getenv, run_cancellable, lazy_import
 import functools, subprocess
-import tempfile, tifffile, mrcfile, numpy as np, os
-from PIL import Image
+import tempfile, os
+# Image libraries are imported at first use, most modules never touch images
+np = lazy_import("numpy")
+tifffile = lazy_import("tifffile")
+mrcfile = lazy_import("mrcfile")
+Image = lazy_import("PIL.Image")
 from data_tools import DataRulesWrapper, DataRule, TransferCondition
 
 class VoxelType(IntEnum):
@@ -110,7 +114,7 @@ class GainRefConverter:
 
     def dm4_to_mrc(self, in_file: pathlib.Path, out_file: pathlib.Path):
         env = self.imod_env_provider()
-        subprocess.run(["dm2mrc", in_file, out_file], env=env, stderr=subprocess.PIPE, check=True)  
+        run_cancellable(["dm2mrc", in_file, out_file], env=env, stderr=subprocess.PIPE, check=True)  
 
     def eer_to_mrc(self, in_file: pathlib.Path, out_file: pathlib.Path):
         Iref = tifffile.imread(in_file)
@@ -185,7 +189,7 @@ class EmMoviesHandler:
         return sum(1 for _ in movie_glob)
 
     @staticmethod
-    def _normalize_to_uint8(arr: np.ndarray) -> np.ndarray:
+    def _normalize_to_uint8(arr: "np.ndarray") -> "np.ndarray":
         arr = np.asarray(arr)
         if arr.ndim >= 3:
             arr = arr[0]
@@ -0,0 +1,225 @@
+""" On-demand diagnostics of the running node: sampling profiler of all threads writing collapsed stacks
+    (flamegraph.pl / speedscope compatible) and tracemalloc snapshot diffs.
+    Triggered by SIGUSR2 (profiling) or by commands sent to a local control socket. """
+import linecache
+import logging
+import contextlib
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger("profiling")
+
+
+class SamplingProfiler:
+    """ Samples stacks of all threads every interval seconds, counting identical stacks """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.path = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration, path):
+        """ Profile for duration seconds, then write collapsed stacks to path. Returns False if already running. """
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self.path = path
+            self._thread = threading.Thread(target=self._run, args=(duration, path), name="sampling_profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """ Stop early, the stacks sampled so far are written """
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, duration, path):
+        logger.info(f"Sampling profiler started for {duration} s")
+        stacks = self.sample(duration)
+        self.write(stacks, path)
+        logger.info(f"Sampling profiler wrote {sum(stacks.values())} samples to {path}")
+
+    def sample(self, duration):
+        stacks = {}
+        names = {}
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline and not self._stop.is_set():
+            frames = sys._current_frames()
+            if len(names) != len(frames):
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                stack = self._collapse(names.get(ident, str(ident)), frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            del frames
+            self._stop.wait(self.interval)
+        return stacks
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        funcs = []
+        while frame is not None:
+            code = frame.f_code
+            funcs.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        funcs.append(thread_name.replace(";", ":"))
+        return ";".join(reversed(funcs))
+
+    @staticmethod
+    def write(stacks, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(stacks.items(), key=lambda x: -x[1]):
+                f.write(f"{stack} {count}\n")
+
+
+class AllocationTracker:
+    """ tracemalloc snapshots, each one compared to the previous one """
+    def __init__(self, frames=5, top=50):
+        self.frames = frames
+        self.top = top
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, path):
+        """ Start tracing on the first call, afterwards write allocations grown since the previous call to path.
+            Returns False when tracing has just started. """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._snapshot = None
+            snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                                                  tracemalloc.Filter(False, linecache.__file__)))
+            previous, self._snapshot = self._snapshot, snapshot
+            if previous is None:
+                logger.info("Allocation tracing started, next snapshot is compared to this one")
+                return False
+            self.write(snapshot.compare_to(previous, "traceback"), path)
+            logger.info(f"Allocation snapshot diff written to {path}")
+            return True
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._snapshot = None
+
+    def write(self, stats, path):
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, "w") as f:
+            f.write(f"Traced memory: current {current} B, peak {peak} B\n")
+            for stat in stats[:self.top]:
+                f.write(f"\n{stat.size_diff:+d} B, {stat.count_diff:+d} blocks (total {stat.size} B in {stat.count} blocks)\n")
+                for line in stat.traceback.format():
+                    f.write(line + "\n")
+
+
+class Diagnostics:
+    """ Commands of the profiler and allocation tracker, files are written to out_dir """
+    def __init__(self, out_dir, profile_duration=30, interval=0.01):
+        self.out_dir = out_dir
+        self.profile_duration = profile_duration
+        self.profiler = SamplingProfiler(interval)
+        self.allocations = AllocationTracker()
+        self._wakeup_fd = None
+
+    def _path(self, kind, ext):
+        return os.path.join(self.out_dir, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+    def profile(self, duration=None):
+        path = self._path("profile", "collapsed")
+        if not self.profiler.start(duration or self.profile_duration, path):
+            return f"profiler already running, writing to {self.profiler.path}"
+        return f"profiling, writing to {path}"
+
+    def stop_profile(self):
+        self.profiler.stop()
+        return f"profiler stopped, written to {self.profiler.path}"
+
+    def malloc(self):
+        path = self._path("malloc", "txt")
+        if not self.allocations.snapshot(path):
+            return "allocation tracing started"
+        return f"allocation diff written to {path}"
+
+    def malloc_stop(self):
+        self.allocations.stop()
+        return "allocation tracing stopped"
+
+    def command(self, line: str):
+        """ profile [seconds] | stop | malloc | malloc-stop """
+        parts = line.split()
+        if not parts:
+            return "empty command"
+        try:
+            if parts[0] == "profile":
+                return self.profile(float(parts[1]) if len(parts) > 1 else None)
+            if parts[0] == "stop":
+                return self.stop_profile()
+            if parts[0] == "malloc":
+                return self.malloc()
+            if parts[0] == "malloc-stop":
+                return self.malloc_stop()
+        except Exception as e:
+            logger.exception(e)
+            return f"failed: {e}"
+        return f"unknown command {parts[0]}"
+
+    def listen_signal(self, sig=signal.SIGUSR2):
+        """ Profile when sig is received. The handler only writes to a pipe, the profiler is started
+            (and logged) by the diagnostics thread, as the signal may interrupt code holding logging locks. """
+        read_fd, self._wakeup_fd = os.pipe()
+        os.set_blocking(self._wakeup_fd, False)
+        threading.Thread(target=self._wait_signals, args=(read_fd,), name="diagnostics_signal", daemon=True).start()
+        signal.signal(sig, self.handle_signal)
+
+    def handle_signal(self, sig, frame):
+        # A full pipe already has a pending request
+        with contextlib.suppress(BlockingIOError):
+            os.write(self._wakeup_fd, b"\0")
+
+    def _wait_signals(self, read_fd):
+        while os.read(read_fd, 1):
+            logger.info(self.profile())
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write((self.server.diagnostics.command(line.decode().strip()) + "\n").encode())
+
+
+class ControlSocket:
+    """ Unix socket accepting diagnostics commands, one per line, e.g. `echo profile 60 | nc -U <path>` """
+    def __init__(self, path, diagnostics: Diagnostics):
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self._server = socketserver.ThreadingUnixStreamServer(path, _ControlHandler)
+        self._server.daemon_threads = True
+        self._server.diagnostics = diagnostics
+        os.chmod(path, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="control_socket", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,3 +1,4 @@
+import functools
 import pathlib
 import common
 import experiment
@@ -6,6 +7,7 @@ import logging
 import configuration
 import experiment
 import fs_storage_engine
+import leases
 import shutil
 
 
@@ -33,11 +35,23 @@ def find_proxy_destination_directory_helper(exp: experiment.ExperimentWrapper, l
     return lims_conf.translate_path(exp.data_source.source_directory, exp.secondary_id, path_mappings=target_mod["PathMappings"], to_proxy=True)
 
 class ProxyTransferHandler(configuration.LimsNodeModule):
-    
+    @functools.cached_property
+    def experiments_api(self):
+        return experiment.ExperimentsApi(self._api_session)
+
+    @functools.cached_property
+    def leases(self):
+        # Nodes running the handler share the experiments, as experiment modules do (lease_store, lease_ttl)
+        return leases.ModuleLeases(self.name, self.module_config, self._api_session, self.logger)
+
     def step(self):
-        exps =  experiment.ExperimentsApi(self._api_session).get_active_experiments()
-        for exp in exps:
-            self._to_proxy_for_experiment(exp)
+        exps =  self.experiments_api.get_active_experiments()
+        for exp in self.leases.track(exps):
+            with self.leases.hold(exp.id) as claimed:
+                if not claimed:
+                    self.logger.debug(f"Experiment {exp.id} is leased by another node, skipping")
+                    continue
+                self._to_proxy_for_experiment(exp)
 
     def _to_proxy_for_experiment(self, exp: experiment.ExperimentWrapper):
         lims_conf = self.module_config.lims_config
@@ -0,0 +1,232 @@
+""" Central scheduler of periodic module steps.
+    One timer thread keeps tasks ordered by their next run time and dispatches due steps onto a bounded worker pool,
+    instead of every module sleeping in its own thread. """
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+import common
+import metrics
+
+FIXED_DELAY = "fixed_delay" # Next run is interval after the previous one finished
+FIXED_RATE = "fixed_rate" # Runs are interval apart from each other, regardless of how long they take
+
+
+class ScheduledTask:
+    def __init__(self, name, func, interval, mode=FIXED_DELAY, jitter=0.1, cancel_event: threading.Event = None, close=None):
+        if mode not in (FIXED_DELAY, FIXED_RATE):
+            raise ValueError(f"Unknown schedule mode {mode}")
+        self.name = name
+        self.func = func
+        self.close = close
+        self.interval = interval
+        self.mode = mode
+        self.jitter = jitter
+        self.cancel_event = cancel_event or threading.Event()
+
+        self.next_run = None # monotonic time of the next run
+        self._rate_base = None # next_run without jitter, for fixed rate
+        self.running = False
+
+        # Statistics
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0 # runs taking longer than interval
+        self.missed = 0 # fixed rate runs skipped because the previous one took too long
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.last_lateness = None # how late the last run started, e.g. when all workers were busy
+        self.max_lateness = 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _close(self):
+        if self.close is None:
+            return
+        try:
+            self.close()
+        except Exception as e:
+            logging.error(f"Error closing module {self.name}", exc_info=e)
+
+    def _jitter(self):
+        return random.uniform(0, self.jitter * self.interval) if self.jitter else 0.0
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "mode": self.mode,
+            "interval": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "overruns": self.overruns,
+            "missed": self.missed,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration,
+            "last_lateness": self.last_lateness,
+            "max_lateness": self.max_lateness,
+        }
+
+
+class ModuleScheduler:
+    def __init__(self, max_workers=16, jitter=0.1):
+        self.jitter = jitter
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="module_step")
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        self._queue = [] # heap of (due time, sequence, task)
+        self._seq = itertools.count()
+        self._tasks = {} # name => task
+        self._busy = 0
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, name="module_scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def busy_workers(self):
+        return self._busy
+
+    @property
+    def tasks(self):
+        return dict(self._tasks)
+
+    def schedule(self, name, func, interval, mode=FIXED_DELAY, jitter=None, cancel_event: threading.Event = None, delay=None, close=None):
+        """ Run func every interval seconds until cancelled, first run after delay (random part of interval by default,
+            so that modules started together do not hit LIMS together). close is called once the task is cancelled
+            and its running step finished. """
+        task = ScheduledTask(name, func, interval, mode, self.jitter if jitter is None else jitter, cancel_event, close)
+        with self._cond:
+            self._tasks[name] = task
+            task.next_run = task._rate_base = time.monotonic() + (task._jitter() if delay is None else delay)
+            self._push(task, task.next_run)
+        return task
+
+    def cancel(self, name):
+        """ Cancel the task, a waiting one is dropped right away, a running one is told to stop through its cancel event """
+        with self._cond:
+            task = self._tasks.pop(name, None)
+            if task is None:
+                return
+            task.cancel()
+            self._queue = [entry for entry in self._queue if entry[2] is not task]
+            heapq.heapify(self._queue)
+            self._cond.notify_all()
+            # A running one is closed when its step finishes
+            idle = not task.running
+        if idle:
+            task._close()
+
+    def drain(self, timeout):
+        """ Cancel all tasks and wait up to timeout seconds for running steps to finish, returns names of those still running """
+        with self._cond:
+            running = [t for t in self._tasks.values() if t.running]
+            names = list(self._tasks)
+        for name in names:
+            self.cancel(name)
+        with self._cond:
+            deadline = time.monotonic() + timeout
+            while self._busy and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return [t.name for t in running if t.running]
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        self._pool.shutdown(wait=wait)
+
+    def export_metrics(self, registry: metrics.MetricsRegistry = metrics.registry):
+        """ Register worker pool saturation and per task scheduling gauges """
+        registry.gauge("lims_node_scheduler_busy_workers", "Module steps running now", function=lambda: {(): self._busy})
+        registry.gauge("lims_node_scheduler_max_workers", "Size of the module step worker pool", function=lambda: {(): self.max_workers})
+        for stat, help in (("max_lateness", "Longest delay of a step start past its due time, seconds"),
+                           ("last_duration", "Duration of the last step, seconds"),
+                           ("overruns", "Steps taking longer than the interval"),
+                           ("missed", "Fixed rate steps skipped because the previous one took too long"),
+                           ("failures", "Steps failed with an exception")):
+            registry.gauge(f"lims_node_scheduler_task_{stat}", help, ("module",),
+                           function=lambda stat=stat: {(t.name,): getattr(t, stat) or 0 for t in list(self._tasks.values())})
+
+    def _push(self, task: ScheduledTask, due):
+        heapq.heappush(self._queue, (due, next(self._seq), task))
+        self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    self._cond.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                if self._shutdown:
+                    return
+                _, _, task = heapq.heappop(self._queue)
+                if task.cancelled:
+                    self._forget(task)
+                    continue
+                task.running = True
+                self._busy += 1
+            self._pool.submit(self._run_task, task)
+
+    def _forget(self, task: ScheduledTask):
+        if self._tasks.get(task.name, None) is task:
+            del self._tasks[task.name]
+
+    def _run_task(self, task: ScheduledTask):
+        start = time.monotonic()
+        task.last_lateness = max(0.0, start - task.next_run)
+        task.max_lateness = max(task.max_lateness, task.last_lateness)
+        try:
+            with common.cancellation_scope(task.cancel_event), metrics.module_scope(task.name):
+                task.func()
+        except common.OperationCancelled:
+            logging.info(f"Module step {task.name} cancelled")
+        except Exception as e:
+            task.failures += 1
+            logging.error(f"Error in controller module step {task.name}", exc_info=e)
+        finally:
+            end = time.monotonic()
+            task.runs += 1
+            task.last_duration = end - start
+            task.max_duration = max(task.max_duration, task.last_duration)
+            metrics.MODULE_STEP_SECONDS.observe(task.last_duration, task.name)
+            if task.last_duration > task.interval:
+                task.overruns += 1
+            self._reschedule(task, end)
+
+    def _reschedule(self, task: ScheduledTask, end):
+        with self._cond:
+            task.running = False
+            self._busy -= 1
+            self._cond.notify_all()
+            # Cancelled while running, cancel left closing to this point
+            closing = task.cancelled
+            if closing or self._shutdown:
+                self._forget(task)
+            else:
+                self._push(task, self._next_run(task, end))
+        if closing:
+            task._close()
+
+    def _next_run(self, task: ScheduledTask, end):
+        if task.mode == FIXED_RATE:
+            next_run = task._rate_base + task.interval
+            if task.interval <= 0:
+                next_run = end
+            elif next_run < end:
+                # Skip the runs that should have happened while this one was running
+                skipped = int((end - next_run) // task.interval) + 1
+                task.missed += skipped
+                next_run += skipped * task.interval
+            task._rate_base = next_run
+            task.next_run = next_run + task._jitter()
+        else:
+            task.next_run = end + task.interval + task._jitter()
+        return task.next_run
@@ -116,7 +116,7 @@ class ScipionWrapper:
         # Create project with this template
         cmd, env = self.prepare_scipion_command(f'python -m pyworkflow.project.scripts.create "{self.project_name}" "{self.wf_template_path}" "{self.project_directory.parent}"')
         self.logger.info(f"Invoking: {cmd}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, env=env)
+        result = common.run_cancellable(cmd, capture_output=True, text=True, shell=True, env=env)
         self.logger.info(f"Exit {result.returncode}")
         self.logger.info(f"Stdout {result.stdout.strip()}")
         self.logger.info(f"Stderr {result.stderr.strip()}")
@@ -191,7 +191,7 @@ class ScipionWrapper:
 
         # Now we are ready to submit the queue job 
         self.logger.info(f"Executing: {submit_cmd}")
-        result = subprocess.run(submit_cmd, shell=True, check=True)
+        result = common.run_cancellable(submit_cmd, shell=True, check=True)
         self.logger.info(f"Submitted queue job for the project schedule: {self.project_name}, exited with {result}")
         return 9999 # TODO - pid
 
@@ -217,7 +217,7 @@ class ScipionWrapper:
     def _stop_command(self):
         cmd, env = self.prepare_scipion_command(f'python -m pyworkflow.project.scripts.stop "{self.project_name}"')
         self.logger.info(f"Creating scipion project: \n {cmd}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, env=env)
+        result = common.run_cancellable(cmd, capture_output=True, text=True, shell=True, env=env)
         self.logger.info(f"Exit {result.returncode}")
         self.logger.info(f"Stdout {result.stdout.strip()}")
         self.logger.info(f"Stderr {result.stderr.strip()}")
@@ -323,16 +323,18 @@ class ScipionExpWrapper(ScipionWrapper, StateObj):
 class ScipionProcessingHandler(ExperimentModuleBase):
 
     def provide_experiments(self):
-        exps = ExperimentsApi(self._api_session).get_experiments_by_states(
+        exps = self.experiments_api.get_experiments_by_states(
             processing_state=[
                 ProcessingState.UNINITIALIZED, 
                        ProcessingState.READY, 
                        ProcessingState.RUNNING,
-                       ProcessingState.FINALIZING]
+                       ProcessingState.FINALIZING],
+            processing_engine="scipion",
+            processing_node=self.module_config.lims_config.node_name,
+            stream=True
             )
-        
 
-        return filter(lambda e: e.processing.engine == "scipion" and (not e.processing.node_name or e.processing.node_name == self.module_config.lims_config.node_name), exps)
+        return exps
 
     def step_experiment(self, exp_engine: ExperimentStorageEngine):
         exp = exp_engine.exp
@@ -360,6 +362,8 @@ class ScipionProcessingHandler(ExperimentModuleBase):
 
         
         def state_project_running():
+            # Running state and pid are visible in LIMS during the transfers
+            exp.exp_api.flush_patch()
             # Download new raw data to the processing source directory
             dw_result, errs = exp_engine.download_raw(sciw.raw_data_dir)
 
@@ -0,0 +1,292 @@
+""" Running modules of the node, optionally in groups isolated in child processes.
+    Modules select their group by module config "group" (default "main"). In supervisor mode the node process only syncs
+    configuration and submits logs to LIMS, each group runs in its own child process, which gets configuration updates
+    and sends LIMS logs back over multiprocessing queues. Crashed children are restarted with exponential backoff. """
+import datetime
+import importlib
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+import time
+import weakref
+
+import common
+import configuration
+import experiment
+import logger_db_api
+import scheduler
+
+DEFAULT_GROUP = "main"
+
+
+def module_group(conf):
+    return conf.get("group", DEFAULT_GROUP)
+
+
+def module_factory(node_name, config: configuration.LimsConfigWrapper, lims_log_handler: logging.Handler,
+                   session_provider, exp_storage_engine_factory):
+    """ make_module(cls, conf) creating configured module instances """
+    def make_module(cls, conf):
+        name = conf["target"]
+        logger = logging.getLogger(conf["target"])
+        lims_logger = logger_db_api.prepare_lims_api_logger("lims/" + conf["target"], node_name, lims_log_handler)
+        module_config = configuration.LimsModuleConfigWrapper(name, node_name, config)
+        if issubclass(cls, experiment.ExperimentModuleBase):
+            return cls(name, logger, lims_logger, module_config, session_provider(), exp_storage_engine_factory)
+        if issubclass(cls, configuration.LimsNodeModule):
+            return cls(name, logger, lims_logger, module_config, session_provider())
+    return make_module
+
+
+class ModuleHost:
+    """ Keeps modules scheduled according to their configuration, starting enabled ones and cancelling removed or disabled ones """
+    def __init__(self, make_module, module_scheduler: scheduler.ModuleScheduler):
+        self.make_module = make_module
+        self.scheduler = module_scheduler
+        self.modules_dict = {}
+        self.action_targets = {} # module.method => (task, config)
+        self._modules = weakref.WeakSet() # modules not yet collected, including removed ones still finishing
+
+    def sync(self, mods):
+        # Kill modules that are not present any longer
+        for active_mod_name in list(self.action_targets):
+            mod_config = next(filter(lambda x: x["target"] == active_mod_name, mods), None)
+            if mod_config is None or ("enabled" in mod_config and not mod_config["enabled"]):
+                self.scheduler.cancel(active_mod_name) # Set module cancel event, steps stop cooperatively
+                del self.action_targets[active_mod_name]
+
+        for conf in mods:
+            # Is this action enabled? If not, skip it.
+            if "enabled" in conf and not conf["enabled"]:
+                continue
+
+            # Is this action already running?
+            if conf["target"] in self.action_targets:
+                continue
+
+            # This action is not running - start it
+            target_spl = conf["target"].split(".")
+            module_name, class_name = ".".join(target_spl[:-1]), target_spl[-1]
+            # Import and configure the module, if not yet done
+            if module_name not in self.modules_dict:
+                module = importlib.import_module(module_name)
+                self.modules_dict[module_name] = module
+            else:
+                module = self.modules_dict[module_name]
+
+            interval = common.parse_timedelta(conf["interval"])
+            seconds = interval.total_seconds()
+
+            try:
+                task_instance = self.make_module(getattr(module, class_name), conf)
+            except Exception as e:
+                logging.error("Failed to initialize module action", exc_info=e)
+                continue
+
+            cancel_event = task_instance.cancel_event
+            try:
+                # Cancelling the task closes the module once its step finishes
+                self.scheduler.schedule(conf["target"], task_instance.step, seconds, conf.get("schedule", scheduler.FIXED_DELAY),
+                                        cancel_event=cancel_event, close=task_instance.close)
+            except ValueError as e:
+                logging.error("Failed to schedule module action", exc_info=e)
+                task_instance.close()
+                continue
+            self._modules.add(task_instance)
+            self.action_targets[conf["target"]] = (cancel_event, conf)
+
+    def drain(self, timeout):
+        """ Cancel all modules and give their running steps, including those on runner workers, timeout seconds to finish.
+            Returns names of modules still running. """
+        deadline = time.monotonic() + timeout
+        modules = list(self._modules)
+        still_running = self.scheduler.drain(timeout)
+        for module in modules:
+            if not module.drain(max(deadline - time.monotonic(), 0)) and module.name not in still_running:
+                still_running.append(module.name)
+        if still_running:
+            logging.warning(f"Module steps not finished within drain timeout: {', '.join(still_running)}")
+        return still_running
+
+
+class GroupSetup:
+    """ Picklable settings a group child process builds its LIMS session and modules from """
+    def __init__(self, organization, node_name, sip_api_url, sip_api_key, https_proxy=None, verify=True, pool_maxsize=10,
+                 module_workers=16, drain_timeout=30, experiment_cache_ttl=2.0, exp_storage_engine_factory=None, experiment_mirror=False):
+        self.organization = organization
+        self.node_name = node_name
+        self.sip_api_url = sip_api_url
+        self.sip_api_key = sip_api_key
+        self.https_proxy = https_proxy
+        self.verify = verify
+        self.pool_maxsize = pool_maxsize
+        self.module_workers = module_workers
+        self.drain_timeout = drain_timeout
+        self.experiment_cache_ttl = experiment_cache_ttl
+        self.exp_storage_engine_factory = exp_storage_engine_factory
+        self.experiment_mirror = experiment_mirror
+        self.log_level = logging.getLogger().level
+
+    def create_session(self):
+        return configuration.create_lims_session(self.sip_api_url, self.sip_api_key, self.https_proxy, verify=self.verify, pool_maxsize=self.pool_maxsize)
+
+
+def run_group(setup: GroupSetup, group, config_queue, log_queue):
+    """ Child process running modules of one group, until None is received or the supervisor is gone """
+    logging.basicConfig(level=setup.log_level, format=f"%(levelname)s:[{group}] %(name)s:%(message)s")
+    experiment.experiment_query_cache.ttl = setup.experiment_cache_ttl
+    if setup.experiment_mirror:
+        experiment.enable_experiment_mirror(setup.create_session(), sync_interval=setup.experiment_cache_ttl)
+    # LIMS logs are submitted by the supervisor
+    lims_log_handler = logging.handlers.QueueHandler(log_queue)
+    lims_log_handler.setLevel(logging.INFO)
+
+    config = configuration.LimsConfigWrapper(setup.organization, setup.node_name)
+    make_module = module_factory(setup.node_name, config, lims_log_handler, setup.create_session, setup.exp_storage_engine_factory)
+    host = ModuleHost(make_module, scheduler.ModuleScheduler(setup.module_workers))
+    supervisor_process = multiprocessing.parent_process()
+    try:
+        while supervisor_process is None or supervisor_process.is_alive():
+            try:
+                message = config_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if message is None:
+                break
+            _, config_obj = message
+            config.from_obj(config_obj, datetime.datetime.utcnow())
+            if not config.is_empty:
+                host.sync([m for m in config.node["Modules"] if module_group(m) == group])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        host.drain(setup.drain_timeout)
+
+
+class _GroupChild:
+    def __init__(self, group):
+        self.group = group
+        self.process = None
+        self.config_queue = None
+        self.sent_version = None
+        self.started_at = None
+        self.restart_at = None
+        self.backoff = None
+        self.restarts = 0
+        self.stopping = False
+
+
+class GroupSupervisor:
+    """ Runs a child process per module group, feeds them configuration, forwards their LIMS logs
+        and restarts crashed ones after backoff, doubling from BACKOFF_MIN up to BACKOFF_MAX unless the child ran STABLE_AFTER seconds """
+    BACKOFF_MIN = 1.0
+    BACKOFF_MAX = 300.0
+    STABLE_AFTER = 60.0
+
+    def __init__(self, setup: GroupSetup, lims_log_handler: logging.Handler, check_interval=1.0, target=run_group):
+        self.setup = setup
+        self.target = target
+        self.check_interval = check_interval
+        self._ctx = multiprocessing.get_context("spawn")
+        self.log_queue = self._ctx.Queue()
+        self._log_listener = logging.handlers.QueueListener(self.log_queue, lims_log_handler, respect_handler_level=True)
+        self._log_listener.start()
+        self.children = {} # group => _GroupChild
+        self._retired = [] # (process, terminate deadline) of removed groups, still stopping
+        self._config = (None, {})
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._monitor_thread = threading.Thread(target=self._monitor, name="group_supervisor", daemon=True)
+        self._monitor_thread.start()
+
+    def sync(self, config_version, config_obj, mods):
+        """ Start children of new groups, stop those of removed groups, send newer configuration to the rest """
+        groups = {module_group(m) for m in mods}
+        with self._lock:
+            self._config = (config_version, config_obj)
+            for group, child in list(self.children.items()):
+                if group not in groups:
+                    self._stop_child(child)
+                    if child.process is not None:
+                        self._retired.append((child.process, time.monotonic() + self.setup.drain_timeout))
+                    del self.children[group]
+            for group in groups:
+                child = self.children.get(group)
+                if child is None:
+                    child = self.children[group] = _GroupChild(group)
+                    self._start_child(child)
+                elif child.process is not None and child.process.is_alive() and child.sent_version != config_version:
+                    self._send_config(child)
+
+    def _send_config(self, child: _GroupChild):
+        child.config_queue.put(self._config)
+        child.sent_version = self._config[0]
+
+    def _start_child(self, child: _GroupChild):
+        child.config_queue = self._ctx.Queue()
+        child.process = self._ctx.Process(target=self.target, args=(self.setup, child.group, child.config_queue, self.log_queue),
+                                          name=f"lims-node-{child.group}", daemon=True)
+        child.process.start()
+        child.started_at = time.monotonic()
+        child.restart_at = None
+        logging.info(f"Started module group {child.group} in process {child.process.pid}")
+        self._send_config(child)
+
+    def _stop_child(self, child: _GroupChild):
+        child.stopping = True
+        if child.process is not None and child.process.is_alive():
+            child.config_queue.put(None)
+
+    def _monitor(self):
+        while not self._stopped.wait(self.check_interval):
+            with self._lock:
+                now = time.monotonic()
+                for process, deadline in self._retired:
+                    if process.is_alive() and now > deadline:
+                        logging.warning(f"Removed module group process {process.pid} did not stop in time, terminating")
+                        self._terminate(process)
+                self._retired = [(p, d) for p, d in self._retired if p.is_alive()]
+                for child in self.children.values():
+                    if child.stopping or child.process is None:
+                        continue
+                    if child.restart_at is not None:
+                        if now >= child.restart_at:
+                            child.restarts += 1
+                            self._start_child(child)
+                        continue
+                    if child.process.is_alive():
+                        continue
+                    # Crashed, restart after backoff, which is reset by a child that ran long enough
+                    if child.backoff is None or now - child.started_at > self.STABLE_AFTER:
+                        child.backoff = self.BACKOFF_MIN
+                    else:
+                        child.backoff = min(child.backoff * 2, self.BACKOFF_MAX)
+                    child.restart_at = now + child.backoff
+                    logging.error(f"Module group {child.group} exited with code {child.process.exitcode}, restarting in {child.backoff:.0f} s")
+
+    @staticmethod
+    def _terminate(process, timeout=5):
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def stop(self, timeout=30):
+        """ Ask children to drain and stop, terminate those (and retired ones of removed groups) not finished within timeout """
+        self._stopped.set()
+        with self._lock:
+            children = list(self.children.values())
+            for child in children:
+                self._stop_child(child)
+            processes = [(f"Module group {c.group}", c.process) for c in children if c.process is not None]
+            processes += [(f"Removed module group process {p.pid}", p) for p, _ in self._retired]
+        deadline = time.monotonic() + timeout
+        for name, process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"{name} did not stop in time, terminating")
+                self._terminate(process)
+        self._log_listener.stop()
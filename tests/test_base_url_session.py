@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Tests for BaseUrlSession from common.py
+"""
+
+import http.server
+import pathlib
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from common import BaseUrlSession
+
+
+class _SlowHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/slow"):
+            time.sleep(0.5)
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBaseUrlSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SlowHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.session = BaseUrlSession(f"http://127.0.0.1:{self.server.server_port}/api/",
+                                      endpoint_timeouts={"experiments/*/email": 130})
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_base_url_joined(self):
+        self.assertEqual(self.session.get("experiments").text, "/api/experiments")
+
+    def test_endpoint_timeouts(self):
+        self.assertEqual(self.session.timeout_for("experiments/abc/email"), 130)
+        self.assertEqual(self.session.timeout_for("experiments"), self.session.timeout)
+
+    def test_slow_request_does_not_block_other_threads(self):
+        slow = threading.Thread(target=lambda: self.session.get("/slow"))
+        slow.start()
+        time.sleep(0.05)
+
+        start = time.time()
+        self.session.get("fast")
+        self.assertLess(time.time() - start, 0.4)
+        slow.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Tests for cooperative cancellation of module steps
+"""
+
+import pathlib
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import common
+from experiment import ExperimentModuleBase, ExperimentWrapper
+from scheduler import ModuleScheduler
+
+
+class TestRunCancellable(unittest.TestCase):
+
+    def test_process_terminated_on_cancel(self):
+        cancel_event = threading.Event()
+        threading.Timer(0.2, cancel_event.set).start()
+        start = time.monotonic()
+        with common.cancellation_scope(cancel_event):
+            with self.assertRaises(common.OperationCancelled):
+                common.run_cancellable(["sleep", "10"], poll_interval=0.05)
+        self.assertLess(time.monotonic() - start, 5)
+
+    @unittest.skipUnless(pathlib.Path("/proc/self").exists(), "process state read from /proc")
+    def test_shell_children_terminated_on_cancel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file = pathlib.Path(tmp) / "sleep.pid"
+            cancel_event = threading.Event()
+            threading.Timer(0.2, cancel_event.set).start()
+            start = time.monotonic()
+            with self.assertRaises(common.OperationCancelled):
+                common.run_cancellable(f"sleep 30 & echo $! > {pid_file}; wait", shell=True, capture_output=True,
+                                       cancel_event=cancel_event, poll_interval=0.05, terminate_timeout=2)
+            self.assertLess(time.monotonic() - start, 5)
+            # Killed shell child is left to init, gone or a zombie
+            status = pathlib.Path(f"/proc/{pid_file.read_text().strip()}/status")
+            self.assertTrue(not status.exists() or "State:\tZ" in status.read_text())
+
+    def test_output_captured(self):
+        result = common.run_cancellable(["echo", "done"], capture_output=True, check=True)
+        self.assertEqual(result.stdout.strip(), b"done")
+
+
+class TestSchedulerCancellation(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = ModuleScheduler(max_workers=2, jitter=0)
+
+    def tearDown(self):
+        self.scheduler.shutdown(wait=False)
+
+    def test_waiting_task_dropped(self):
+        runs = []
+        self.scheduler.schedule("mod", lambda: runs.append(1), 0.05, delay=0.2)
+        self.scheduler.cancel("mod")
+        time.sleep(0.3)
+        self.assertEqual(runs, [])
+        self.assertEqual(self.scheduler.tasks, {})
+
+    def test_drain_waits_for_cooperative_step(self):
+        started = threading.Event()
+
+        def step():
+            started.set()
+            common.current_cancel_event().wait(5)
+
+        self.scheduler.schedule("mod", step, 1, delay=0)
+        self.assertTrue(started.wait(2))
+        self.assertEqual(self.scheduler.drain(2), [])
+        self.assertEqual(self.scheduler.busy_workers, 0)
+
+    def test_drain_reports_stuck_step(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def step():
+            started.set()
+            release.wait(5)
+
+        self.scheduler.schedule("stuck", step, 1, delay=0)
+        self.assertTrue(started.wait(2))
+        self.assertEqual(self.scheduler.drain(0.1), ["stuck"])
+        release.set()
+
+    def test_module_closed_after_cancel(self):
+        closed = []
+        self.scheduler.schedule("idle", lambda: None, 10, delay=10, close=lambda: closed.append("idle"))
+        self.scheduler.cancel("idle")
+        self.assertEqual(closed, ["idle"])
+
+        started = threading.Event()
+
+        def step():
+            started.set()
+            common.current_cancel_event().wait(5)
+            closed.append("step finished")
+
+        self.scheduler.schedule("running", step, 1, delay=0, close=lambda: closed.append("running"))
+        self.assertTrue(started.wait(2))
+        self.scheduler.cancel("running")
+        deadline = time.monotonic() + 2
+        while len(closed) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(closed, ["idle", "step finished", "running"])
+
+
+class SleepingModule(ExperimentModuleBase):
+    """ Runs a long command in its step (parallel 0) or in runner threads (parallel > 0), records cancellation """
+    def _sleep(self, name):
+        events = pathlib.Path(self.module_config["events"])
+        with open(events, "a") as f:
+            f.write(f"started {name}\n")
+        try:
+            common.run_cancellable(["sleep", "60"], poll_interval=0.05)
+        except common.OperationCancelled:
+            with open(events, "a") as f:
+                f.write(f"cancelled {name}\n")
+            raise
+
+    def provide_experiments(self):
+        return [ExperimentWrapper(self.experiments_api.for_experiment(exp_id),
+                                  {"Id": exp_id, "SecondaryId": exp_id, "InstrumentName": "krios", "Technique": "SPA",
+                                   "Storage": {"StorageEngine": "fs"}})
+                for exp_id in ("exp_1", "exp_2")]
+
+    def step(self):
+        if self.is_parallel:
+            return super().step()
+        self._sleep(self.name)
+
+    def step_experiment(self, exp_engine):
+        self._sleep(exp_engine.exp.id)
+
+
+class SleepingParallelModule(SleepingModule):
+    pass
+
+
+# Node process stopped by SIGTERM, module steps run in the scheduler and in ParallelRunner threads
+NODE_SCRIPT = """
+import logging, signal, sys, time
+sys.path[:0] = [{root!r}, {tests!r}]
+import configuration, main, scheduler, supervisor
+from common import BaseUrlSession
+
+modules = [{{"target": "test_cancellation.SleepingModule", "interval": "00:00:10", "parallel": 0, "events": {events!r}}},
+           {{"target": "test_cancellation.SleepingParallelModule", "interval": "00:00:10", "parallel": 2, "events": {events!r},
+             "coalesce_patches": False}}]
+config = configuration.LimsConfigWrapper("org", "node", {{"LimsNodes": {{"node": {{"Modules": modules}}}},
+                                                          "Experiments": [{{"Instrument": "krios", "Technique": "SPA"}}]}})
+
+def make_module(cls, conf):
+    module_config = configuration.LimsModuleConfigWrapper(conf["target"], "node", config)
+    return cls(conf["target"], logging.getLogger(conf["target"]), logging.getLogger(conf["target"]), module_config,
+               BaseUrlSession("http://127.0.0.1:9/"), lambda exp, *args, **kwargs: type("Engine", (), {{"exp": exp, "close": lambda self: None}})())
+
+module_host = supervisor.ModuleHost(make_module, scheduler.ModuleScheduler(4, jitter=0))
+signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+try:
+    module_host.sync(modules)
+    while True:
+        time.sleep(0.1)
+finally:
+    main.stop_node(module_host, None, 10)
+"""
+
+
+@unittest.skipIf(sys.platform == "win32", "stopped by SIGTERM")
+class TestNodeExit(unittest.TestCase):
+
+    def test_sigterm_cancels_running_steps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            events = pathlib.Path(tmp) / "events"
+            events.touch()
+            script = NODE_SCRIPT.format(root=str(pathlib.Path(__file__).parent.parent), tests=str(pathlib.Path(__file__).parent),
+                                        events=str(events))
+            node = subprocess.Popen([sys.executable, "-c", script])
+            try:
+                deadline = time.monotonic() + 30
+                while events.read_text().count("started") < 3 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                node.send_signal(signal.SIGTERM)
+                self.assertEqual(node.wait(20), 0)
+            finally:
+                node.kill()
+            self.assertEqual(sorted(events.read_text().splitlines()),
+                             ["cancelled exp_1", "cancelled exp_2", "cancelled test_cancellation.SleepingModule",
+                              "started exp_1", "started exp_2", "started test_cancellation.SleepingModule"])
+
+
+if __name__ == '__main__':
+    unittest.main()
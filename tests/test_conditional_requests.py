@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Tests for conditional LIMS experiment requests against the local LIMS stand-in server
+"""
+
+import pathlib
+import sys
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from common import BaseUrlSession
+from experiment import ExperimentQueryCache, ExperimentsApi, JobState, ProcessingState
+from lims_local_server import LocalLimsServer
+
+
+def _experiment(exp_id, state="Active"):
+    return {
+        "Id": exp_id,
+        "State": state,
+        "Processing": {"State": "Ready", "Pid": None, "Node": None, "DtLastUpdate": None},
+    }
+
+
+class TestConditionalRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalLimsServer([_experiment("exp_1"), _experiment("exp_2", "Finished")]).start()
+        self.session = BaseUrlSession(self.server.base_url)
+        # No ttl, every poll goes to the server
+        self.api = ExperimentsApi(self.session, ExperimentQueryCache(ttl=0))
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def test_unchanged_list_reuses_wrappers(self):
+        first = self.api.get_active_experiments()
+        second = self.api.get_active_experiments()
+
+        self.assertEqual([e.id for e in first], ["exp_1"])
+        self.assertIs(first[0], second[0])
+        self.assertEqual(self.server.count_requests("GET", 200), 1)
+        self.assertEqual(self.server.count_requests("GET", 304), 1)
+
+    def test_changed_list_refetched(self):
+        self.api.get_active_experiments()
+        self.server.put_experiment(_experiment("exp_2"))
+
+        exps = self.api.get_active_experiments()
+        self.assertEqual(sorted(e.id for e in exps), ["exp_1", "exp_2"])
+        self.assertEqual(self.server.count_requests("GET", 304), 0)
+
+    def test_patch_changes_etag(self):
+        exp = self.api.get_active_experiments()[0]
+        exp.processing.state = ProcessingState.RUNNING
+        self.assertEqual(self.server.experiments["exp_1"]["Processing"]["State"], "Running")
+
+        self.assertEqual(self.api.get_active_experiments()[0].processing.state, ProcessingState.RUNNING)
+        self.assertEqual(self.server.count_requests("GET", 304), 0)
+
+    def test_detail_reload_not_modified(self):
+        exp = self.api.get_active_experiments()[0]
+        exp.reload()
+        exp.reload()
+        self.assertEqual(self.server.count_requests("GET", 304), 1)
+        self.assertEqual(exp.state, JobState.ACTIVE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Tests for content hashed configuration loading and structural diff of LimsConfigWrapper
+"""
+
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import configuration
+from configuration import LimsConfigWrapper, LimsModuleConfigWrapper, config_diff
+
+CONFIG = """
+LimsNodes:
+  node_a:
+    Modules: [{target: a.A, interval: "00:00:10"}]
+  node_b:
+    Modules: [{target: b.B, interval: "00:00:10"}]
+Experiments: []
+"""
+
+
+class TestConfigReload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name) / "config.yml"
+        self.path.write_text(CONFIG)
+        self.config = LimsConfigWrapper("org", "node_a")
+        self.assertTrue(self.config.from_local_file(self.path))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _touch(self, content):
+        self.path.write_text(content)
+        future = time.time() + 10
+        os.utime(self.path, (future, future))
+
+    def test_touched_file_not_parsed(self):
+        self._touch(CONFIG)
+        with patch.object(configuration.yaml, "load") as load:
+            self.assertFalse(self.config.from_local_file(self.path))
+        load.assert_not_called()
+        self.assertEqual(self.config.version, 1)
+
+    def test_changed_sections(self):
+        changes = []
+        self.config.on_change(changes.append)
+        self._touch(CONFIG.replace('b.B, interval: "00:00:10"', 'b.B, interval: "00:01:00"'))
+
+        self.assertTrue(self.config.from_local_file(self.path))
+        self.assertEqual(changes, [{"LimsNodes/node_b"}])
+        self.assertEqual(self.config.get_node_config("node_b")["Modules"][0]["interval"], "00:01:00")
+
+    def test_config_diff(self):
+        self.assertEqual(config_diff({"a": 1, "b": {"c": 1}}, {"a": 1, "b": {"c": 2}, "d": 1}), {"b/c", "d"})
+        self.assertEqual(config_diff({"a": [1]}, {"a": [1]}), set())
+
+
+class TestConfigIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.config = LimsConfigWrapper("org", "node_a")
+        self.config.from_obj(self._config("00:00:10"), 1)
+
+    def _config(self, interval):
+        return {
+            "LimsNodes": {"node_a": {"Modules": [{"target": "a.A", "interval": interval}], "Storage": "fs"},
+                          "node_b": {"Modules": [{"target": "a.A"}, {"target": "b.B"}]}},
+            "Experiments": [{"Instrument": "krios", "Technique": "SPA", "DataRules": []}],
+        }
+
+    def test_lookups(self):
+        self.assertEqual(self.config.get_module_config("a.A")["interval"], "00:00:10")
+        self.assertIsNone(self.config.get_module_config("b.B"))
+        self.assertEqual([m.node_name for m in self.config.find_module_config_nodes("a.A")], ["node_a", "node_b"])
+        self.assertIs(self.config.get_experiment_config("krios", "SPA"), self.config.get_experiment_config("krios", "SPA"))
+        with self.assertRaises(KeyError):
+            self.config.get_experiment_config("krios", "TOMO")
+
+    def test_resolved_settings_follow_new_version(self):
+        module_config = LimsModuleConfigWrapper("a.A", "node_a", self.config)
+        self.assertEqual(module_config["interval"], "00:00:10")
+        self.assertEqual(module_config["Storage"], "fs")
+        self.assertIsNone(module_config.get("missing"))
+        index = self.config.index
+        self.assertEqual(len(index.resolved), 3)
+
+        self.config.from_obj(self._config("00:01:00"), 2)
+        self.assertEqual(module_config["interval"], "00:01:00")
+        self.assertIsNot(self.config.index, index)
+
+    def test_unchanged_sections_carried_over(self):
+        module_a, module_b = LimsModuleConfigWrapper("a.A", "node_a", self.config), LimsModuleConfigWrapper("b.B", "node_b", self.config)
+        self.assertIsNone(module_b.get("interval"))
+        fingerprint = module_b.fingerprint
+        exp_config = self.config.get_experiment_config("krios", "SPA")
+
+        changes = []
+        self.config.on_change(changes.append)
+        self.config.from_obj(self._config("00:01:00"), 2)
+        self.assertEqual(changes, [{"LimsNodes/node_a"}])
+        self.assertTrue(module_a.affected_by(changes[0]))
+        self.assertFalse(module_b.affected_by(changes[0]))
+        self.assertIs(self.config.get_experiment_config("krios", "SPA"), exp_config)
+        self.assertEqual(self.config.index.resolved, {("b.B", "node_b", "interval"): configuration._MISSING})
+        self.assertEqual(self.config.index.fingerprints, {("b.B", "node_b"): fingerprint})
+
+        self.config.remove_change_listener(changes.append)
+        self.config.from_obj({**self._config("00:01:00"), "Experiments": []}, 3)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(self.config.index.experiments, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
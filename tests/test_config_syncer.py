@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Tests for ConfigFromDbSyncer long polling against the local LIMS stand-in server
+"""
+
+import logging
+import pathlib
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from common import BaseUrlSession
+from configuration import ConfigFromDbSyncer, LimsConfigWrapper, LimsModuleConfigWrapper
+from lims_local_server import LocalLimsServer
+
+
+def _config(interval="00:00:10"):
+    return {"LimsNodes": {"node_a": {"Modules": [{"target": "data_clean_service.DataCleanService", "interval": interval}]}}}
+
+
+class TestConfigFromDbSyncer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalLimsServer(config=_config()).start()
+        self.session = BaseUrlSession(self.server.base_url)
+        self.config = LimsConfigWrapper("org", "node_a")
+        logger = logging.getLogger("test_config_syncer")
+        self.syncer = ConfigFromDbSyncer("syncer", logger, logger, LimsModuleConfigWrapper(None, "node_a", self.config), self.session)
+        self.syncer.long_poll_wait = 5
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def _full_fetches(self):
+        return len([r for r in self.server.requests if r[1] == "/centers"])
+
+    def test_change_notified_as_patch(self):
+        self.syncer.step()
+        self.assertEqual(self._full_fetches(), 1)
+
+        waiting = threading.Thread(target=self.syncer.step)
+        start = time.monotonic()
+        waiting.start()
+        time.sleep(0.2)
+        self.server.set_config(_config("00:01:00"))
+        waiting.join()
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.config.get_node_config()["Modules"][0]["interval"], "00:01:00")
+        self.assertEqual(self.config._last_update, self.server.config_versions[-1][0])
+        self.assertEqual(self._full_fetches(), 1)
+
+    def test_no_change_within_wait(self):
+        self.syncer.step()
+        self.syncer.long_poll_wait = 0.2
+        self.syncer.step()
+        self.assertEqual(self.server.count_requests("GET", 204), 1)
+        self.assertEqual(self.config.get_node_config()["Modules"][0]["interval"], "00:00:10")
+
+    def test_failed_wait_ends_step(self):
+        self.syncer.step()
+        with patch.object(self.server, "config_change_since", side_effect=RuntimeError("LIMS error")), \
+                self.assertLogs("test_config_syncer", logging.WARNING):
+            self.syncer.step()
+        self.assertEqual(self.syncer.long_poll_wait, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
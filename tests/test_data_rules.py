@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Tests for cached rule sets of DataRulesWrapper from data_tools.py
+"""
+
+import pathlib
+import sys
+import unittest
+from unittest.mock import Mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from configuration import JobConfigWrapper
+from data_tools import DataRulesWrapper, TransferAction
+from experiment import ExperimentDataSourceWrapper
+
+RULES = [
+    {"patterns": ["*.tif"], "tags": ["raw", "movie"], "action": "move"},
+    {"patterns": ["*.mrc"], "tags": ["raw", "gain"]},
+    {"patterns": ["*.xml"], "tags": ["metadata"]},
+]
+
+
+class TestDataRulesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = DataRulesWrapper(RULES)
+
+    def test_with_tags(self):
+        self.assertEqual([str(r.patterns[0]) for r in self.rules.with_tags("raw")], ["*.tif", "*.mrc"])
+        self.assertEqual([str(r.patterns[0]) for r in self.rules.with_tags({"raw", "gain"}, "metadata")], ["*.mrc", "*.xml"])
+        self.assertEqual(list(self.rules.with_tags("unknown")), [])
+        self.assertIs(self.rules.with_tags({"movie", "raw"}), self.rules.with_tags({"raw", "movie"}))
+        self.assertIs(self.rules.get_target_for({"raw", "movie"}, subfiles=False), self.rules.get_target_for({"movie", "raw"}, subfiles=False))
+
+    def test_job_config_rules_parsed_once(self):
+        job_config = JobConfigWrapper({"DataRules": RULES})
+        self.assertIs(job_config.data_rules, job_config.data_rules)
+
+    def test_combined_rules_do_not_modify_shared_rules(self):
+        data_source = ExperimentDataSourceWrapper({"SourcePatterns": [".tiff"], "KeepSourceFiles": True}, Mock())
+        raw_rules = self.rules.with_tags("raw")
+        combined = data_source.get_combined_raw_datarules(raw_rules)
+
+        self.assertIs(combined, data_source.get_combined_raw_datarules(raw_rules))
+        self.assertEqual([r.action for r in combined], [TransferAction.COPY] * 3)
+        self.assertEqual(raw_rules.data_rules[0].action, TransferAction.MOVE)
+
+
+if __name__ == '__main__':
+    unittest.main()
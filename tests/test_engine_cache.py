@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Tests for StorageEngineCache from experiment.py and storage engines kept by experiment modules between steps
+"""
+
+import copy
+import logging
+import pathlib
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import configuration
+from common import BaseUrlSession
+from experiment import ExperimentModuleBase, ExperimentWrapper, StorageEngineCache
+
+
+class SimpleEngine:
+    def __init__(self, exp):
+        self.exp = exp
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorageEngineCache(unittest.TestCase):
+
+    def _get(self, cache, key, created):
+        with cache.use(key, lambda: created.append(key) or SimpleEngine(None)) as engine:
+            return engine
+
+    def test_engine_reused(self):
+        cache = StorageEngineCache()
+        created = []
+        first = self._get(cache, ("exp_1", "fs", 1), created)
+        self.assertIs(self._get(cache, ("exp_1", "fs", 1), created), first)
+        self.assertEqual(len(created), 1)
+
+    def test_least_recently_used_evicted(self):
+        cache = StorageEngineCache(max_size=2)
+        created = []
+        first = self._get(cache, ("exp_1", "fs", 1), created)
+        self._get(cache, ("exp_2", "fs", 1), created)
+        self._get(cache, ("exp_1", "fs", 1), created)
+        self._get(cache, ("exp_3", "fs", 1), created)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(first.closed)
+        self._get(cache, ("exp_2", "fs", 1), created)
+        self.assertEqual(created.count(("exp_2", "fs", 1)), 2)
+
+    def test_unused_engines_expire(self):
+        cache = StorageEngineCache(ttl=0.05)
+        first = self._get(cache, ("exp_1", "fs", 1), [])
+        time.sleep(0.1)
+        self._get(cache, ("exp_2", "fs", 1), [])
+        self.assertTrue(first.closed)
+        self.assertEqual(len(cache), 1)
+
+    def test_engine_in_use_not_evicted(self):
+        cache = StorageEngineCache(max_size=1, ttl=0)
+        with cache.use(("exp_1", "fs", 1), lambda: SimpleEngine(None)) as engine:
+            self._get(cache, ("exp_2", "fs", 1), [])
+            self.assertFalse(engine.closed)
+        self.assertTrue(engine.closed)
+
+    def test_engine_cleared_in_use_closed_when_released(self):
+        cache = StorageEngineCache()
+        idle = self._get(cache, ("exp_1", "fs", 1), [])
+        with cache.use(("exp_2", "fs", 1), lambda: SimpleEngine(None)) as engine:
+            cache.clear()
+            self.assertTrue(idle.closed)
+            self.assertFalse(engine.closed)
+        self.assertTrue(engine.closed)
+        self.assertEqual(len(cache), 0)
+
+    def test_new_config_version_replaces_engine(self):
+        cache = StorageEngineCache()
+        first = self._get(cache, ("exp_1", "fs", 1), [])
+        self._get(cache, ("exp_1", "fs", 2), [])
+        self.assertTrue(first.closed)
+        self.assertEqual(len(cache), 1)
+
+
+class CountingModule(ExperimentModuleBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.experiments_data = []
+        self.engines = []
+        self.stepped = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def provide_experiments(self):
+        return [ExperimentWrapper(self.experiments_api.for_experiment(data["Id"]), dict(data)) for data in self.experiments_data]
+
+    def step_experiment(self, exp_engine):
+        self.stepped.append((exp_engine, exp_engine.exp.state.value))
+        self.release.wait(5)
+
+
+class TestModuleEngines(unittest.TestCase):
+
+    def _module(self, parallel):
+        config = configuration.LimsConfigWrapper("org", "node", {
+            "LimsNodes": {"node": {"Modules": [{"target": "test_engine_cache.CountingModule", "interval": "00:00:10",
+                                               "parallel": parallel, "coalesce_patches": False}]}},
+            "Experiments": [{"Instrument": "krios", "Technique": "SPA"}],
+        })
+        module_config = configuration.LimsModuleConfigWrapper("test_engine_cache.CountingModule", "node", config)
+        self.session = BaseUrlSession("http://127.0.0.1:9/")
+        self.addCleanup(self.session.close)
+
+        def engine_factory(exp, e_config, logger, module_config, engine=None):
+            module.engines.append(exp.id)
+            return SimpleEngine(exp)
+        module = CountingModule("test_engine_cache.CountingModule", logging.getLogger("test"), logging.getLogger("test"),
+                                module_config, self.session, engine_factory)
+        module.experiments_data = [{"Id": f"exp_{i}", "State": "Active", "SecondaryId": f"exp_{i}",
+                                    "InstrumentName": "krios", "Technique": "SPA", "Storage": {"StorageEngine": "fs"}}
+                                   for i in range(3)]
+        return module
+
+    def test_engines_reused_with_refreshed_data(self):
+        module = self._module(parallel=0)
+        module.step()
+        module.experiments_data[0]["State"] = "Finished"
+        module.step()
+
+        self.assertEqual(sorted(module.engines), ["exp_0", "exp_1", "exp_2"])
+        engine, state = module.stepped[3]
+        self.assertIs(engine, module.stepped[0][0])
+        self.assertEqual(state, "Finished")
+
+    def test_engines_replaced_only_for_changed_settings(self):
+        module = self._module(parallel=0)
+        module.step()
+        config = module.module_config.lims_config
+        config_obj = copy.deepcopy(config.config)
+        config_obj["LimsNodes"]["other_node"] = {"Modules": [{"target": "other.Module", "interval": "00:00:10"}]}
+        config.from_obj(config_obj, 1)
+        module.step()
+        self.assertEqual(len(module.engines), 3)
+
+        config_obj = copy.deepcopy(config_obj)
+        config_obj["Experiments"][0]["DataRules"] = []
+        engines = [engine for engine, _ in module.stepped]
+        config.from_obj(config_obj, 2)
+        # Released on change, not once they expire
+        self.assertTrue(all(engine.closed for engine in engines))
+        module.step()
+        self.assertEqual(len(module.engines), 6)
+
+        module.close()
+        self.assertNotIn(module._config_changed, config._change_listeners)
+
+    def test_engines_created_only_for_free_workers(self):
+        module = self._module(parallel=1)
+        module.release.clear()
+        module.step()
+        self.assertEqual(len(module.engines), 1)
+        module.release.set()
+        module.runner.executor.shutdown(wait=True)
+
+    def test_close_releases_engines_and_runner(self):
+        module = self._module(parallel=0)
+        module.step()
+        engines = [engine for engine, _ in module.stepped]
+        module.close()
+        self.assertTrue(all(engine.closed for engine in engines))
+        self.assertEqual(len(module.engine_cache), 0)
+
+        module = self._module(parallel=2)
+        module.close()
+        with self.assertRaises(RuntimeError):
+            module.runner.executor.submit(lambda: None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Tests for server-side experiment filters and paged experiment queries against the local LIMS stand-in server
+"""
+
+import pathlib
+import sys
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from common import BaseUrlSession
+from experiment import ExperimentQueryCache, ExperimentsApi, ProcessingState, filter_experiments
+from lims_local_server import LocalLimsServer
+
+
+def _experiment(exp_id, engine="scipion", node=None):
+    return {
+        "Id": exp_id,
+        "State": "Active",
+        "InstrumentName": "krios",
+        "Technique": "SPA",
+        "Processing": {"State": "Ready", "ProcessingEngine": engine, "Pid": None, "Node": node, "DtLastUpdate": None},
+        "Publications": [{"PublicationEngine": "b2share", "State": "Unpublished"}],
+    }
+
+
+class TestExperimentFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalLimsServer([
+            _experiment("exp_1"),
+            _experiment("exp_2", node="node_a"),
+            _experiment("exp_3", node="node_b"),
+            _experiment("exp_4", engine="cryosparc"),
+            _experiment("exp_5"),
+        ]).start()
+        self.session = BaseUrlSession(self.server.base_url)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def _api(self, page_size):
+        return ExperimentsApi(self.session, ExperimentQueryCache(ttl=0), page_size=page_size)
+
+    def test_engine_and_node_filters(self):
+        exps = self._api(None).get_experiments_by_states(processing_state=ProcessingState.READY,
+                                                         processing_engine="scipion", processing_node="node_a")
+        self.assertEqual([e.id for e in exps], ["exp_1", "exp_2", "exp_5"])
+
+    def test_paged_query(self):
+        api = self._api(2)
+        exps = api.get_experiments_by_states(processing_engine="scipion")
+        self.assertEqual([e.id for e in exps], ["exp_1", "exp_2", "exp_3", "exp_5"])
+        self.assertEqual(self.server.count_requests("GET", 200), 2)
+
+        # No page changed - wrappers are reused
+        self.assertIs(api.get_experiments_by_states(processing_engine="scipion")[0], exps[0])
+        self.assertEqual(self.server.count_requests("GET", 304), 2)
+
+    def test_streamed_query_requests_pages_lazily(self):
+        exps = self._api(2).get_experiments_by_states(processing_engine="scipion", stream=True)
+        self.assertEqual(self.server.count_requests("GET"), 0)
+        self.assertEqual(next(exps).id, "exp_1")
+        self.assertEqual(self.server.count_requests("GET"), 1)
+        self.assertEqual([e.id for e in exps], ["exp_2", "exp_3", "exp_5"])
+        self.assertEqual(self.server.count_requests("GET"), 2)
+
+    def test_filters_applied_when_ignored_by_server(self):
+        data = [_experiment("exp_1"), _experiment("exp_2", engine="cryosparc")]
+        self.assertEqual(filter_experiments({"processingEngine": "cryosparc", "unknown": "x"}, data), data[1:])
+        self.assertEqual(filter_experiments([("Publication", "Requested"), ("publicationEngine", "empiar-emdb")], data), [])
+        self.assertEqual(filter_experiments({"expType": "krios/SPA,glacios/SPA"}, data), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
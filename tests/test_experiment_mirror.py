@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Tests for ExperimentMirror from experiment.py against the local LIMS stand-in server
+"""
+
+import pathlib
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import experiment
+from common import BaseUrlSession
+from experiment import ExperimentMirror, ExperimentQueryCache, ExperimentsApi, JobState, ProcessingState
+from lims_local_server import LocalLimsServer
+
+
+def _experiment(exp_id, state="Active", processing_state="Ready"):
+    return {
+        "Id": exp_id,
+        "State": state,
+        "Processing": {"State": processing_state, "Pid": None, "Node": None, "DtLastUpdate": None},
+    }
+
+
+class TestExperimentMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalLimsServer([_experiment("exp_1"), _experiment("exp_2", "Finished", "Completed")]).start()
+        self.session = BaseUrlSession(self.server.base_url)
+        cache = ExperimentQueryCache(ttl=0)
+        self.mirror = ExperimentMirror(self.session, sync_interval=0)
+        cache.on_invalidate(self.mirror.mark_stale)
+        self.api = ExperimentsApi(self.session, cache)
+        self._mirror_patch = patch.object(experiment, "experiment_mirror", self.mirror)
+        self._mirror_patch.start()
+
+    def tearDown(self):
+        self._mirror_patch.stop()
+        self.session.close()
+        self.server.stop()
+
+    def _changes_requests(self):
+        return [r for r in self.server.requests if r[1].startswith("/experiments/changes")]
+
+    def test_state_queries_answered_from_mirror(self):
+        self.assertEqual([e.id for e in self.api.get_active_experiments()], ["exp_1"])
+        finished = self.api.get_experiments_by_states(exp_state=[JobState.FINISHED], processing_state=ProcessingState.COMPLETED)
+        self.assertEqual([e.id for e in finished], ["exp_2"])
+
+        # No list queries, only the change feed
+        self.assertEqual(self.server.count_requests("GET"), len(self._changes_requests()))
+
+    def test_only_changes_transferred(self):
+        self.api.get_active_experiments()
+        self.server.put_experiment(_experiment("exp_2"))
+
+        self.assertEqual(sorted(e.id for e in self.api.get_active_experiments()), ["exp_1", "exp_2"])
+        last_feed = self.session.get("experiments/changes", params={"since": 2}).json()
+        self.assertEqual([e["Id"] for e in last_feed["Experiments"]], ["exp_2"])
+
+    def test_local_patch_visible_after_sync(self):
+        exp = self.api.get_active_experiments()[0]
+        exp.state = JobState.STOP_REQUESTED
+        self.assertEqual(self.api.get_active_experiments(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Tests for coalesced experiment patching in ExperimentApi from experiment.py
+"""
+
+import datetime
+import pathlib
+import sys
+import unittest
+from unittest.mock import Mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import requests
+
+from experiment import ExperimentApi, ExperimentQueryCache, ExperimentsApi, ExperimentWrapper, ProcessingState, StorageState
+
+
+def _experiment_data():
+    return {
+        "Id": "exp_1",
+        "State": "Active",
+        "Processing": {"State": "Ready", "Pid": None, "Node": None, "DtLastUpdate": None},
+        "Storage": {"State": "Transfering", "DtLastUpdate": None},
+    }
+
+
+class TestExperimentPatchContext(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        self.exp = ExperimentWrapper(ExperimentApi("exp_1", self.session), _experiment_data())
+
+    def _sent_patches(self):
+        return [c.kwargs["json"] for c in self.session.patch.call_args_list]
+
+    def test_patch_sent_immediately_outside_context(self):
+        self.exp.processing.pid = 42
+        self.exp.processing.state = ProcessingState.RUNNING
+        self.assertEqual(len(self._sent_patches()), 2)
+
+    def test_changes_coalesced_into_one_patch(self):
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        with self.exp.exp_api.patch_context():
+            self.exp.processing.pid = 42
+            self.exp.processing.state = ProcessingState.RUNNING
+            self.exp.processing.last_update = now
+            self.exp.processing.last_update = now + datetime.timedelta(seconds=1)
+            self.exp.storage.state = StorageState.IDLE
+            self.session.patch.assert_not_called()
+
+            # Optimistic local state, visible to later reads in the same step
+            self.assertEqual(self.exp.processing.state, ProcessingState.RUNNING)
+            self.assertEqual(self.exp.processing.last_update, now + datetime.timedelta(seconds=1))
+
+        patches = self._sent_patches()
+        self.assertEqual(len(patches), 1)
+        paths = [op["path"] for op in patches[0]]
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertIn({"op": "replace", "path": "/Storage/State", "value": "Idle"}, patches[0])
+
+    def test_direct_patch_updates_local_data(self):
+        with self.exp.exp_api.patch_context():
+            self.exp.exp_api.patch_experiment({"Storage": {"State": StorageState.IDLE.value}})
+            self.assertEqual(self.exp.storage.state, StorageState.IDLE)
+
+    def test_flushed_on_exception(self):
+        with self.assertRaises(ValueError):
+            with self.exp.exp_api.patch_context():
+                self.exp.processing.state = ProcessingState.RUNNING
+                raise ValueError()
+        self.assertEqual(len(self._sent_patches()), 1)
+
+    def test_failed_flush_keeps_step_exception(self):
+        self.session.patch.side_effect = ConnectionError("LIMS down")
+        with self.assertRaises(ValueError), self.assertLogs(level="ERROR"):
+            with self.exp.exp_api.patch_context():
+                self.exp.processing.state = ProcessingState.RUNNING
+                raise ValueError()
+
+    def test_reload_keeps_pending_changes(self):
+        self.session.get.return_value.json.return_value = _experiment_data()
+        with self.exp.exp_api.patch_context():
+            self.exp.processing.state = ProcessingState.RUNNING
+            self.exp.reload()
+            self.assertEqual(self.exp.processing.state, ProcessingState.RUNNING)
+
+    def test_flushed_before_email(self):
+        with self.exp.exp_api.patch_context():
+            self.exp.storage.state = StorageState.ARCHIVED
+            self.session.post.side_effect = lambda *args, **kwargs: self.assertEqual(len(self._sent_patches()), 1)
+            self.exp.exp_api.send_email({"Template": "DataArchived"})
+        self.session.post.assert_called_once()
+        self.assertEqual(len(self._sent_patches()), 1)
+
+
+class TestFailedPatch(unittest.TestCase):
+
+    def test_rejected_patch_raises_and_wrappers_rebuilt(self):
+        session = Mock()
+        listed, detail = [_experiment_data()], _experiment_data()
+        session.get.side_effect = lambda path, **kwargs: Mock(status_code=200, headers={"ETag": "v1"},
+                                                              json=Mock(return_value=listed if path == "experiments" else detail))
+        session.patch.return_value.raise_for_status.side_effect = requests.HTTPError("409 Conflict")
+        experiments_api = ExperimentsApi(session, ExperimentQueryCache(ttl=60))
+
+        exp = experiments_api.get_experiments()[0]
+        exp.reload()
+        with self.assertRaises(requests.HTTPError):
+            exp.processing.state = ProcessingState.RUNNING
+        self.assertEqual(exp.exp_api._detail_validators, (None, None))
+
+        # LIMS still has the experiment unchanged, wrappers with the rejected change are not reused
+        exp = experiments_api.get_experiments()[0]
+        self.assertEqual(exp.processing.state, ProcessingState.READY)
+
+
+if __name__ == '__main__':
+    unittest.main()
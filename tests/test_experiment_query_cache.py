@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Tests for ExperimentQueryCache from experiment.py
+"""
+
+import pathlib
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from experiment import ExperimentQueryCache, ExperimentsApi, JobState
+
+
+class TestExperimentQueryCache(unittest.TestCase):
+
+    def test_concurrent_identical_queries_fetched_once(self):
+        cache = ExperimentQueryCache(ttl=0)
+        calls = []
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return [{"Id": "exp_1"}]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("q", fetch))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[{"Id": "exp_1"}]] * 5)
+
+    def test_ttl_and_invalidation(self):
+        cache = ExperimentQueryCache(ttl=10)
+        fetch = Mock(return_value=[])
+        cache.get("q", fetch)
+        cache.get("q", fetch)
+        self.assertEqual(fetch.call_count, 1)
+
+        cache.invalidate()
+        cache.get("q", fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_failed_fetch_not_cached(self):
+        cache = ExperimentQueryCache(ttl=10)
+        with self.assertRaises(ValueError):
+            cache.get("q", Mock(side_effect=ValueError()))
+        self.assertEqual(cache.get("q", Mock(return_value=[1])), [1])
+
+    def test_patch_invalidates_shared_queries(self):
+        session = Mock()
+        session.get.return_value.json.side_effect = lambda: [{"Id": "exp_1", "State": "Active"}]
+        api = ExperimentsApi(session, ExperimentQueryCache(ttl=10))
+
+        exps = api.get_active_experiments()
+        api.get_active_experiments()
+        self.assertEqual(session.get.call_count, 1)
+
+        # Wrappers work on their own copy of the data
+        exps[0].exp_api.patch_experiment({"State": JobState.FINISHED.value})
+        self.assertEqual(exps[0].state, JobState.FINISHED)
+
+        self.assertEqual(api.get_active_experiments()[0].state, JobState.ACTIVE)
+        self.assertEqual(session.get.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
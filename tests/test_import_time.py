@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Import-time budget of the node: modules of lightweight nodes must not pull in heavy dependencies
+and must import within IMPORT_TIME_BUDGET seconds (env, default 1)
+"""
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+NODE_MODULES = [
+    "common", "configuration", "experiment", "logger_db_api", "scheduler", "metrics", "profiling",
+    "job_lifecycle_service", "data_expiration_service", "data_archivation_service", "fs_storage_engine",
+    "scipion_processing", "cryosparc.processing", "cemproc.processing",
+]
+HEAVY_MODULES = ["numpy", "PIL", "tifffile", "mrcfile", "matplotlib", "reportlab", "sklearn", "irods"]
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+for name in sys.argv[1].split(","):
+    __import__(name)
+print(json.dumps({"seconds": time.perf_counter() - start,
+                  "heavy": [m for m in sys.argv[2].split(",") if m in sys.modules]}))
+"""
+
+
+class TestImportTime(unittest.TestCase):
+
+    def _measure(self):
+        out = subprocess.run([sys.executable, "-c", _MEASURE, ",".join(NODE_MODULES), ",".join(HEAVY_MODULES)],
+                             cwd=pathlib.Path(__file__).parent.parent, capture_output=True, check=True)
+        return json.loads(out.stdout)
+
+    def test_no_heavy_dependencies(self):
+        self.assertEqual(self._measure()["heavy"], [])
+
+    def test_startup_budget(self):
+        budget = float(os.getenv("IMPORT_TIME_BUDGET", 1.0))
+        # Best of three, the first run may be slowed by cold caches
+        seconds = min(self._measure()["seconds"] for _ in range(3))
+        self.assertLess(seconds, budget, f"Importing node modules took {seconds:.3f} s, budget is {budget} s")
+
+
+if __name__ == '__main__':
+    unittest.main()
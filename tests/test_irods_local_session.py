@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Tests for IrodsExperimentStorageEngine running against the local iRODS stand-in
+"""
+
+import functools
+import hashlib
+import logging
+import pathlib
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from data_tools import DataRule, DataRulesWrapper
+from experiment import ExperimentWrapper
+from irods_local_session import LocalIrodsSession
+from irods_storage_engine import IrodsExperimentStorageEngine
+
+
+class TestLocalIrodsEngine(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = pathlib.Path(self._tmp.name)
+        self.src = self.tmp / "src"
+        self.src.mkdir()
+        self.rules = DataRulesWrapper([DataRule("**/*.tif", ["raw"], keep_tree=True)])
+        exp = ExperimentWrapper(Mock(), {"Storage": {"SubPath": "exp_1"}})
+        self.engine = IrodsExperimentStorageEngine(
+            exp, logging.getLogger("test"), self.rules, {}, connection={"host": "irods.test", "user": "rods", "zone": "tempZone"},
+            collection_base="/tempZone/home/rods",
+            session_factory=functools.partial(LocalIrodsSession, self.tmp / "zone"))
+        self.session = self.engine.irods_collection.irods_session
+        self.engine.prepare()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_put_glob_and_checksum(self):
+        content = b"movie data"
+        (self.src / "a.tif").write_bytes(content)
+        self.engine.put_file(pathlib.Path("sub/a.tif"), self.src / "a.tif")
+
+        globbed = list(self.engine.glob(self.rules))
+        self.assertEqual([g[0] for g in globbed], [pathlib.Path("sub/a.tif")])
+        self.assertEqual(globbed[0][3], len(content))
+        self.assertEqual(self.engine.checksum(pathlib.Path("sub/a.tif"), "sha256"), hashlib.sha256(content).hexdigest())
+
+    def test_read_write_and_delete(self):
+        self.engine.write_file(pathlib.Path("experiment.yml"), "a: 1\n")
+        self.assertTrue(self.engine.file_exists(pathlib.Path("experiment.yml")))
+        self.assertEqual(self.engine.read_file(pathlib.Path("experiment.yml")), "a: 1\n")
+
+        self.engine.del_file(pathlib.Path("experiment.yml"))
+        self.assertFalse(self.engine.file_exists(pathlib.Path("experiment.yml")))
+
+    def test_metadata_applied_as_diff(self):
+        col = self.engine.irods_collection
+        col.store_irods_metadata({"a": 1, "b": "x", "empty": None})
+        self.assertEqual({m.name: m.value for m in col.collection.metadata.items()}, {"a": "1", "b": "x"})
+
+        trips = self.session.round_trips
+        col.store_irods_metadata({"a": 1, "b": "x"})
+        # Collection lookup and AVU listing only, nothing to apply
+        self.assertEqual(self.session.round_trips - trips, 2)
+
+        col.store_irods_metadata({"b": "y"})
+        self.assertEqual({m.name: m.value for m in col.collection.metadata.items()}, {"a": "1", "b": "y"})
+
+    def test_ticket_issued(self):
+        info = self.engine.get_access_info()
+        self.assertEqual(info["Target"], "irods.test")
+        self.assertIn(info["Token"], self.session.tickets())
+
+    def test_latency_injection(self):
+        session = LocalIrodsSession(self.tmp / "slow", latency=0.05)
+        start = time.time()
+        session.collections.exists("/tempZone")
+        session.collections.exists("/tempZone")
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(session.round_trips, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Tests for experiment leases from leases.py, kept in a shared directory and by the local LIMS stand-in server
+"""
+
+import logging
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from common import BaseUrlSession
+from configuration import LimsConfigWrapper, LimsModuleConfigWrapper
+from leases import FsLeaseStore, LeaseKeeper, LimsLeaseStore, ModuleLeases
+from lims_local_server import LocalLimsServer
+
+KEY = "module.Processing/exp_1"
+
+
+class TestFsLeaseStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = FsLeaseStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lease_is_exclusive(self):
+        self.assertTrue(self.store.acquire(KEY, "node_a", 10))
+        self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+        # The owner keeps its lease
+        self.assertTrue(self.store.acquire(KEY, "node_a", 10))
+        self.assertFalse(self.store.renew(KEY, "node_b", 10))
+
+    def test_concurrent_claims_have_one_winner(self):
+        results = []
+        threads = [threading.Thread(target=lambda n=n: results.append(self.store.acquire(KEY, f"node_{n}", 10))) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results.count(True), 1)
+
+    def test_expired_lease_is_taken_over(self):
+        self.assertTrue(self.store.acquire(KEY, "node_a", 0.05))
+        time.sleep(0.1)
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+        self.assertFalse(self.store.renew(KEY, "node_a", 10))
+
+    def test_release(self):
+        self.assertTrue(self.store.acquire(KEY, "node_a", 10))
+        # Only the owner releases the lease
+        self.store.release(KEY, "node_b")
+        self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+        self.store.release(KEY, "node_a")
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+
+
+class TestLeaseKeeper(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = FsLeaseStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_held_lease_is_renewed_past_ttl(self):
+        keeper = LeaseKeeper(self.store, "node_a", 0.15)
+        with keeper.hold(KEY) as claimed:
+            self.assertTrue(claimed)
+            time.sleep(0.4)
+            self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+        # Not renewed after the block, expires after ttl
+        time.sleep(0.3)
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+
+    def test_leased_by_other_node_not_claimed(self):
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+        with LeaseKeeper(self.store, "node_a", 10).hold(KEY) as claimed:
+            self.assertFalse(claimed)
+
+    def test_release_while_held_waits_for_step(self):
+        keeper = LeaseKeeper(self.store, "node_a", 10)
+        with keeper.hold(KEY):
+            keeper.release(KEY)
+            self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+
+
+class TestModuleLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = FsLeaseStore(self.tmp.name)
+        config = LimsConfigWrapper("org", "node_a", {"LimsNodes": {"node_a": {"Modules": [
+            {"target": "module.Processing", "lease_store": self.tmp.name, "lease_ttl": "00:01:00"}]}}})
+        self.leases = ModuleLeases("module.Processing", LimsModuleConfigWrapper("module.Processing", "node_a", config), None,
+                                   logging.getLogger("test"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _step(self, exp_ids):
+        for exp in self.leases.track(SimpleNamespace(id=exp_id) for exp_id in exp_ids):
+            with self.leases.hold(exp.id) as claimed:
+                self.assertTrue(claimed)
+
+    def test_kept_between_steps_and_released_when_no_longer_provided(self):
+        self._step(["exp_1", "exp_2"])
+        self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+        self._step(["exp_2"])
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+        self.assertFalse(self.store.acquire("module.Processing/exp_2", "node_b", 10))
+
+    def test_not_released_by_incomplete_step(self):
+        self._step(["exp_1"])
+        # Runner without free workers does not go through the experiments
+        next(self.leases.track(SimpleNamespace(id=exp_id) for exp_id in ["exp_2", "exp_3"]))
+        self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+
+    def test_not_used_without_lease_store(self):
+        config = LimsConfigWrapper("org", "node_a", {"LimsNodes": {"node_a": {"Modules": [{"target": "module.Processing"}]}}})
+        leases = ModuleLeases("module.Processing", LimsModuleConfigWrapper("module.Processing", "node_a", config), None, None)
+        self.assertIsNone(leases.keeper)
+        with leases.hold("exp_1") as claimed:
+            self.assertTrue(claimed)
+
+
+class TestLimsLeaseStore(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalLimsServer([{"Id": "exp_1", "State": "Active"}]).start()
+        self.session = BaseUrlSession(self.server.base_url)
+        self.store = LimsLeaseStore(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def test_lease_is_exclusive_until_released(self):
+        self.assertTrue(self.store.acquire(KEY, "node_a", 10))
+        self.assertFalse(self.store.acquire(KEY, "node_b", 10))
+        self.assertTrue(self.store.renew(KEY, "node_a", 10))
+        self.store.release(KEY, "node_a")
+        self.assertTrue(self.store.acquire(KEY, "node_b", 10))
+        self.assertEqual(self.server.leases[("exp_1", "module.Processing")][0], "node_b")
+
+
+if __name__ == '__main__':
+    unittest.main()
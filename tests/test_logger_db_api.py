@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Tests for LimsApiLoggerHandler from logger_db_api.py
+"""
+
+import gzip
+import json
+import logging
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from logger_db_api import LimsApiLoggerHandler, LogCoalescer
+
+
+def _record(msg):
+    return logging.LogRecord("test", logging.INFO, __file__, 1, msg, None, None)
+
+
+class TestLimsApiLoggerHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = pathlib.Path(self.tmp.name) / "logs.jsonl"
+        self.session = Mock()
+        self.posted = []
+        def post(path, data, headers, stream):
+            self.posted.extend(json.loads(gzip.decompress(data) if headers.get("Content-Encoding") == "gzip" else data))
+            return Mock()
+        self.session.post.side_effect = post
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_emit_does_not_block_when_full(self):
+        handler = LimsApiLoggerHandler(self.session, queue_max=2, journal_path=self.journal)
+        start = time.monotonic()
+        for i in range(5):
+            handler.emit(_record(f"log {i}"))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(self.journal.read_text().splitlines()), 3)
+
+        handler.flush()
+        self.assertEqual(sorted(l["Message"] for l in self.posted), [f"log {i}" for i in range(5)])
+        self.assertFalse(self.journal.exists())
+
+    def test_failed_submission_replayed(self):
+        handler = LimsApiLoggerHandler(self.session, journal_path=self.journal)
+        post = self.session.post.side_effect
+        self.session.post.side_effect = ConnectionError("LIMS down")
+        handler.emit(_record("first"))
+        handler.flush()
+        self.assertEqual(self.session.post.call_count, 1)
+
+        # Backoff - no attempt until it expires
+        handler.emit(_record("second"))
+        handler.flush()
+        self.assertEqual(self.session.post.call_count, 1)
+
+        self.session.post.side_effect = post
+        handler._retry_at = 0
+        handler.flush()
+        self.assertEqual([l["Message"] for l in self.posted], ["first", "second"])
+
+    def test_dropped_without_journal(self):
+        handler = LimsApiLoggerHandler(self.session, queue_max=1)
+        handler.emit(_record("kept"))
+        handler.emit(_record("dropped"))
+        self.assertEqual(handler.dropped, 1)
+
+    def test_compressed_only_when_enabled(self):
+        for compress in (False, True):
+            handler = LimsApiLoggerHandler(self.session, compress=compress)
+            handler.emit(_record("log"))
+            handler.flush()
+            headers = self.session.post.call_args.kwargs["headers"]
+            self.assertEqual(headers.get("Content-Encoding") == "gzip", compress)
+        self.assertEqual([l["Message"] for l in self.posted], ["log", "log"])
+
+
+def _log_data(msg, origin="scipion", level="Information", coalesce=None):
+    log = {"Id": msg, "ExperimentId": "exp_1", "Dt": "2024-01-01T00:00:00", "Origin": origin, "Level": level, "Message": msg}
+    if coalesce:
+        log["_coalesce"] = coalesce
+    return log
+
+
+class TestLogCoalescer(unittest.TestCase):
+
+    def test_repeated_messages_summarized(self):
+        coalescer = LogCoalescer(window=60)
+        passed = coalescer.process([_log_data(f"Frame {i} aligned") for i in range(100)] + [_log_data("Failed", level="Error")], now=0)
+        self.assertEqual([l["Message"] for l in passed], ["Frame 0 aligned", "Failed"])
+
+        self.assertEqual(coalescer.process([], now=30), [])
+        summary = coalescer.process([], now=60)
+        self.assertEqual([l["Message"] for l in summary], ["Frame 99 aligned (99 similar messages in last 60 s)"])
+
+    def test_templated_messages_and_detail_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            detail = pathlib.Path(tmp) / "detail.jsonl"
+            coalescer = LogCoalescer(window=60, detail_path=detail)
+            template = "TRANSFER [raw]; {count} files, {size} in last {window} s"
+            logs = [_log_data(f"TRANSFER {i}", coalesce=(template, 1024 ** 2)) for i in range(412)]
+            self.assertEqual(coalescer.process(logs, now=0), [])
+
+            summary = coalescer.summaries(now=61)
+            self.assertEqual([l["Message"] for l in summary], ["TRANSFER [raw]; 412 files, 412.0MiB in last 60 s"])
+            self.assertEqual(len(detail.read_text().splitlines()), 412)
+
+    def test_rate_limit_per_origin(self):
+        coalescer = LogCoalescer(window=60, rate_limit=3)
+        passed = coalescer.process([_log_data(f"message {c}") for c in "abcdef"] + [_log_data("other", origin="cryosparc")], now=0)
+        self.assertEqual([l["Message"] for l in passed], ["message a", "message b", "message c", "other"])
+        self.assertEqual(len(coalescer.summaries(force=True)), 3)
+
+    def test_concurrent_processing_keeps_counts(self):
+        coalescer = LogCoalescer(window=60)
+        template = "TRANSFER [raw]; {count} files"
+        summaries = []
+        done = threading.Event()
+
+        def log(thread):
+            for batch in range(50):
+                coalescer.process([_log_data(f"TRANSFER {thread} {batch} {i}", coalesce=(template, 1),
+                                             origin=f"origin_{i % 3}") for i in range(10)])
+
+        def flush():
+            while not done.is_set():
+                summaries.extend(coalescer.summaries(force=True))
+
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        threads = [threading.Thread(target=log, args=(t,)) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        done.set()
+        flusher.join()
+        summaries.extend(coalescer.summaries(force=True))
+        self.assertEqual(sum(int(s["Message"].split()[2]) for s in summaries), 8 * 50 * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Tests for metrics.py and the metrics recorded by LIMS sessions and the module scheduler
+"""
+
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import metrics
+from common import BaseUrlSession
+from lims_local_server import LocalLimsServer
+from scheduler import ModuleScheduler
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_render_prometheus_text(self):
+        counter = self.registry.counter("calls_total", "Calls", ("module",))
+        counter.inc(2, "mod")
+        histogram = self.registry.histogram("step_seconds", "Steps", ("module",), buckets=(1, 10))
+        histogram.observe(0.5, "mod")
+        histogram.observe(5, "mod")
+        self.registry.gauge("busy", "Busy", function=lambda: {(): 3})
+
+        text = self.registry.render()
+        self.assertIn("# TYPE calls_total counter", text)
+        self.assertIn('calls_total{module="mod"} 2', text)
+        self.assertIn('step_seconds_bucket{module="mod",le="1"} 1', text)
+        self.assertIn('step_seconds_bucket{module="mod",le="10"} 2', text)
+        self.assertIn('step_seconds_bucket{module="mod",le="+Inf"} 2', text)
+        self.assertIn('step_seconds_count{module="mod"} 2', text)
+        self.assertIn("busy 3", text)
+
+    def test_server_and_rolling_file(self):
+        self.registry.counter("calls_total", "Calls").inc()
+        server = metrics.MetricsServer(0, registry=self.registry).start()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+                self.assertIn("calls_total 1", response.read().decode())
+        finally:
+            server.stop()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.jsonl")
+            writer = metrics.MetricsFileWriter(path, max_bytes=100, backups=1, registry=self.registry)
+            for _ in range(3):
+                writer.write()
+            self.assertEqual(sorted(os.listdir(tmp)), ["metrics.jsonl", "metrics.jsonl.1"])
+            with open(path) as f:
+                self.assertEqual(json.loads(f.readline())["metrics"]["calls_total"], {"": 1})
+
+
+class TestRecordedMetrics(unittest.TestCase):
+
+    def test_lims_calls_attributed_to_module(self):
+        server = LocalLimsServer([]).start()
+        session = BaseUrlSession(server.base_url)
+        try:
+            before = metrics.LIMS_REQUESTS.get("test_module", "GET", "200")
+            with metrics.module_scope("test_module"):
+                session.get("experiments")
+            self.assertEqual(metrics.LIMS_REQUESTS.get("test_module", "GET", "200"), before + 1)
+            self.assertGreater(metrics.LIMS_BYTES.get("test_module", "received"), 0)
+        finally:
+            session.close()
+            server.stop()
+
+    def test_scheduler_step_timings(self):
+        module_scheduler = ModuleScheduler(max_workers=1, jitter=0)
+        done = threading.Event()
+        try:
+            module_scheduler.schedule("timed_module", done.set, 10, delay=0)
+            self.assertTrue(done.wait(2))
+            module_scheduler.drain(2)
+        finally:
+            module_scheduler.shutdown(wait=False)
+        self.assertEqual(metrics.MODULE_STEP_SECONDS.snapshot()["timed_module"]["count"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
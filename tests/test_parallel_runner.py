@@ -276,6 +276,56 @@ class TestParallelRunner(unittest.TestCase):
         self.assertEqual(step_func.call_count, 1)
 
 
+class TestFairParallelRunner(unittest.TestCase):
+    """Test cases for fair ordering and deadlines of ParallelRunner"""
+
+    def setUp(self):
+        self.logger = logging.getLogger('test')
+
+    def _served(self, runner, exp_engines, step_func):
+        runner.step(exp_engines, step_func)
+        served = [e.exp.id for e in exp_engines if e.exp.id in runner.exec_state]
+        while runner.exec_state:
+            time.sleep(0.01)
+        return served
+
+    def test_least_recently_served_first(self):
+        runner = ParallelRunner(max_workers=1, name="test_runner", logger=self.logger)
+        exp_engines = [MockExperimentEngine(f"exp_{i}", delay=0.05) for i in range(3)]
+        step_func = Mock(side_effect=lambda e: e.process())
+
+        served = [self._served(runner, exp_engines, step_func) for _ in range(4)]
+        self.assertEqual(served, [["exp_0"], ["exp_1"], ["exp_2"], ["exp_0"]])
+
+    def test_weights(self):
+        weights = {"exp_0": 1, "exp_1": 10}
+        runner = ParallelRunner(max_workers=1, name="test_runner", logger=self.logger, weight=lambda exp: weights[exp.id])
+        exp_engines = [MockExperimentEngine(f"exp_{i}", delay=0.05) for i in range(2)]
+        step_func = Mock(side_effect=lambda e: e.process())
+
+        served = [self._served(runner, exp_engines, step_func) for _ in range(4)]
+        # Heavier experiment goes first and is served again before the lighter one waited long enough
+        self.assertEqual(served[0], ["exp_1"])
+        self.assertEqual(served[1], ["exp_0"])
+        self.assertEqual(served[2:].count(["exp_1"]), 2)
+
+    def test_deadline_overrun_logged(self):
+        runner = ParallelRunner(max_workers=2, name="test_runner", logger=self.logger, deadline=0.05)
+        exp_engine = MockExperimentEngine("exp_1", delay=0.3)
+        step_func = Mock(side_effect=lambda e: e.process())
+
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            runner.step([exp_engine], step_func)
+            time.sleep(0.1)
+            runner.step([exp_engine], step_func)
+            runner.step([exp_engine], step_func)
+            while runner.exec_state:
+                time.sleep(0.01)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("still running", logs.records[0].getMessage())
+        self.assertIn("step took", logs.records[1].getMessage())
+
+
 class TestSequentialRunner(unittest.TestCase):
     """Test cases for SequentialRunner class"""
 
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Tests for translate_path of LimsConfigWrapper with path mappings compiled into PathMappingTrie
+"""
+
+import pathlib
+import sys
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import common
+from configuration import LimsConfigWrapper
+
+MAPPINGS = [
+    {"From": "/data/instruments/krios", "To": "/mnt/krios"},
+    {"From": "/data", "To": "/mnt/data", "Proxy": "/proxy/data"},
+    {"From": "/data/instruments", "To": "/mnt/instruments"},
+    {"From": "D:\\Krios\\OffloadData", "To": "/mnt/offload", "Proxy": "/proxy/offload"},
+]
+
+
+def _translate_linear(path, safe_stem, path_mappings, to_proxy=False):
+    # Reference - mappings tried one by one
+    for mpp in path_mappings:
+        fromp = common.path_universal_factory(mpp["From"])
+        to = common.path_universal_factory(mpp["To"])
+        proxy = common.path_universal_factory(mpp["Proxy"]) if "Proxy" in mpp and mpp["Proxy"] else None
+        if to_proxy and not proxy:
+            continue
+        if to_proxy:
+            to = proxy
+        rel = common.try_translate_path(path, fromp, to)
+        if rel and proxy:
+            return to / safe_stem
+        elif rel:
+            return to / rel
+    return None
+
+
+class TestPathMapping(unittest.TestCase):
+
+    def setUp(self):
+        self.config = LimsConfigWrapper("org", "node_a", {"LimsNodes": {"node_a": {"PathMappings": MAPPINGS, "Modules": []}}})
+
+    def test_same_as_linear_translation(self):
+        paths = ["/data/instruments/krios/exp_1", "/data/instruments/krios", "/data/instruments/glacios/exp_2",
+                 "/data", "/other/exp_3", "/datax/exp_4", "D:\\Krios\\OffloadData\\exp_5", "d:\\krios\\offloaddata\\exp_6", "D:\\Other\\exp_7"]
+        for path_str in paths:
+            path = common.path_universal_factory(path_str)
+            for to_proxy in (False, True):
+                with self.subTest(path=path_str, to_proxy=to_proxy):
+                    self.assertEqual(self.config.translate_path(path, "stem", to_proxy=to_proxy),
+                                     _translate_linear(path, "stem", MAPPINGS, to_proxy))
+
+    def test_compiled_once_per_config_version(self):
+        trie = self.config.index.path_mapping_trie(MAPPINGS)
+        self.config.translate_path(pathlib.PurePosixPath("/data/x"), "stem", path_mappings=MAPPINGS)
+        self.assertIs(self.config.index.path_mapping_trie(MAPPINGS), trie)
+
+
+if __name__ == '__main__':
+    unittest.main()
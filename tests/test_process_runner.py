@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests for ProcessRunner from experiment.py, experiment steps run in spawned worker processes
+"""
+
+import datetime
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import configuration
+from common import BaseUrlSession, OperationCancelled, run_cancellable
+from experiment import ExperimentModuleBase, ExperimentWrapper, ProcessRunner
+
+
+class SimpleEngine:
+    def __init__(self, exp):
+        self.exp = exp
+
+
+def engine_factory(exp, e_config, logger, module_config, engine=None):
+    return SimpleEngine(exp)
+
+
+class CpuModule(ExperimentModuleBase):
+    experiment_ids = []
+
+    def provide_experiments(self):
+        return [ExperimentWrapper(self.experiments_api.for_experiment(exp_id),
+                                  {"Id": exp_id, "SecondaryId": exp_id, "InstrumentName": "krios", "Technique": "SPA",
+                                   "Storage": {"StorageEngine": "fs"}})
+                for exp_id in self.experiment_ids]
+
+    def step_experiment(self, exp_engine):
+        if exp_engine.exp.id == "crash":
+            os._exit(1)
+        out = pathlib.Path(self.module_config["out_dir"]) / exp_engine.exp.id
+        if exp_engine.exp.id == "sleep":
+            out.with_suffix(".started").touch()
+            try:
+                run_cancellable(["sleep", "60"])
+            except OperationCancelled:
+                out.with_suffix(".cancelled").touch()
+                raise
+        out.write_text(str(os.getpid()))
+
+
+class TestProcessRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = config = configuration.LimsConfigWrapper("org", "node", self._config_obj(self.tmp.name))
+        module_config = configuration.LimsModuleConfigWrapper("test_process_runner.CpuModule", "node", config)
+        self.session = BaseUrlSession("http://127.0.0.1:9/")
+        self.module = CpuModule("test_process_runner.CpuModule", logging.getLogger("test"), logging.getLogger("test"),
+                                module_config, self.session, engine_factory)
+
+    @staticmethod
+    def _config_obj(out_dir):
+        return {
+            "LimsNodes": {"node": {"Modules": [{"target": "test_process_runner.CpuModule", "interval": "00:00:10",
+                                               "runner": "process", "parallel": 2, "coalesce_patches": False,
+                                               "out_dir": out_dir}]}},
+            "Experiments": [{"Instrument": "krios", "Technique": "SPA"}],
+        }
+
+    def tearDown(self):
+        self.module.runner.shutdown()
+        self.session.close()
+        self.tmp.cleanup()
+
+    def _step(self, experiment_ids):
+        self.module.experiment_ids = experiment_ids
+        self.module.step()
+        deadline = time.monotonic() + 60
+        while self.module.runner.exec_state and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def test_steps_run_in_worker_processes(self):
+        self.assertIsInstance(self.module.runner, ProcessRunner)
+        self._step(["exp_1", "exp_2"])
+
+        pids = {int((pathlib.Path(self.tmp.name) / exp_id).read_text()) for exp_id in ["exp_1", "exp_2"]}
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_crashed_worker_isolated(self):
+        with self.assertLogs("test", logging.ERROR) as logs:
+            self._step(["crash"])
+        self.assertIn("Worker process crashed", logs.output[0])
+
+        self._step(["exp_1"])
+        self.assertTrue((pathlib.Path(self.tmp.name) / "exp_1").exists())
+
+    def test_closed_module_stops_workers(self):
+        self._step(["exp_1"])
+        processes = list(self.module.runner._pool._processes.values())
+        self.assertTrue(processes)
+        self.module.close()
+        for process in processes:
+            process.join(30)
+            self.assertFalse(process.is_alive())
+
+    @unittest.skipIf(sys.platform == "win32", "workers are cancelled by SIGTERM")
+    def test_drain_cancels_steps_in_workers(self):
+        out = pathlib.Path(self.tmp.name)
+        self.module.experiment_ids = ["sleep"]
+        self.module.step()
+        deadline = time.monotonic() + 60
+        while not (out / "sleep.started").exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        processes = list(self.module.runner._pool._processes.values())
+
+        self.module.cancel_event.set()
+        start = time.monotonic()
+        self.assertTrue(self.module.drain(20))
+        self.assertLess(time.monotonic() - start, 15)
+        self.assertTrue((out / "sleep.cancelled").exists())
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+    def test_workers_recreated_for_new_config(self):
+        self._step(["exp_1"])
+        pool, finalizer = self.module.runner._pool, self.module.runner._pool_finalizer
+        # Settings of other nodes are not used by the workers
+        config_obj = self._config_obj(self.tmp.name)
+        config_obj["LimsNodes"]["other_node"] = {"Modules": []}
+        self.config.from_obj(config_obj, datetime.datetime.utcnow())
+        self._step(["exp_2"])
+        self.assertIs(self.module.runner._pool, pool)
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            self.config.from_obj(self._config_obj(out_dir), datetime.datetime.utcnow())
+            self._step(["exp_3"])
+            self.assertTrue((pathlib.Path(out_dir) / "exp_3").exists())
+        self.assertIsNot(self.module.runner._pool, pool)
+        self.assertFalse(finalizer.alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Tests for profiling.py diagnostics
+"""
+
+import os
+import pathlib
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import profiling
+
+
+def _busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        self.diagnostics = profiling.Diagnostics(self.tmp, profile_duration=0.2, interval=0.005)
+
+    def tearDown(self):
+        self.diagnostics.allocations.stop()
+        self._tmp.cleanup()
+
+    def test_collapsed_stacks_of_other_threads(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy_worker, args=(stop,), name="busy_worker")
+        worker.start()
+        try:
+            self.diagnostics.profile()
+            self.assertIn("already running", self.diagnostics.profile())
+            self.diagnostics.profiler._thread.join(5)
+        finally:
+            stop.set()
+            worker.join()
+
+        with open(self.diagnostics.profiler.path) as f:
+            lines = f.read().splitlines()
+        busy = [l for l in lines if l.startswith("busy_worker;")]
+        self.assertTrue(busy)
+        stack, count = busy[0].rsplit(" ", 1)
+        self.assertIn("_busy_worker (test_profiling.py:", stack)
+        self.assertGreater(int(count), 0)
+
+    def test_allocation_diff(self):
+        self.assertEqual(self.diagnostics.command("malloc"), "allocation tracing started")
+        retained = [bytearray(1024) for _ in range(1000)]
+        result = self.diagnostics.command("malloc")
+        path = result.rsplit(" ", 1)[1]
+        with open(path) as f:
+            self.assertIn("test_profiling.py", f.read())
+        del retained
+
+    @unittest.skipIf(sys.platform == "win32", "Unix signals only")
+    def test_signal_starts_profiler(self):
+        previous = signal.getsignal(signal.SIGUSR2)
+        try:
+            self.diagnostics.listen_signal(signal.SIGUSR2)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            deadline = time.monotonic() + 5
+            while self.diagnostics.profiler._thread is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.diagnostics.profiler.stop()
+            self.assertTrue(os.path.exists(self.diagnostics.profiler.path))
+        finally:
+            signal.signal(signal.SIGUSR2, previous)
+
+    @unittest.skipIf(sys.platform == "win32", "Unix sockets only")
+    def test_control_socket(self):
+        path = os.path.join(self.tmp, "control.sock")
+        control = profiling.ControlSocket(path, self.diagnostics).start()
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+                sock.sendall(b"bogus\n")
+                self.assertEqual(sock.makefile().readline().strip(), "unknown command bogus")
+        finally:
+            control.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Tests for ModuleScheduler from scheduler.py
+"""
+
+import pathlib
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from scheduler import FIXED_DELAY, FIXED_RATE, ModuleScheduler
+
+
+class TestModuleScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = ModuleScheduler(max_workers=2, jitter=0)
+
+    def tearDown(self):
+        self.scheduler.shutdown(wait=False)
+
+    def test_fixed_rate_does_not_drift(self):
+        runs = []
+        task = self.scheduler.schedule("rate", lambda: (runs.append(time.monotonic()), time.sleep(0.05)), 0.1, FIXED_RATE, delay=0)
+        time.sleep(0.55)
+        task.cancel()
+        self.assertGreaterEqual(len(runs), 5)
+        # Runs are interval apart from the first one, duration of the step does not add up
+        self.assertAlmostEqual(runs[4] - runs[0], 0.4, delta=0.05)
+
+    def test_fixed_delay_and_overruns(self):
+        runs = []
+        task = self.scheduler.schedule("delay", lambda: (runs.append(time.monotonic()), time.sleep(0.1)), 0.05, FIXED_DELAY, delay=0)
+        time.sleep(0.5)
+        task.cancel()
+        self.assertGreaterEqual(runs[1] - runs[0], 0.15)
+        self.assertEqual(task.overruns, task.runs)
+
+    def test_missed_runs_counted(self):
+        task = self.scheduler.schedule("slow", lambda: time.sleep(0.25), 0.1, FIXED_RATE, delay=0)
+        time.sleep(0.3)
+        task.cancel()
+        self.assertEqual(task.runs, 1)
+        self.assertEqual(task.missed, 2)
+
+    def test_cancelled_task_removed(self):
+        cancel_event = threading.Event()
+        calls = []
+        self.scheduler.schedule("cancelled", lambda: calls.append(1), 0.05, cancel_event=cancel_event, delay=0)
+        time.sleep(0.08)
+        cancel_event.set()
+        time.sleep(0.15)
+        count = len(calls)
+        time.sleep(0.1)
+        self.assertEqual(len(calls), count)
+        self.assertNotIn("cancelled", self.scheduler.tasks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Tests for GroupSupervisor from supervisor.py, with simple module group child processes
+"""
+
+import logging
+import logging.handlers
+import os
+import pathlib
+import sys
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import supervisor
+
+
+def echo_group(setup, group, config_queue, log_queue):
+    logger = logging.getLogger(f"lims/{group}")
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    while True:
+        message = config_queue.get()
+        if message is None:
+            return
+        logger.info(f"{group} got config {message[0]}", extra={"origin": group})
+
+
+def crashing_group(setup, group, config_queue, log_queue):
+    os._exit(3)
+
+
+def hanging_group(setup, group, config_queue, log_queue):
+    while True:
+        time.sleep(1)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+class TestGroupSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.group_setup = supervisor.GroupSetup("org", "node", "http://127.0.0.1:9/", "key")
+
+    def test_config_sent_and_logs_forwarded(self):
+        group_supervisor = supervisor.GroupSupervisor(self.group_setup, self.handler, check_interval=0.05, target=echo_group)
+        try:
+            mods = [{"target": "a.A"}, {"target": "b.B", "group": "batch"}]
+            group_supervisor.sync(1, {}, mods)
+            group_supervisor.sync(2, {}, mods)
+            messages = lambda: sorted(r.getMessage() for r in self.handler.records)
+            self.assertTrue(_wait_for(lambda: len(self.handler.records) == 4), messages())
+            self.assertEqual(messages(), ["batch got config 1", "batch got config 2", "main got config 1", "main got config 2"])
+            self.assertEqual({r.origin for r in self.handler.records}, {"main", "batch"})
+
+            # Removed group is stopped
+            batch = group_supervisor.children["batch"].process
+            group_supervisor.sync(3, {}, mods[:1])
+            self.assertTrue(_wait_for(lambda: not batch.is_alive()))
+            self.assertEqual(batch.exitcode, 0)
+        finally:
+            group_supervisor.stop(10)
+
+    def test_crashed_group_restarted_with_backoff(self):
+        group_supervisor = supervisor.GroupSupervisor(self.group_setup, self.handler, check_interval=0.05, target=crashing_group)
+        group_supervisor.BACKOFF_MIN = 0.1
+        try:
+            group_supervisor.sync(1, {}, [{"target": "a.A"}])
+            child = group_supervisor.children["main"]
+            self.assertTrue(_wait_for(lambda: child.restarts >= 2))
+            self.assertGreater(child.backoff, 0.1)
+            self.assertIn(child.process.exitcode, (None, 3))
+        finally:
+            group_supervisor.stop(10)
+
+    def test_removed_group_terminated_after_drain_timeout(self):
+        self.group_setup.drain_timeout = 0.2
+        group_supervisor = supervisor.GroupSupervisor(self.group_setup, self.handler, check_interval=0.05, target=hanging_group)
+        try:
+            group_supervisor.sync(1, {}, [{"target": "a.A"}, {"target": "b.B", "group": "batch"}])
+            batch = group_supervisor.children["batch"].process
+            group_supervisor.sync(2, {}, [{"target": "a.A"}])
+            self.assertTrue(_wait_for(lambda: not batch.is_alive()))
+            self.assertLess(batch.exitcode, 0)
+        finally:
+            group_supervisor.stop(1)
+
+    def test_stop_terminates_removed_groups(self):
+        self.group_setup.drain_timeout = 60
+        group_supervisor = supervisor.GroupSupervisor(self.group_setup, self.handler, check_interval=0.05, target=hanging_group)
+        group_supervisor.sync(1, {}, [{"target": "a.A"}, {"target": "b.B", "group": "batch"}])
+        batch = group_supervisor.children["batch"].process
+        group_supervisor.sync(2, {}, [{"target": "a.A"}])
+        group_supervisor.stop(0.5)
+        self.assertFalse(batch.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()